@@ -0,0 +1,259 @@
+"""
+WindexRouter - Архив лога использования
+Старые помесячные партиции лога использования переносятся в сжатые файлы Arrow IPC
+по дням и удаляются из БД целиком
+"""
+
+import asyncio
+import calendar
+import fcntl
+import logging
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import db
+import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # pyarrow необязателен: без него архивация выключена
+    pa = None
+
+logger = logging.getLogger("windexrouter.archive")
+
+# Строки старше стольких дней уходят в архив (0 = архивация выключена)
+USAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("USAGE_ARCHIVE_AFTER_DAYS", "0"))
+USAGE_ARCHIVE_DIR = os.getenv("USAGE_ARCHIVE_DIR", "usage_archive")
+USAGE_ARCHIVE_INTERVAL = float(os.getenv("USAGE_ARCHIVE_INTERVAL", "3600"))
+# Строк в одном чтении партиции (не больше одного файла части на день)
+USAGE_ARCHIVE_BATCH = int(os.getenv("USAGE_ARCHIVE_BATCH", "5000"))
+USAGE_ARCHIVE_COMPRESSION = os.getenv("USAGE_ARCHIVE_COMPRESSION", "zstd")
+
+ARCHIVED_ROWS = metrics.Counter("windex_usage_archived_rows_total", "Строки лога использования, перенесенные в архив")
+
+COLUMNS = ("id", "user_id", "api_key_id", "endpoint", "timestamp")
+
+
+def _schema():
+    # Повторяющиеся строковые значения хранятся словарем: файл остается компактным
+    return pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.dictionary(pa.int32(), pa.string())),
+        ("api_key_id", pa.dictionary(pa.int32(), pa.string())),
+        ("endpoint", pa.dictionary(pa.int32(), pa.string())),
+        ("timestamp", pa.int64()),
+    ])
+
+
+def _day(ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def _partition_dir(root: str, day: str) -> str:
+    return os.path.join(root, f"day={day}")
+
+
+def _write_part(root: str, day: str, rows: List[tuple]):
+    """Записать строки одного дня в отдельный файл (атомарно через переименование).
+    Имя файла — первый id строк: при повторе после сбоя файл перезаписывается, а не дублируется."""
+    directory = _partition_dir(root, day)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{rows[0][0]:012d}.arrow")
+    columns = list(zip(*rows))
+    table = pa.Table.from_arrays(
+        [
+            pa.array(columns[0], pa.int64()),
+            pa.array(columns[1], pa.string()).dictionary_encode(),
+            pa.array(columns[2], pa.string()).dictionary_encode(),
+            pa.array(columns[3], pa.string()).dictionary_encode(),
+            pa.array(columns[4], pa.int64()),
+        ],
+        schema=_schema(),
+    )
+    options = pa.ipc.IpcWriteOptions(compression=USAGE_ARCHIVE_COMPRESSION or None)
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def archive_batch(table: str, after_id: int, batch_size: int, root: str) -> Tuple[int, int]:
+    """Выгрузить в архив одну пачку строк партиции с id больше after_id.
+    Возвращает (число строк, последний id); 0 строк — партиция выгружена."""
+    # Чтение без блокировки записи: в партицию прошлого месяца никто не пишет, а запись
+    # в текущую партицию не ждет выгрузки. Архиваторы разделяет блокировка файла (_archive_lock)
+    conn = db.connect()
+    try:
+        if table not in db.usage_partitions(conn):
+            return 0, after_id  # партицию уже удалил другой воркер
+        rows = conn.execute(f'''
+            SELECT id, user_id, api_key_id, endpoint, timestamp FROM {table}
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, batch_size)).fetchall()
+        if not rows:
+            return 0, after_id
+
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(_day(row[4]), []).append(row)
+        for day, day_rows in by_day.items():
+            _write_part(root, day, day_rows)
+        return len(rows), rows[-1][0]
+    finally:
+        conn.close()
+
+
+def drop_partition(table: str):
+    """Удалить выгруженную партицию: DROP TABLE вместо построчного DELETE.
+    Блокировка записи — только на удаление таблицы и перестройку представления"""
+    conn = db.connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        db.drop_usage_partition(conn, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _archive_lock(root: str):
+    """Неблокирующая блокировка каталога архива между процессами; None — архивирует другой воркер"""
+    os.makedirs(root, exist_ok=True)
+    lock_file = open(os.path.join(root, ".lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def expired_partitions(cutoff: int) -> List[str]:
+    """Партиции месяцев, целиком лежащих раньше cutoff"""
+    conn = db.connect()
+    try:
+        month_start = calendar.timegm(time.gmtime(cutoff)[:2] + (1, 0, 0, 0))
+        return db.usage_partitions(conn, end_ts=month_start)
+    finally:
+        conn.close()
+
+
+def _day_range(start_ts: Optional[int], end_ts: Optional[int], root: str) -> List[str]:
+    if not os.path.isdir(root):
+        return []
+    days = sorted(name[4:] for name in os.listdir(root) if name.startswith("day="))
+    first = _day(start_ts) if start_ts is not None else None
+    last = _day(end_ts) if end_ts is not None else None
+    return [day for day in days if (first is None or day >= first) and (last is None or day <= last)]
+
+
+def query_archive(start_ts: Optional[int] = None, end_ts: Optional[int] = None,
+                  columns: Optional[Sequence[str]] = None, root: str = USAGE_ARCHIVE_DIR):
+    """Архивные строки за [start_ts, end_ts) как pyarrow.Table.
+
+    Читаются только нужные столбцы нужных дней. Сжатые файлы (USAGE_ARCHIVE_COMPRESSION)
+    распаковываются в память; без сжатия столбцы отображаются из файла без копирования."""
+    if pa is None:
+        raise RuntimeError("Для чтения архива нужен пакет pyarrow")
+    selected = list(columns or COLUMNS)
+    if start_ts is not None or end_ts is not None:
+        needed = list(dict.fromkeys(selected + ["timestamp"]))
+    else:
+        needed = selected
+    schema = _schema()
+    options = pa.ipc.IpcReadOptions(included_fields=sorted(schema.get_field_index(name) for name in needed))
+
+    tables = []
+    for day in _day_range(start_ts, end_ts, root):
+        directory = _partition_dir(root, day)
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".arrow"):
+                continue
+            with pa.memory_map(os.path.join(directory, name), "r") as source:
+                tables.append(pa.ipc.open_file(source, options=options).read_all().select(needed))
+
+    if not tables:
+        return schema.empty_table().select(selected)
+    table = pa.concat_tables(tables)
+    if start_ts is not None:
+        table = table.filter(pc.greater_equal(table["timestamp"], start_ts))
+    if end_ts is not None:
+        table = table.filter(pc.less(table["timestamp"], end_ts))
+    return table.select(selected)
+
+
+class UsageArchiver:
+    """Фоновый перенос старых строк лога использования в архив"""
+
+    def __init__(self, after_days: int, interval: float, batch_size: int, root: str):
+        self.after_days = after_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.root = root
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.after_days > 0 and pa is not None
+
+    async def run_once(self) -> int:
+        """Архивировать все партиции месяцев старше порога: выгрузка пачками, затем DROP TABLE"""
+        loop = asyncio.get_running_loop()
+        lock_file = _archive_lock(self.root)
+        if lock_file is None:
+            return 0
+        try:
+            return await self._archive_expired(loop)
+        finally:
+            lock_file.close()
+
+    async def _archive_expired(self, loop: asyncio.AbstractEventLoop) -> int:
+        cutoff = db.now_ts() - self.after_days * 86400
+        total = 0
+        for table in await loop.run_in_executor(None, expired_partitions, cutoff):
+            moved, last_id = 0, 0
+            while True:
+                count, last_id = await loop.run_in_executor(None, archive_batch, table, last_id,
+                                                            self.batch_size, self.root)
+                if not count:
+                    break
+                moved += count
+                ARCHIVED_ROWS.inc(amount=count)
+            # Файлы частей названы по первому id: повтор после сбоя до DROP перезапишет их, а не продублирует
+            await loop.run_in_executor(None, drop_partition, table)
+            total += moved
+            logger.info("Партиция %s перенесена в архив: %d строк", table, moved)
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Ошибка архивации лога использования")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.after_days > 0 and pa is None:
+            logger.warning("USAGE_ARCHIVE_AFTER_DAYS задан, но pyarrow не установлен: архивация выключена")
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+usage_archiver = UsageArchiver(USAGE_ARCHIVE_AFTER_DAYS, USAGE_ARCHIVE_INTERVAL, USAGE_ARCHIVE_BATCH, USAGE_ARCHIVE_DIR)
@@ -0,0 +1,465 @@
+"""
+WindexRouter - Пакетные задания
+JSONL с запросами загружается целиком, обрабатывается в фоне с низким приоритетом,
+результаты дописываются в выходной JSONL; после перезапуска задание продолжается с места остановки
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+
+import db
+import metrics
+import proxy
+import routing
+from context_window import context_limits
+from lifecycle import readiness
+from proxy import PROXY_ROUTES, ProxyRoute
+from quotas import quota_manager
+from usage import usage_writer
+
+logger = logging.getLogger("windexrouter.batch")
+
+# Каталог файлов заданий: <BATCH_DIR>/<id>/input.jsonl и output.jsonl
+BATCH_DIR = os.getenv("BATCH_DIR", "batch_jobs")
+BATCH_MAX_LINES = int(os.getenv("BATCH_MAX_LINES", "50000"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(100 * 1024 * 1024)))
+# Одновременных запросов пакетных заданий на воркер
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Низкий приоритет: новые запросы пакета не отправляются, пока у воркера больше
+# BATCH_YIELD_THRESHOLD интерактивных запросов к upstream в обработке
+BATCH_YIELD_THRESHOLD = int(os.getenv("BATCH_YIELD_THRESHOLD", "0"))
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "2.0"))
+# Аренда задания воркером (сек): задание упавшего воркера подхватывается по ее истечении
+BATCH_LEASE = int(os.getenv("BATCH_LEASE", "60"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+# Период сохранения прогресса и продления аренды (сек, не реже трети BATCH_LEASE);
+# сам результат пишется в выходной файл сразу
+BATCH_CHECKPOINT_INTERVAL = float(os.getenv("BATCH_CHECKPOINT_INTERVAL", "2.0"))
+
+METRICS_ROUTE = "batch"
+# Маршруты, доступные в пакете: url строки -> маршрут upstream
+BATCH_ROUTES: Dict[str, ProxyRoute] = {
+    path: route for path, route in PROXY_ROUTES.items() if route.method == "POST"
+}
+DEFAULT_URL = "/v1/chat/completions"
+# Ошибки upstream, после которых запрос повторяется
+RETRYABLE_STATUSES = (status.HTTP_429_TOO_MANY_REQUESTS, status.HTTP_502_BAD_GATEWAY,
+                      status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_504_GATEWAY_TIMEOUT)
+
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+BATCH_ITEMS = metrics.Counter("windex_batch_items_total", "Обработанные строки пакетных заданий", ("result",))
+BATCH_ACTIVE = metrics.Gauge("windex_batch_requests_in_flight", "Запросы пакетных заданий в обработке")
+
+_worker_id = uuid.uuid4().hex
+
+
+def job_dir(job_id: str) -> str:
+    return os.path.join(BATCH_DIR, job_id)
+
+
+def input_path(job_id: str) -> str:
+    return os.path.join(job_dir(job_id), "input.jsonl")
+
+
+def output_path(job_id: str) -> str:
+    return os.path.join(job_dir(job_id), "output.jsonl")
+
+
+def parse_input(content: bytes) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """Разобрать и проверить JSONL: (custom_id, url, body) на строку. Ошибка — HTTPException 400.
+    Строка — {"custom_id", "url", "body"} в формате OpenAI Batch или просто тело запроса чата."""
+    items = []
+    for number, raw in enumerate(content.splitlines(), 1):
+        if not raw.strip():
+            continue
+        if len(items) >= BATCH_MAX_LINES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"В задании больше {BATCH_MAX_LINES} строк"
+            )
+        try:
+            line = json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Строка {number}: неверный JSON")
+        if not isinstance(line, dict):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Строка {number}: ожидается JSON-объект")
+        if "body" in line:
+            url, body, custom_id = line.get("url", DEFAULT_URL), line["body"], line.get("custom_id")
+        else:
+            url, body, custom_id = DEFAULT_URL, line, None
+        route = BATCH_ROUTES.get(url)
+        if route is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Строка {number}: маршрут '{url}' недоступен в пакетных заданиях")
+        if not isinstance(body, dict) or route.required_field not in body:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Строка {number}: отсутствует поле '{route.required_field}' в запросе")
+        items.append((str(custom_id) if custom_id is not None else f"line-{number}", url, body))
+    if not items:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Задание не содержит запросов")
+    return items
+
+
+def job_to_dict(row) -> dict:
+    (job_id, job_status, total, completed, failed, created_at, started_at, finished_at, error) = row
+    return {
+        "id": job_id,
+        "status": job_status,
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "created_at": db.ts_to_iso(created_at),
+        "started_at": db.ts_to_iso(started_at),
+        "finished_at": db.ts_to_iso(finished_at),
+        "error": error,
+    }
+
+
+JOB_COLUMNS = "id, status, total, completed, failed, created_at, started_at, finished_at, error"
+
+
+def create_job(user_id: str, key_id: str, content: bytes) -> dict:
+    """Проверить входной файл, сохранить его на диск и поставить задание в очередь"""
+    items = parse_input(content)
+    job_id = str(uuid.uuid4())
+    os.makedirs(job_dir(job_id), exist_ok=True)
+    with open(input_path(job_id), "w", encoding="utf-8") as f:
+        for custom_id, url, body in items:
+            f.write(json.dumps({"custom_id": custom_id, "url": url, "body": body}, ensure_ascii=False) + "\n")
+    conn = db.connect()
+    try:
+        conn.execute('''
+            INSERT INTO batch_jobs (id, user_id, api_key_id, status, total, created_at)
+            VALUES (?, ?, ?, 'queued', ?, ?)
+        ''', (job_id, user_id, key_id, len(items), db.now_ts()))
+        conn.commit()
+        row = conn.execute(f'SELECT {JOB_COLUMNS} FROM batch_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return job_to_dict(row)
+
+
+def get_job(job_id: str, user_id: str) -> Optional[dict]:
+    conn = db.connect()
+    try:
+        row = conn.execute(f'SELECT {JOB_COLUMNS} FROM batch_jobs WHERE id = ? AND user_id = ?',
+                           (job_id, user_id)).fetchone()
+    finally:
+        conn.close()
+    return job_to_dict(row) if row else None
+
+
+def list_jobs(user_id: str, limit: int) -> List[dict]:
+    conn = db.connect()
+    try:
+        rows = conn.execute(f'''
+            SELECT {JOB_COLUMNS} FROM batch_jobs WHERE user_id = ?
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (user_id, limit)).fetchall()
+    finally:
+        conn.close()
+    return [job_to_dict(row) for row in rows]
+
+
+def cancel_job(job_id: str, user_id: str) -> Optional[dict]:
+    """Отменить задание; обработанные строки остаются в выходном файле"""
+    conn = db.connect()
+    try:
+        conn.execute(f'''
+            UPDATE batch_jobs SET status = 'cancelled', finished_at = ?, lease_owner = NULL
+            WHERE id = ? AND user_id = ? AND status NOT IN {FINAL_STATUSES}
+        ''', (db.now_ts(), job_id, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+    return get_job(job_id, user_id)
+
+
+def delete_job(job_id: str, user_id: str) -> Optional[bool]:
+    """Удалить завершенное задание вместе с файлами. None — не найдено, False — еще выполняется"""
+    conn = db.connect()
+    try:
+        row = conn.execute('SELECT status FROM batch_jobs WHERE id = ? AND user_id = ?',
+                           (job_id, user_id)).fetchone()
+        if row is None:
+            return None
+        if row[0] not in FINAL_STATUSES:
+            return False
+        conn.execute('DELETE FROM batch_jobs WHERE id = ?', (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    shutil.rmtree(job_dir(job_id), ignore_errors=True)
+    return True
+
+
+def _is_failed(result: dict) -> bool:
+    return "error" in result or result.get("status_code") != 200
+
+
+def _done_lines(path: str) -> Tuple[Set[int], int]:
+    """Номера строк, результат которых уже записан, и число неудачных среди них.
+    Недописанная последняя строка (обрыв во время записи) обрезается."""
+    done: Set[int] = set()
+    failed = 0
+    if not os.path.exists(path):
+        return done, failed
+    with open(path, "rb+") as f:
+        content = f.read()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):
+            f.truncate(end)
+    for raw in content[:end].splitlines():
+        result = json.loads(raw)
+        done.add(result["line"])
+        failed += _is_failed(result)
+    return done, failed
+
+
+def _read_input(job_id: str) -> List[dict]:
+    with open(input_path(job_id), "rb") as f:
+        return [json.loads(raw) for raw in f]
+
+
+class BatchRunner:
+    """Фоновая обработка пакетных заданий с ограниченным параллелизмом"""
+
+    def __init__(self, concurrency: int, yield_threshold: int, poll_interval: float, lease: int):
+        self.concurrency = concurrency
+        self.yield_threshold = yield_threshold
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._active = 0  # запросы пакетов к upstream в обработке
+        self._task: Optional[asyncio.Task] = None
+
+    def _claim(self) -> Optional[Tuple[str, str, str]]:
+        """Взять в работу очередное задание или задание с истекшей арендой"""
+        now = db.now_ts()
+        conn = db.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute('''
+                SELECT id, user_id, api_key_id FROM batch_jobs
+                WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?)
+                ORDER BY created_at LIMIT 1
+            ''', (now,)).fetchone()
+            if row is not None:
+                conn.execute('''
+                    UPDATE batch_jobs SET status = 'running', started_at = COALESCE(started_at, ?),
+                        lease_owner = ?, lease_expires_at = ?
+                    WHERE id = ?
+                ''', (now, _worker_id, now + self.lease, row[0]))
+            conn.commit()
+            return row
+        finally:
+            conn.close()
+
+    def _checkpoint(self, job_id: str, completed: int, failed: int) -> bool:
+        """Сохранить прогресс и продлить аренду; False — задание отменено или передано другому воркеру"""
+        conn = db.connect()
+        try:
+            cursor = conn.execute('''
+                UPDATE batch_jobs SET completed = ?, failed = ?, lease_expires_at = ?
+                WHERE id = ? AND status = 'running' AND lease_owner = ?
+            ''', (completed, failed, db.now_ts() + self.lease, job_id, _worker_id))
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def _finish(self, job_id: str, job_status: str, completed: Optional[int] = None,
+                failed: Optional[int] = None, error: Optional[str] = None):
+        conn = db.connect()
+        try:
+            conn.execute('''
+                UPDATE batch_jobs SET status = ?, completed = COALESCE(?, completed), failed = COALESCE(?, failed),
+                    error = ?, finished_at = ?, lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ? AND status = 'running' AND lease_owner = ?
+            ''', (job_status, completed, failed, error, db.now_ts(), job_id, _worker_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _release(self, job_id: str):
+        """Вернуть задание в очередь (остановка воркера): его продолжит любой воркер"""
+        conn = db.connect()
+        try:
+            conn.execute('''
+                UPDATE batch_jobs SET status = 'queued', lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ? AND status = 'running' AND lease_owner = ?
+            ''', (job_id, _worker_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _key_active(self, key_id: str) -> bool:
+        conn = db.connect()
+        try:
+            row = conn.execute('SELECT is_active, expires_at FROM api_keys WHERE id = ?', (key_id,)).fetchone()
+        finally:
+            conn.close()
+        return bool(row and row[0] and (row[1] is None or row[1] > db.now_ts()))
+
+    async def _wait_for_idle(self, user_id: str, key_id: str):
+        """Уступить интерактивному трафику и дождаться квоты"""
+        while True:
+            exceeded = quota_manager.check(user_id, key_id)
+            if exceeded is not None:
+                await asyncio.sleep(min(exceeded.retry_after, 60))
+            # Интерактивная нагрузка — запросы к upstream помимо самих пакетов; служебные
+            # запросы (/metrics, /readyz, опрос заданий) upstream не нагружают
+            elif readiness.draining or routing.backend_pool.in_flight - self._active > self.yield_threshold:
+                await asyncio.sleep(0.05)
+            else:
+                return
+
+    async def _call(self, user_id: str, key_id: str, item: dict) -> dict:
+        """Выполнить одну строку задания: {"status_code", "body"} или {"error"}"""
+        route = BATCH_ROUTES[item["url"]]
+        request_data = dict(item["body"], stream=False)
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            await self._wait_for_idle(user_id, key_id)
+            try:
+                context_limits.fit(route, request_data)
+                usage_writer.record(user_id, key_id, route.name)
+                quota_manager.record_request(user_id, key_id)
+                BATCH_ACTIVE.inc()
+                self._active += 1
+                try:
+                    response = await proxy.forward(
+                        route, json.dumps(request_data, ensure_ascii=False).encode("utf-8"),
+                        on_usage=lambda usage: quota_manager.record_tokens(user_id, key_id, usage),
+                        model=request_data.get("model"), max_tokens=request_data.get("max_tokens"),
+                        cost=routing.request_cost(request_data),
+                    )
+                finally:
+                    self._active -= 1
+                    BATCH_ACTIVE.dec()
+                return {"status_code": response.status_code, "body": json.loads(response.body)}
+            except HTTPException as e:
+                if e.status_code not in RETRYABLE_STATUSES or attempt == BATCH_MAX_RETRIES:
+                    return {"error": {"status_code": e.status_code, "detail": e.detail}}
+                metrics.UPSTREAM_ERRORS.inc(METRICS_ROUTE, str(e.status_code))
+                await asyncio.sleep(2 ** attempt)
+            except ValueError as e:
+                return {"error": {"status_code": status.HTTP_502_BAD_GATEWAY,
+                                  "detail": f"Ошибка DeepSeek API: некорректный ответ ({e})"}}
+
+    async def _process(self, job_id: str, user_id: str, key_id: str):
+        loop = asyncio.get_running_loop()
+        concurrency = self.concurrency
+        if concurrency <= 0:
+            # Обработку приостановили между захватом и запуском: задание остается в очереди
+            await loop.run_in_executor(None, self._release, job_id)
+            return
+        if not await loop.run_in_executor(None, self._key_active, key_id):
+            await loop.run_in_executor(None, self._finish, job_id, "failed", None, None,
+                                       "API ключ задания отозван или истек")
+            return
+
+        items = await loop.run_in_executor(None, _read_input, job_id)
+        # Выходной файл и есть контрольная точка: строки с записанным результатом пропускаются
+        done, failed = await loop.run_in_executor(None, _done_lines, output_path(job_id))
+        pending = [(index, item) for index, item in enumerate(items) if index not in done]
+        counts = {"completed": len(done) - failed, "failed": failed}
+
+        output = open(output_path(job_id), "a", encoding="utf-8")
+        queue: asyncio.Queue = asyncio.Queue()
+        for entry in pending:
+            queue.put_nowait(entry)
+        state = {"active": True}
+
+        async def worker():
+            while state["active"]:
+                try:
+                    index, item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                result = await self._call(user_id, key_id, item)
+                if not state["active"]:
+                    return  # задание отменено или передано другому воркеру: результат не пишется
+                failed = _is_failed(result)
+                counts["failed" if failed else "completed"] += 1
+                BATCH_ITEMS.inc("failed" if failed else "completed")
+                line = {"line": index, "custom_id": item["custom_id"], **result}
+                output.write(json.dumps(line, ensure_ascii=False) + "\n")
+                output.flush()
+
+        workers = asyncio.gather(*(worker() for _ in range(concurrency)))
+
+        async def heartbeat():
+            # Аренда продлевается независимо от хода строк: ожидание квоты, уступка
+            # интерактивному трафику и долгая генерация не отдают задание другому воркеру
+            interval = max(0.05, min(BATCH_CHECKPOINT_INTERVAL, self.lease / 3))
+            while True:
+                await asyncio.sleep(interval)
+                if not await loop.run_in_executor(None, self._checkpoint, job_id,
+                                                  counts["completed"], counts["failed"]):
+                    state["active"] = False
+                    workers.cancel()
+                    return
+
+        renewer = loop.create_task(heartbeat())
+        try:
+            await workers
+        except asyncio.CancelledError:
+            if state["active"]:
+                raise
+        finally:
+            renewer.cancel()
+            output.close()
+        if state["active"]:
+            await loop.run_in_executor(None, self._finish, job_id, "completed",
+                                       counts["completed"], counts["failed"])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = None
+            try:
+                if self.concurrency <= 0:
+                    # BATCH_CONCURRENCY=0 приостанавливает обработку до перезагрузки настроек
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                job = await loop.run_in_executor(None, self._claim)
+                if job is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self._process(*job)
+            except asyncio.CancelledError:
+                if job is not None:
+                    self._release(job[0])
+                raise
+            except Exception:
+                logger.exception("Ошибка обработки пакетного задания")
+                if job is not None:
+                    self._finish(job[0], "failed", error="Внутренняя ошибка обработки задания")
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        # Задача запускается и при нулевом параллелизме: его можно поднять перезагрузкой настроек
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Прервать обработку; незавершенное задание возвращается в очередь"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+batch_runner = BatchRunner(BATCH_CONCURRENCY, BATCH_YIELD_THRESHOLD, BATCH_POLL_INTERVAL, BATCH_LEASE)
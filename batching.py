@@ -0,0 +1,177 @@
+"""
+WindexRouter - Микробатчинг запросов эмбеддингов
+Мелкие запросы к одной модели собираются в один вызов upstream и разбиваются обратно
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+
+import metrics
+import proxy
+import routing
+from context_window import context_limits
+from proxy import ProxyRoute
+
+# Окно сбора пачки (мс) и максимум входов в одном вызове upstream; окно 0 отключает батчинг
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", "64"))
+
+_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+BATCH_INPUTS = metrics.Histogram(
+    "windex_embedding_batch_inputs", "Число входов в одном вызове upstream эмбеддингов",
+    ("model",), buckets=_SIZE_BUCKETS,
+)
+BATCH_REQUESTS = metrics.Histogram(
+    "windex_embedding_batch_requests", "Число клиентских запросов в одной пачке эмбеддингов",
+    ("model",), buckets=_SIZE_BUCKETS,
+)
+
+
+class _Batch:
+    """Открытая пачка: общие параметры запроса и ожидающие клиенты"""
+    __slots__ = ("params", "items", "size", "timer")
+
+    def __init__(self, params: Dict[str, Any]):
+        self.params = params
+        self.items: List[Tuple[List[str], asyncio.Future]] = []
+        self.size = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+def _split_usage(total: int, weights: List[int]) -> List[int]:
+    """Распределить токены пачки между клиентами пропорционально длине их входов"""
+    weight_sum = sum(weights) or 1
+    shares = [total * weight // weight_sum for weight in weights]
+    shares[-1] += total - sum(shares)
+    return shares
+
+
+class EmbeddingBatcher:
+    """Собирает запросы с одинаковыми параметрами (модель и пр.) в пачки"""
+
+    def __init__(self, route: ProxyRoute, window_ms: float, max_inputs: int):
+        self.route = route
+        self.window = window_ms / 1000.0
+        self.max_inputs = max_inputs
+        self._batches: Dict[str, _Batch] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_inputs > 1
+
+    def accepts(self, request_data: Dict[str, Any]) -> bool:
+        """Батчить можно строку или список строк, не превышающий размер пачки"""
+        if not self.enabled:
+            return False
+        value = request_data.get("input")
+        if isinstance(value, str):
+            return True
+        return (
+            isinstance(value, list)
+            and 0 < len(value) < self.max_inputs
+            and all(isinstance(item, str) for item in value)
+        )
+
+    async def submit(self, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Поставить запрос в пачку и дождаться своей части ответа"""
+        value = request_data["input"]
+        inputs = [value] if isinstance(value, str) else value
+        params = {name: field for name, field in request_data.items() if name != "input"}
+        batch_key = json.dumps(params, sort_keys=True)
+
+        batch = self._batches.get(batch_key)
+        if batch is not None and batch.size + len(inputs) > self.max_inputs:
+            self._flush(batch_key)
+            batch = None
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = self._batches[batch_key] = _Batch(params)
+            batch.timer = loop.call_later(self.window, self._flush, batch_key)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.items.append((inputs, future))
+        batch.size += len(inputs)
+        if batch.size >= self.max_inputs:
+            self._flush(batch_key)
+
+        return await future
+
+    def _flush(self, batch_key: str):
+        batch = self._batches.pop(batch_key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _Batch):
+        # Модель приходит от клиента: в метку попадают только известные модели, иначе число рядов не ограничено
+        model = batch.params.get("model")
+        model = model if context_limits.is_known(model) else "other"
+        BATCH_INPUTS.observe(batch.size, model)
+        BATCH_REQUESTS.observe(len(batch.items), model)
+
+        all_inputs = [text for inputs, _ in batch.items for text in inputs]
+        payload = dict(batch.params, input=all_inputs)
+        try:
+            response = await proxy.forward(self.route, json.dumps(payload).encode("utf-8"),
+                                           model=batch.params.get("model"),
+                                           cost=routing.request_cost(payload))
+            result = json.loads(response.body)
+            data = sorted(result["data"], key=lambda item: item["index"])
+            if len(data) != len(all_inputs):
+                raise HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail="Ошибка DeepSeek API: число эмбеддингов не совпадает с числом входов"
+                )
+            # Ответы всех клиентов собираются до раздачи: ошибка в любом поле ответа upstream
+            # завершает ожидание каждого клиента пачки, а не оставляет их висеть
+            usage = result.get("usage") or {}
+            prompt_shares = _split_usage(int(usage.get("prompt_tokens") or 0),
+                                         [sum(len(text) for text in inputs) for inputs, _ in batch.items])
+            parts = []
+            offset = 0
+            for (inputs, _), prompt_tokens in zip(batch.items, prompt_shares):
+                parts.append({
+                    "object": result.get("object", "list"),
+                    "data": [dict(item, index=index) for index, item in enumerate(data[offset:offset + len(inputs)])],
+                    "model": result.get("model", batch.params.get("model")),
+                    "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+                })
+                offset += len(inputs)
+        except asyncio.CancelledError:
+            for _, future in batch.items:
+                future.cancel()
+            raise
+        except Exception as e:
+            if not isinstance(e, HTTPException):
+                e = HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail=f"Ошибка DeepSeek API: некорректный ответ ({e})"
+                )
+            for _, future in batch.items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), part in zip(batch.items, parts):
+            if not future.done():
+                future.set_result(part)
+
+    async def drain(self):
+        """Отправить открытые пачки и дождаться ответов upstream"""
+        for batch_key in list(self._batches):
+            self._flush(batch_key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+embedding_batcher = EmbeddingBatcher(proxy.EMBEDDINGS_ROUTE, EMBED_BATCH_WINDOW_MS, EMBED_BATCH_MAX_INPUTS)
@@ -0,0 +1,199 @@
+"""
+WindexRouter - Сжатие ответов
+ASGI middleware: выбор gzip/br/zstd по Accept-Encoding, потоковое сжатие SSE с flush
+"""
+
+import asyncio
+import os
+import zlib
+from typing import Callable, Dict, List, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard необязателен
+    zstandard = None
+
+# Ответы меньше порога не сжимаются
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Тела больше порога сжимаются в пуле потоков, чтобы не блокировать event loop
+COMPRESSION_THREAD_THRESHOLD = int(os.getenv("COMPRESSION_THREAD_THRESHOLD", str(256 * 1024)))
+COMPRESSION_LEVEL_GZIP = int(os.getenv("COMPRESSION_LEVEL_GZIP", "6"))
+COMPRESSION_LEVEL_BROTLI = int(os.getenv("COMPRESSION_LEVEL_BROTLI", "4"))
+COMPRESSION_LEVEL_ZSTD = int(os.getenv("COMPRESSION_LEVEL_ZSTD", "3"))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson", "application/jsonl")
+
+
+class _GzipStream:
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_LEVEL_BROTLI)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdStream:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL_ZSTD).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+# Поддерживаемые кодировки в порядке предпочтения сервера
+ENCODERS: Dict[str, Callable] = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = _ZstdStream
+if brotli is not None:
+    ENCODERS["br"] = _BrotliStream
+ENCODERS["gzip"] = _GzipStream
+
+
+def _compress_whole(encoding: str, body: bytes) -> bytes:
+    if encoding == "gzip":
+        return zlib.compress(body, COMPRESSION_LEVEL_GZIP, wbits=16 + zlib.MAX_WBITS)
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_LEVEL_BROTLI)
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL_ZSTD).compress(body)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Лучшая поддерживаемая кодировка из заголовка Accept-Encoding (с учетом q)"""
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+
+    best = None
+    best_q = 0.0
+    for encoding in ENCODERS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _header(headers: List, name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """Сжимает ответы по Accept-Encoding; уже сжатые ответы upstream не трогает"""
+
+    def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept = ""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept) if accept else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        stream = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, stream
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = list(start_message.get("headers", []))
+                content_type = (_header(headers, b"content-type") or b"").decode("latin-1")
+                compressible = (
+                    _header(headers, b"content-encoding") is None
+                    and content_type.startswith(COMPRESSIBLE_TYPES)
+                    and (more_body or len(body) >= self.min_size)
+                )
+                if not compressible:
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    return
+
+                headers = [(k, v) for k, v in headers if k.lower() != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode("latin-1")))
+                headers.append((b"vary", b"Accept-Encoding"))
+                start = dict(start_message, headers=headers)
+                start_message = None
+
+                if not more_body:
+                    # Ответ целиком: большие тела сжимаются вне event loop
+                    if len(body) >= COMPRESSION_THREAD_THRESHOLD:
+                        loop = asyncio.get_running_loop()
+                        compressed = await loop.run_in_executor(None, _compress_whole, encoding, body)
+                    else:
+                        compressed = _compress_whole(encoding, body)
+                    headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+
+                # Потоковый ответ (SSE): каждый чанк сжимается и сразу сбрасывается клиенту
+                stream = ENCODERS[encoding]()
+                await send(start)
+
+            if stream is None:
+                await send(message)
+                return
+
+            chunk = stream.compress(body) if body else b""
+            if not more_body:
+                chunk += stream.finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
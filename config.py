@@ -0,0 +1,304 @@
+"""
+WindexRouter - Перезагружаемая конфигурация
+Настройки из переменных окружения перекрываются файлом CONFIG_FILE; файл перечитывается
+по SIGHUP или при изменении, новые значения применяются разом, без перезапуска воркера
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import batch_jobs
+import compression
+import limits
+import loop_monitor
+import routing
+import timeouts
+import ws_chat
+from batching import embedding_batcher
+from context_window import context_limits, parse_context_limits
+from idempotency import idempotency_store
+from key_store import key_cache
+from quotas import quota_manager
+from shadow import shadow_mirror
+
+logger = logging.getLogger("windexrouter.config")
+
+# JSON-файл {"ИМЯ_ПЕРЕМЕННОЙ": значение}; его значения важнее переменных окружения
+CONFIG_FILE = os.getenv("CONFIG_FILE", "")
+# Как часто проверять изменение файла (сек, 0 — только по SIGHUP и через админ-эндпоинт)
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", "2.0"))
+
+
+def _bool(value: str) -> bool:
+    if value not in ("0", "1"):
+        raise ValueError("ожидается 0 или 1")
+    return value == "1"
+
+
+def _non_negative(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    def parse_checked(value: str):
+        result = parse(value)
+        if result < 0:
+            raise ValueError("значение не может быть отрицательным")
+        return result
+    return parse_checked
+
+
+def parse_list(value: str) -> List[str]:
+    """Список через запятую без пустых элементов"""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _backends(value: str) -> List[str]:
+    urls = routing.parse_backends(value)
+    if not urls:
+        raise ValueError("нужен хотя бы один backend")
+    return urls
+
+
+def _set_module(module) -> Callable[[str], Tuple[Callable, Callable]]:
+    """Настройка — глобальная переменная модуля, которая читается на каждом запросе"""
+    def accessor(name: str):
+        return (lambda: getattr(module, name)), (lambda value: setattr(module, name, value))
+    return accessor
+
+
+def _set_attr(obj, attr: str) -> Tuple[Callable, Callable]:
+    """Настройка — атрибут живого объекта (пула, лимитера, кэша)"""
+    return (lambda: getattr(obj, attr)), (lambda value: setattr(obj, attr, value))
+
+
+def _set_quota_default(period: str, index: int) -> Tuple[Callable, Callable]:
+    def get():
+        return quota_manager.user_defaults.get(period, (0, 0))[index]
+
+    def set_(value: int):
+        limit = list(quota_manager.user_defaults.get(period, (0, 0)))
+        limit[index] = value
+        defaults = dict(quota_manager.user_defaults, **{period: tuple(limit)})
+        quota_manager.user_defaults = {p: l for p, l in defaults.items() if any(l)}
+    return get, set_
+
+
+_routing = _set_module(routing)
+_timeouts = _set_module(timeouts)
+_batch = _set_module(batch_jobs)
+_ws = _set_module(ws_chat)
+_compression = _set_module(compression)
+_int = _non_negative(int)
+_float = _non_negative(float)
+
+# Настройки, которые применяются без перезапуска: имя -> (разбор строки, чтение, запись).
+# Запросы в обработке держат ссылки на прежние объекты (backend, лимиты таймаутов)
+# и завершаются с ними; новые значения видят только следующие запросы.
+RELOADABLE: Dict[str, Tuple[Callable[[str], Any], Callable[[], Any], Callable[[Any], None]]] = {
+    "DEEPSEEK_BACKENDS": (_backends, lambda: list(routing.backend_pool.backends),
+                          routing.backend_pool.set_backends),
+    "STICKY_ROUTING": (_bool, *_routing("STICKY_ROUTING")),
+    "STICKY_PREFIX_TURNS": (_int, *_routing("STICKY_PREFIX_TURNS")),
+    "STICKY_LOAD_FACTOR": (_float, *_set_attr(routing.backend_pool, "load_factor")),
+    "TOKEN_AWARE_ROUTING": (_bool, *_routing("TOKEN_AWARE_ROUTING")),
+    "ROUTING_COMPLETION_TOKENS": (_int, *_routing("ROUTING_COMPLETION_TOKENS")),
+    "RATE_LIMIT_RPS": (_float, *_set_attr(limits.rate_limiter, "rate")),
+    "RATE_LIMIT_BURST": (_float, *_set_attr(limits.rate_limiter, "burst")),
+    "RATE_LIMIT_MAX_KEYS": (_int, *_set_attr(limits.rate_limiter, "max_keys")),
+    "API_KEY_CACHE_TTL": (_float, *_set_attr(key_cache, "ttl")),
+    "API_KEY_CACHE_NEGATIVE_TTL": (_float, *_set_attr(key_cache, "negative_ttl")),
+    "API_KEY_CACHE_MAX_SIZE": (_int, lambda: key_cache.max_size, key_cache.resize),
+    "EMBED_BATCH_WINDOW_MS": (_float, lambda: embedding_batcher.window * 1000.0,
+                              lambda value: setattr(embedding_batcher, "window", value / 1000.0)),
+    "EMBED_BATCH_MAX_INPUTS": (_int, *_set_attr(embedding_batcher, "max_inputs")),
+    "COMPRESSION_THREAD_THRESHOLD": (_int, *_compression("COMPRESSION_THREAD_THRESHOLD")),
+    "COMPRESSION_LEVEL_GZIP": (_int, *_compression("COMPRESSION_LEVEL_GZIP")),
+    "COMPRESSION_LEVEL_BROTLI": (_int, *_compression("COMPRESSION_LEVEL_BROTLI")),
+    "COMPRESSION_LEVEL_ZSTD": (_int, *_compression("COMPRESSION_LEVEL_ZSTD")),
+    "ADAPTIVE_TIMEOUTS": (_bool, *_set_attr(timeouts.adaptive_timeouts, "enabled")),
+    "TIMEOUT_PERCENTILE": (_float, *_set_attr(timeouts.adaptive_timeouts, "percentile")),
+    "TIMEOUT_MULTIPLIER": (_float, *_set_attr(timeouts.adaptive_timeouts, "multiplier")),
+    "TIMEOUT_MIN_SAMPLES": (_int, *_set_attr(timeouts.adaptive_timeouts, "min_samples")),
+    "TIMEOUT_CONNECT_DEFAULT": (_float, *_timeouts("TIMEOUT_CONNECT_DEFAULT")),
+    "TIMEOUT_CONNECT_MIN": (_float, *_timeouts("TIMEOUT_CONNECT_MIN")),
+    "TIMEOUT_FIRST_BYTE_MIN": (_float, *_timeouts("TIMEOUT_FIRST_BYTE_MIN")),
+    "TIMEOUT_IDLE_MIN": (_float, *_timeouts("TIMEOUT_IDLE_MIN")),
+    "TIMEOUT_MAX": (_float, *_timeouts("TIMEOUT_MAX")),
+    "TIMEOUT_DEFAULT_MAX_TOKENS": (_int, *_timeouts("TIMEOUT_DEFAULT_MAX_TOKENS")),
+    "QUOTA_USER_DAY_TOKENS": (_int, *_set_quota_default("day", 0)),
+    "QUOTA_USER_DAY_REQUESTS": (_int, *_set_quota_default("day", 1)),
+    "QUOTA_USER_MONTH_TOKENS": (_int, *_set_quota_default("month", 0)),
+    "QUOTA_USER_MONTH_REQUESTS": (_int, *_set_quota_default("month", 1)),
+    "MODEL_CONTEXT_LIMITS": (parse_context_limits, *_set_attr(context_limits, "configured")),
+    "CONTEXT_DEFAULT_LIMIT": (_int, *_set_attr(context_limits, "default")),
+    "CONTEXT_TOLERANCE": (_float, *_set_attr(context_limits, "tolerance")),
+    "CONTEXT_TRIM": (_bool, *_set_attr(context_limits, "trim")),
+    "SHADOW_BACKEND": (lambda value: value.rstrip("/"), *_set_attr(shadow_mirror, "backend")),
+    "SHADOW_SAMPLE_RATE": (_float, *_set_attr(shadow_mirror, "sample_rate")),
+    "SHADOW_MODEL": (str, *_set_attr(shadow_mirror, "model")),
+    "BATCH_CONCURRENCY": (_int, *_set_attr(batch_jobs.batch_runner, "concurrency")),
+    "BATCH_YIELD_THRESHOLD": (_int, *_set_attr(batch_jobs.batch_runner, "yield_threshold")),
+    "BATCH_MAX_LINES": (_int, *_batch("BATCH_MAX_LINES")),
+    "BATCH_MAX_BYTES": (_int, *_batch("BATCH_MAX_BYTES")),
+    "BATCH_MAX_RETRIES": (_int, *_batch("BATCH_MAX_RETRIES")),
+    "WS_MAX_TURNS_IN_FLIGHT": (_int, *_ws("WS_MAX_TURNS_IN_FLIGHT")),
+    "WS_REAUTH_INTERVAL": (_float, *_ws("WS_REAUTH_INTERVAL")),
+    "LOOP_BLOCK_THRESHOLD": (_float, *_set_attr(loop_monitor.loop_monitor, "block_threshold")),
+    "IDEMPOTENCY_TTL": (_int, *_set_attr(idempotency_store, "ttl")),
+    "IDEMPOTENCY_MAX_RESPONSE_BYTES": (_int, *_set_attr(idempotency_store, "max_response_bytes")),
+    "IDEMPOTENCY_MAX_STORED_BYTES": (_int, *_set_attr(idempotency_store, "max_stored_bytes")),
+}
+
+
+def _to_env_string(value: Any) -> str:
+    """Значение из JSON-файла в строку того же вида, что и в переменной окружения"""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, list):
+        return ",".join(str(item) for item in value)
+    if isinstance(value, dict):
+        return ",".join(f"{name}={limit}" for name, limit in value.items())
+    return str(value)
+
+
+def _read_file(path: str) -> Dict[str, str]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("файл конфигурации должен содержать JSON-объект")
+    return {name: _to_env_string(value) for name, value in data.items()}
+
+
+def _file_signature(path: str) -> Optional[Tuple[float, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _public(value: Any) -> Any:
+    return value if isinstance(value, (int, float, str, bool, list, dict)) or value is None else str(value)
+
+
+class RuntimeConfig:
+    """Текущая конфигурация воркера и ее перезагрузка"""
+
+    def __init__(self, path: str, watch_interval: float):
+        self.path = path
+        self.watch_interval = watch_interval
+        # Значения из окружения на старте: к ним возвращается настройка, удаленная из файла
+        self._baseline = {name: getter() for name, (_, getter, _) in RELOADABLE.items()}
+        self.version = 0
+        self.digest = ""
+        self.loaded_at: Optional[int] = None
+        self.last_error: Optional[str] = None
+        self.restart_required: List[str] = []
+        self._signature: Optional[Tuple[float, int]] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _parse(self, raw: Dict[str, str]) -> Dict[str, Any]:
+        values = dict(self._baseline)
+        errors = []
+        for name, text in raw.items():
+            if name not in RELOADABLE:
+                continue
+            try:
+                values[name] = RELOADABLE[name][0](text)
+            except (TypeError, ValueError) as e:
+                errors.append(f"{name}: {e}")
+        if errors:
+            raise ValueError("; ".join(errors))
+        return values
+
+    def _apply(self, values: Dict[str, Any]) -> List[str]:
+        """Применить разом, без await между присваиваниями: запрос видит либо старые, либо новые значения"""
+        changed = []
+        for name, value in values.items():
+            _, getter, setter = RELOADABLE[name]
+            if getter() != value:
+                setter(value)
+                changed.append(name)
+        return changed
+
+    def register(self, name: str, parse: Callable[[str], Any], getter: Callable[[], Any],
+                 setter: Callable[[Any], None]):
+        """Добавить перезагружаемую настройку, которой владеет другой модуль (например, main)"""
+        RELOADABLE[name] = (parse, getter, setter)
+        self._baseline[name] = getter()
+
+    async def reload(self, reason: str) -> bool:
+        """Перечитать файл и применить изменения. При ошибке остается прежняя конфигурация."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            signature = _file_signature(self.path) if self.path else None
+            # Ошибочный файл не перечитывается по кругу: следующая попытка — после его изменения
+            self._signature = signature
+            try:
+                raw = await loop.run_in_executor(None, _read_file, self.path) if signature else {}
+                values = self._parse(raw)
+            except (OSError, ValueError) as e:
+                self.last_error = str(e)
+                logger.error("Конфигурация не применена (%s): %s", reason, e)
+                return False
+
+            self.last_error = None
+            self.restart_required = sorted(name for name in raw if name not in RELOADABLE)
+            changed = self._apply(values)
+            digest = hashlib.sha256(
+                json.dumps({name: _public(value) for name, value in values.items()}, sort_keys=True).encode("utf-8")
+            ).hexdigest()[:16]
+            if digest != self.digest:
+                self.version += 1
+                self.digest = digest
+                self.loaded_at = int(time.time())
+            if changed:
+                logger.info("Конфигурация v%d (%s): изменены %s", self.version, reason, ", ".join(changed))
+            if self.restart_required:
+                logger.warning("Настройки применятся только после перезапуска: %s",
+                               ", ".join(self.restart_required))
+            return True
+
+    def snapshot(self) -> dict:
+        return {
+            "version": self.version,
+            "digest": self.digest,
+            "loaded_at": self.loaded_at,
+            "source": self.path or None,
+            "last_error": self.last_error,
+            "restart_required": self.restart_required,
+            "settings": {name: _public(getter()) for name, (_, getter, _) in RELOADABLE.items()},
+        }
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            if _file_signature(self.path) != self._signature:
+                await self.reload("файл изменен")
+
+    async def start(self):
+        await self.reload("старт")
+        loop = asyncio.get_running_loop()
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self.reload("SIGHUP")))
+        if self.path and self.watch_interval > 0:
+            self._task = loop.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+runtime_config = RuntimeConfig(CONFIG_FILE, CONFIG_WATCH_INTERVAL)
@@ -0,0 +1,179 @@
+"""
+WindexRouter - Проверка длины контекста
+Промпт плюс max_tokens сверяется с окном контекста модели до обращения к upstream;
+по желанию старые реплики диалога отбрасываются, чтобы запрос поместился
+"""
+
+import asyncio
+import logging
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+from fastapi import HTTPException, status
+
+import metrics
+import proxy
+from proxy import CHAT_ROUTE, MODELS_ROUTE
+from routing import backend_pool
+from token_count import largest_prompt_tokens, message_tokens, messages_tokens
+
+logger = logging.getLogger("windexrouter.context")
+
+
+def parse_context_limits(value: str) -> Dict[str, int]:
+    return {
+        name.strip(): int(limit)
+        for name, _, limit in (item.partition("=") for item in value.split(",") if "=" in item)
+    }
+
+
+# Окна контекста моделей: "модель=токены" через запятую; важнее данных эндпоинта моделей
+MODEL_CONTEXT_LIMITS = parse_context_limits(os.getenv("MODEL_CONTEXT_LIMITS", ""))
+# Окно для моделей, о которых ничего не известно (0 = такие запросы не проверяются)
+CONTEXT_DEFAULT_LIMIT = int(os.getenv("CONTEXT_DEFAULT_LIMIT", "0"))
+# Как часто перечитывать окна из эндпоинта моделей upstream (сек, 0 = только конфигурация)
+CONTEXT_LIMITS_REFRESH = float(os.getenv("CONTEXT_LIMITS_REFRESH", "300"))
+# Допуск на погрешность локальной оценки: запрос отклоняется, только если оценка
+# превышает окно больше чем на эту долю
+CONTEXT_TOLERANCE = float(os.getenv("CONTEXT_TOLERANCE", "0.05"))
+# 1 — вместо отказа отбрасывать самые старые реплики (системные сообщения и последняя остаются)
+CONTEXT_TRIM = os.getenv("CONTEXT_TRIM", "0") == "1"
+
+# Поля описания модели, в которых разные серверы сообщают окно контекста
+_LIMIT_FIELDS = ("context_length", "context_window", "max_context_length", "max_model_len")
+
+CONTEXT_CHECKS = metrics.Counter(
+    "windex_context_checks_total", "Запросы, не поместившиеся в окно контекста модели", ("result",)
+)
+
+
+def _completion_tokens(request_data: Dict[str, Any]) -> int:
+    max_tokens = request_data.get("max_tokens")
+    return max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else 0
+
+
+class ContextLimits:
+    """Окна контекста моделей: конфигурация и эндпоинт моделей upstream"""
+
+    def __init__(self, configured: Dict[str, int], default: int, refresh_interval: float,
+                 tolerance: float, trim: bool):
+        self.configured = configured
+        self.default = default
+        self.refresh_interval = refresh_interval
+        self.tolerance = tolerance
+        self.trim = trim
+        self._discovered: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def limit_for(self, model: Any) -> int:
+        """Окно контекста модели в токенах (0 = неизвестно)"""
+        if not isinstance(model, str):
+            return self.default
+        return self.configured.get(model) or self._discovered.get(model) or self.default
+
+    def is_known(self, model: Any) -> bool:
+        """Модель из конфигурации или эндпоинта моделей upstream (а не произвольная строка клиента)"""
+        return isinstance(model, str) and (model in self.configured or model in self._discovered)
+
+    async def refresh(self):
+        """Перечитать окна из эндпоинта моделей upstream"""
+        backend = backend_pool.least_loaded()
+        response = await proxy.get_client().get(backend.url + MODELS_ROUTE.upstream_path,
+                                                timeout=MODELS_ROUTE.timeout)
+        response.raise_for_status()
+        payload = response.json()
+        models = payload.get("data") if isinstance(payload, dict) else None
+        if not isinstance(models, list):
+            raise ValueError("эндпоинт моделей вернул не список моделей")
+        discovered = {}
+        for model in models:
+            if not isinstance(model, dict) or not isinstance(model.get("id"), str):
+                continue
+            for field in _LIMIT_FIELDS:
+                if isinstance(model.get(field), int) and model[field] > 0:
+                    discovered[model["id"]] = model[field]
+                    break
+        self._discovered = discovered
+
+    def fit(self, route: proxy.ProxyRoute, request_data: Dict[str, Any]) -> int:
+        """Проверить, что запрос помещается в окно модели. Может укоротить messages
+        на месте (CONTEXT_TRIM); возвращает число отброшенных сообщений.
+        Не помещается — HTTPException 400 без обращения к upstream."""
+        limit = self.limit_for(request_data.get("model"))
+        if limit <= 0:
+            return 0
+        allowed = int(limit * (1 + self.tolerance))
+        completion = _completion_tokens(request_data)
+        prompt = largest_prompt_tokens(request_data)
+        if prompt + completion <= allowed:
+            return 0
+
+        trimmed = 0
+        if self.trim and route is CHAT_ROUTE and completion < allowed:
+            trimmed = self._trim(request_data, allowed - completion)
+            if trimmed:
+                prompt = messages_tokens(request_data["messages"])
+                if prompt + completion <= allowed:
+                    CONTEXT_CHECKS.inc("trimmed")
+                    return trimmed
+
+        CONTEXT_CHECKS.inc("rejected")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=(f"Запрос не помещается в окно контекста модели: {limit} токенов, "
+                    f"запрошено около {prompt + completion} (промпт ~{prompt}, max_tokens {completion}). "
+                    "Сократите сообщения или max_tokens")
+        )
+
+    @staticmethod
+    def _trim(request_data: Dict[str, Any], budget: int) -> int:
+        """Отбросить самые старые реплики, пока промпт не уложится в budget токенов.
+        Системные сообщения и порядок оставшихся сообщений не меняются"""
+        messages = request_data["messages"]
+        if not isinstance(messages, list):
+            return 0
+        turns = [index for index, m in enumerate(messages)
+                 if not (isinstance(m, dict) and m.get("role") == "system")]
+        total = messages_tokens(messages)
+        dropped = 0
+        while len(turns) - dropped > 1 and total > budget:
+            total -= message_tokens(messages[turns[dropped]])
+            dropped += 1
+            # Ответы инструментов без вызвавшей их реплики ассистента upstream не примет
+            while (len(turns) - dropped > 1 and isinstance(messages[turns[dropped]], dict)
+                   and messages[turns[dropped]].get("role") == "tool"):
+                total -= message_tokens(messages[turns[dropped]])
+                dropped += 1
+        if dropped:
+            removed = set(turns[:dropped])
+            request_data["messages"] = [m for index, m in enumerate(messages) if index not in removed]
+        return dropped
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning("Не удалось получить окна контекста моделей: %s", e)
+            except Exception:
+                # Задача обновления не должна умирать: иначе окна больше не перечитываются
+                logger.exception("Ошибка обновления окон контекста моделей")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._task is None and self.refresh_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+context_limits = ContextLimits(MODEL_CONTEXT_LIMITS, CONTEXT_DEFAULT_LIMIT, CONTEXT_LIMITS_REFRESH,
+                               CONTEXT_TOLERANCE, CONTEXT_TRIM)
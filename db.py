@@ -0,0 +1,460 @@
+"""
+WindexRouter - Работа с базой данных SQLite
+Подключение, версионированные миграции схемы и хелперы для времени
+"""
+
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+# Путь к файлу базы данных
+DB_PATH = os.getenv("WINDEX_DB_PATH", "api_keys.db")
+
+
+def connect() -> sqlite3.Connection:
+    """Открыть соединение с базой данных"""
+    return sqlite3.connect(DB_PATH)
+
+
+# Время хранится в БД как целые секунды Unix epoch
+def now_ts() -> int:
+    """Текущее время в секундах epoch"""
+    return int(time.time())
+
+
+def ts_to_iso(ts: Optional[int]) -> Optional[str]:
+    """Преобразование epoch в ISO-строку для ответов API"""
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts).isoformat()
+
+
+def _iso_to_epoch(value):
+    """Конвертация старых ISO-строк (локальное время) в epoch"""
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return int(float(value))
+
+
+# Миграция 1: исходная схема (совпадает с первой версией init_db)
+def _migration_1_base_schema(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            is_active INTEGER DEFAULT 1
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tokens (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            token TEXT UNIQUE NOT NULL,
+            expires_at TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            key TEXT UNIQUE NOT NULL,
+            created_at TEXT NOT NULL,
+            expires_at TEXT,
+            is_active INTEGER DEFAULT 1,
+            user_id TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_usage_log (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            api_key_id TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+# Миграция 2: время в epoch, INTEGER rowid для лога, вторичные индексы
+def _migration_2_epoch_and_indexes(conn: sqlite3.Connection):
+    conn.create_function("iso_to_epoch", 1, _iso_to_epoch, deterministic=True)
+
+    conn.execute('''
+        CREATE TABLE users_new (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            is_active INTEGER DEFAULT 1
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO users_new (id, username, email, password_hash, created_at, is_active)
+        SELECT id, username, email, password_hash, iso_to_epoch(created_at), is_active FROM users
+    ''')
+
+    conn.execute('''
+        CREATE TABLE tokens_new (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            token TEXT UNIQUE NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO tokens_new (id, user_id, token, expires_at, created_at)
+        SELECT id, user_id, token, iso_to_epoch(expires_at), iso_to_epoch(created_at) FROM tokens
+    ''')
+
+    conn.execute('''
+        CREATE TABLE api_keys_new (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            key TEXT UNIQUE NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER,
+            is_active INTEGER DEFAULT 1,
+            user_id TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO api_keys_new (id, name, key, created_at, expires_at, is_active, user_id)
+        SELECT id, name, key, iso_to_epoch(created_at), iso_to_epoch(expires_at), is_active, user_id
+        FROM api_keys
+    ''')
+
+    # UUID-идентификаторы лога заменяются на INTEGER rowid
+    conn.execute('''
+        CREATE TABLE api_usage_log_new (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            api_key_id TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO api_usage_log_new (user_id, api_key_id, endpoint, timestamp)
+        SELECT user_id, api_key_id, endpoint, iso_to_epoch(timestamp)
+        FROM api_usage_log ORDER BY timestamp
+    ''')
+
+    for table in ("users", "tokens", "api_keys", "api_usage_log"):
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    conn.execute("CREATE INDEX idx_tokens_user ON tokens (user_id)")
+    conn.execute("CREATE INDEX idx_api_keys_user_created ON api_keys (user_id, created_at)")
+    conn.execute("CREATE INDEX idx_usage_key_ts ON api_usage_log (api_key_id, timestamp)")
+    conn.execute("CREATE INDEX idx_usage_user_ts ON api_usage_log (user_id, timestamp)")
+
+
+# Миграция 3: хранение API ключей в виде префикса и HMAC вместо открытого текста
+def _migration_3_hashed_api_keys(conn: sqlite3.Connection):
+    import key_store
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS app_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    pepper = os.getenv("API_KEY_PEPPER")
+    if not pepper:
+        row = conn.execute('SELECT value FROM app_settings WHERE key = ?', (key_store.PEPPER_SETTING,)).fetchone()
+        pepper = row[0] if row else key_store.generate_pepper()
+        conn.execute('INSERT OR IGNORE INTO app_settings (key, value) VALUES (?, ?)',
+                     (key_store.PEPPER_SETTING, pepper))
+    pepper_bytes = pepper.encode('utf-8')
+
+    conn.execute('''
+        CREATE TABLE api_keys_new (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            key_prefix TEXT NOT NULL,
+            key_hash TEXT UNIQUE NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER,
+            is_active INTEGER DEFAULT 1,
+            user_id TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    rows = conn.execute('SELECT id, name, key, created_at, expires_at, is_active, user_id FROM api_keys').fetchall()
+    conn.executemany('''
+        INSERT INTO api_keys_new (id, name, key_prefix, key_hash, created_at, expires_at, is_active, user_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (key_id, name, key_store.key_prefix(key), key_store.hash_api_key(key, pepper_bytes),
+         created_at, expires_at, is_active, user_id)
+        for key_id, name, key, created_at, expires_at, is_active, user_id in rows
+    ])
+    conn.execute("DROP TABLE api_keys")
+    conn.execute("ALTER TABLE api_keys_new RENAME TO api_keys")
+    conn.execute("CREATE INDEX idx_api_keys_user_created ON api_keys (user_id, created_at)")
+
+
+# Миграция 4: индекс для keyset-пагинации списка ключей по (created_at, id)
+def _migration_4_api_keys_keyset_index(conn: sqlite3.Connection):
+    conn.execute("DROP INDEX IF EXISTS idx_api_keys_user_created")
+    conn.execute("CREATE INDEX idx_api_keys_user_created_id ON api_keys (user_id, created_at, id)")
+
+
+# Миграция 5: квоты и суммы использования по окнам (день/месяц) для их проверки
+def _migration_5_quotas(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE quotas (
+            scope TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            max_tokens INTEGER NOT NULL DEFAULT 0,
+            max_requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, subject_id, period)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE usage_rollups (
+            scope TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            window_start INTEGER NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, subject_id, period, window_start)
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_usage_rollups_window ON usage_rollups (period, window_start)")
+
+
+# Миграция 6: секрет и список отзыва подписанных токенов сессий.
+# Деактивация пользователя любым способом (в т.ч. прямым UPDATE) отзывает его токены триггером.
+def _migration_6_session_revocations(conn: sqlite3.Connection):
+    import sessions
+
+    conn.execute('INSERT OR IGNORE INTO app_settings (key, value) VALUES (?, ?)',
+                 (sessions.SECRET_SETTING, sessions.generate_secret()))
+    conn.execute('''
+        CREATE TABLE session_revocations (
+            user_id TEXT PRIMARY KEY,
+            revoked_before INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_session_revocations_revoked ON session_revocations (revoked_before)")
+    conn.execute('''
+        CREATE TRIGGER trg_users_deactivate_sessions AFTER UPDATE OF is_active ON users
+        WHEN NEW.is_active = 0 AND OLD.is_active != 0
+        BEGIN
+            INSERT INTO session_revocations (user_id, revoked_before, expires_at)
+            VALUES (
+                NEW.id,
+                CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER),
+                CAST(strftime('%s', 'now') AS INTEGER) + 86400
+            )
+            ON CONFLICT (user_id) DO UPDATE SET
+                revoked_before = excluded.revoked_before, expires_at = excluded.expires_at;
+        END
+    ''')
+
+
+# Миграция 7: пакетные задания (входной и выходной JSONL лежат на диске, в БД — состояние и аренда)
+def _migration_7_batch_jobs(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE batch_jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            api_key_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            started_at INTEGER,
+            finished_at INTEGER,
+            error TEXT,
+            lease_owner TEXT,
+            lease_expires_at INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_batch_jobs_user ON batch_jobs (user_id, created_at)")
+    conn.execute("CREATE INDEX idx_batch_jobs_status ON batch_jobs (status, created_at)")
+
+
+# Миграция 8: лог использования разбит на помесячные таблицы, api_usage_log становится представлением
+def _migration_8_usage_partitions(conn: sqlite3.Connection):
+    # id строк сохраняются: по ним названы файлы уже выгруженного архива.
+    # Они меньше начала диапазона любого месяца (см. USAGE_ID_MONTH_SPAN) и не пересекаются с новыми
+    months = [row[0] for row in conn.execute(
+        "SELECT DISTINCT strftime('%Y%m', timestamp, 'unixepoch') FROM api_usage_log"
+    )]
+    for month in months:
+        table = ensure_usage_partition(conn, month, rebuild_view=False)
+        conn.execute(f'''
+            INSERT INTO {table} (id, user_id, api_key_id, endpoint, timestamp)
+            SELECT id, user_id, api_key_id, endpoint, timestamp FROM api_usage_log
+            WHERE strftime('%Y%m', timestamp, 'unixepoch') = ?
+        ''', (month,))
+    conn.execute("DROP TABLE api_usage_log")
+    _rebuild_usage_view(conn)
+
+
+# Миграция 9: сохраненные ответы запросов с Idempotency-Key (область — API ключ)
+def _migration_9_idempotency_keys(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE idempotency_keys (
+            api_key_id TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (api_key_id, idempotency_key)
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_idempotency_keys_created ON idempotency_keys (created_at)")
+
+
+# Список миграций: (версия, описание, функция). Новые добавляются в конец.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "базовая схема", _migration_1_base_schema),
+    (2, "epoch-время, INTEGER id лога, индексы", _migration_2_epoch_and_indexes),
+    (3, "хешированные API ключи", _migration_3_hashed_api_keys),
+    (4, "индекс keyset-пагинации ключей", _migration_4_api_keys_keyset_index),
+    (5, "квоты и суммы использования", _migration_5_quotas),
+    (6, "список отзыва токенов сессий", _migration_6_session_revocations),
+    (7, "пакетные задания", _migration_7_batch_jobs),
+    (8, "помесячные партиции лога использования", _migration_8_usage_partitions),
+    (9, "ответы идемпотентных запросов", _migration_9_idempotency_keys),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы (PRAGMA user_version)"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(path: Optional[str] = None) -> int:
+    """Применить недостающие миграции. Каждая выполняется один раз в своей транзакции."""
+    conn = sqlite3.connect(path or DB_PATH, isolation_level=None)
+    try:
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            return SCHEMA_VERSION
+
+        for version, _description, migrate in MIGRATIONS:
+            # BEGIN IMMEDIATE берет блокировку записи: параллельные воркеры ждут,
+            # а затем видят уже обновленную версию и пропускают миграцию
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        # WAL позволяет читать параллельно с записью; режим сохраняется в файле БД
+        conn.execute("PRAGMA journal_mode=WAL")
+        return get_schema_version(conn)
+    finally:
+        conn.close()
+
+
+# Лог использования хранится помесячно (UTC) в таблицах api_usage_log_ГГГГММ.
+# Архивация и удаление старых данных — DROP TABLE целого месяца, а запрос за период
+# читает только таблицы нужных месяцев. api_usage_log — представление поверх всех партиций
+USAGE_PARTITION_PREFIX = "api_usage_log_"
+# Диапазон id одного месяца: id строки = ГГГГММ * USAGE_ID_MONTH_SPAN + номер в месяце
+USAGE_ID_MONTH_SPAN = 10 ** 12
+
+
+def usage_month(ts: int) -> str:
+    """Месяц партиции для времени epoch: 'ГГГГММ' (UTC)"""
+    return time.strftime("%Y%m", time.gmtime(ts))
+
+
+def usage_partition(month: str) -> str:
+    return USAGE_PARTITION_PREFIX + month
+
+
+def usage_partitions(conn: sqlite3.Connection, start_ts: Optional[int] = None,
+                     end_ts: Optional[int] = None) -> List[str]:
+    """Таблицы партиций, пересекающиеся с [start_ts, end_ts), по возрастанию месяца"""
+    names = sorted(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+        (USAGE_PARTITION_PREFIX + "[0-9][0-9][0-9][0-9][0-9][0-9]",)
+    ))
+    first = usage_month(start_ts) if start_ts is not None else None
+    # end_ts не включается: граница ровно на начале месяца этот месяц не захватывает
+    last = usage_month(end_ts - 1) if end_ts is not None else None
+    prefix = len(USAGE_PARTITION_PREFIX)
+    return [name for name in names
+            if (first is None or name[prefix:] >= first) and (last is None or name[prefix:] <= last)]
+
+
+def _rebuild_usage_view(conn: sqlite3.Connection):
+    """Пересоздать представление api_usage_log по текущему набору партиций"""
+    selects = [f"SELECT id, user_id, api_key_id, endpoint, timestamp FROM {table}"
+               for table in usage_partitions(conn)]
+    if not selects:
+        selects = ["SELECT 0 AS id, '' AS user_id, '' AS api_key_id, '' AS endpoint, 0 AS timestamp WHERE 0"]
+    conn.execute("DROP VIEW IF EXISTS api_usage_log")
+    conn.execute("CREATE VIEW api_usage_log AS " + " UNION ALL ".join(selects))
+
+
+def ensure_usage_partition(conn: sqlite3.Connection, month: str, rebuild_view: bool = True) -> str:
+    """Создать партицию месяца, если ее нет. Вызывается внутри транзакции записи."""
+    table = usage_partition(month)
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if exists:
+        return table
+    conn.execute(f'''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            api_key_id TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Нумерация месяца начинается с ГГГГММ * USAGE_ID_MONTH_SPAN: id уникальны и возрастают по всем партициям
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                 (table, int(month) * USAGE_ID_MONTH_SPAN))
+    conn.execute(f"CREATE INDEX idx_{table}_key_ts ON {table} (api_key_id, timestamp)")
+    conn.execute(f"CREATE INDEX idx_{table}_user_ts ON {table} (user_id, timestamp)")
+    if rebuild_view:
+        _rebuild_usage_view(conn)
+    return table
+
+
+def drop_usage_partition(conn: sqlite3.Connection, table: str):
+    """Удалить партицию целиком вместе со счетчиком AUTOINCREMENT. Вызывается внутри транзакции записи."""
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+    _rebuild_usage_view(conn)
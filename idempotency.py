@@ -0,0 +1,323 @@
+"""
+WindexRouter - Идемпотентные запросы (заголовок Idempotency-Key)
+Повтор запроса с тем же ключом в пределах API ключа не запускает генерацию заново:
+пока исходный запрос выполняется, повтор присоединяется к нему (включая поток),
+после завершения в течение IDEMPOTENCY_TTL отдается сохраненный ответ
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from fastapi.responses import Response, StreamingResponse
+
+import db
+import metrics
+
+logger = logging.getLogger("windexrouter.idempotency")
+
+# Сколько хранится ответ завершенного запроса (сек)
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# Ответ больше этого (байт) не сохраняется, а к его потоку нельзя присоединиться после переполнения
+IDEMPOTENCY_MAX_RESPONSE_BYTES = int(os.getenv("IDEMPOTENCY_MAX_RESPONSE_BYTES", str(1024 * 1024)))
+# Предел суммарного размера сохраненных ответов в БД (байт): сверх него удаляются самые старые
+IDEMPOTENCY_MAX_STORED_BYTES = int(os.getenv("IDEMPOTENCY_MAX_STORED_BYTES", str(256 * 1024 * 1024)))
+# Как часто удалять истекшие ответы (сек)
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "300"))
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+IDEMPOTENT_REQUESTS = metrics.Counter(
+    "windex_idempotent_requests_total", "Запросы с Idempotency-Key по исходу", ("result",)
+)
+
+# Заголовки, которые не сохраняются: длину тела Response считает сам
+_SKIPPED_HEADERS = ("content-length",)
+
+
+def fingerprint(route_name: str, body: Optional[bytes]) -> str:
+    """Отпечаток запроса: повтор с тем же ключом, но другим телом — ошибка клиента"""
+    digest = hashlib.sha256(route_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(body or b"")
+    return digest.hexdigest()
+
+
+def _stored_headers(response: Response) -> List[Tuple[str, str]]:
+    return [(name, value) for name, value in response.headers.items() if name not in _SKIPPED_HEADERS]
+
+
+def _replay(status_code: int, headers: str, body: bytes) -> Response:
+    """Сохраненный ответ; заголовок Idempotent-Replayed отличает его от нового выполнения"""
+    IDEMPOTENT_REQUESTS.inc("replayed")
+    response = Response(content=body, status_code=status_code, headers=dict(json.loads(headers)))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+class _InFlight:
+    """Выполняющийся запрос: его ответ читают исходный клиент и присоединившиеся повторы"""
+
+    __slots__ = ("fingerprint", "max_bytes", "ready", "error", "status_code", "headers",
+                 "body", "streaming", "chunks", "size", "subscribers", "task")
+
+    def __init__(self, fingerprint: str, max_bytes: int):
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.ready = asyncio.Event()  # известны статус и заголовки ответа (или ошибка)
+        self.error: Optional[BaseException] = None
+        self.status_code = 0
+        self.headers: List[Tuple[str, str]] = []
+        self.body: Optional[bytes] = None
+        self.streaming = False
+        # Полученные чанки потока для новых подписчиков; None — ответ превысил max_bytes
+        self.chunks: Optional[List[bytes]] = []
+        self.size = 0
+        self.subscribers: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> Optional[asyncio.Queue]:
+        """Очередь чанков с начала ответа (None, если начало уже не сохранено)"""
+        if self.chunks is None:
+            return None
+        queue = asyncio.Queue()
+        for chunk in self.chunks:
+            queue.put_nowait(chunk)
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+
+    def push(self, chunk: Optional[bytes]):
+        """Раздать чанк подписчикам; None — конец потока"""
+        if chunk is not None and self.chunks is not None:
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                self.chunks = None
+            else:
+                self.chunks.append(chunk)
+        for queue in self.subscribers:
+            queue.put_nowait(chunk)
+
+
+class IdempotencyStore:
+    """Присоединение повторов к выполняющимся запросам и хранение готовых ответов в БД"""
+
+    def __init__(self, ttl: int, max_response_bytes: int, max_stored_bytes: int, purge_interval: float):
+        self.ttl = ttl
+        self.max_response_bytes = max_response_bytes
+        self.max_stored_bytes = max_stored_bytes
+        self.purge_interval = purge_interval
+        self._in_flight: Dict[Tuple[str, str], _InFlight] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def validate_key(value: str) -> str:
+        if not value or len(value) > MAX_KEY_LENGTH:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Заголовок {IDEMPOTENCY_HEADER} должен быть непустым и не длиннее {MAX_KEY_LENGTH} символов"
+            )
+        return value
+
+    @staticmethod
+    def _mismatch() -> HTTPException:
+        IDEMPOTENT_REQUESTS.inc("mismatch")
+        return HTTPException(
+            status_code=422,
+            detail=f"{IDEMPOTENCY_HEADER} уже использован для другого запроса"
+        )
+
+    def _load(self, api_key_id: str, key: str) -> Optional[tuple]:
+        conn = db.connect()
+        try:
+            return conn.execute('''
+                SELECT fingerprint, status_code, headers, body FROM idempotency_keys
+                WHERE api_key_id = ? AND idempotency_key = ? AND created_at >= ?
+            ''', (api_key_id, key, db.now_ts() - self.ttl)).fetchone()
+        finally:
+            conn.close()
+
+    def _save(self, api_key_id: str, key: str, entry: _InFlight, body: bytes):
+        conn = db.connect()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO idempotency_keys
+                    (api_key_id, idempotency_key, fingerprint, status_code, headers, body, size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (api_key_id, key, entry.fingerprint, entry.status_code,
+                  json.dumps(entry.headers), body, len(body), db.now_ts()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def execute(self, api_key_id: str, key: str, request_fingerprint: str,
+                      call: Callable[[], Awaitable[Response]]) -> Response:
+        """Выполнить call один раз на (API ключ, Idempotency-Key) и вернуть его ответ.
+        Выполнение идет в фоновой задаче: обрыв соединения исходного клиента не прерывает
+        генерацию, и повтор получает ответ целиком."""
+        scope = (api_key_id, key)
+        loop = asyncio.get_running_loop()
+        entry = self._in_flight.get(scope)
+        if entry is None:
+            stored = await loop.run_in_executor(None, self._load, api_key_id, key)
+            # Пока читалась БД, тот же запрос мог начаться в этом процессе
+            entry = self._in_flight.get(scope)
+            if entry is None and stored is not None:
+                if stored[0] != request_fingerprint:
+                    raise self._mismatch()
+                return _replay(*stored[1:])
+
+        if entry is not None:
+            if entry.fingerprint != request_fingerprint:
+                raise self._mismatch()
+            queue = entry.subscribe()
+            if queue is None:
+                IDEMPOTENT_REQUESTS.inc("conflict")
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Запрос с этим {IDEMPOTENCY_HEADER} еще выполняется, "
+                           "а его ответ слишком велик для повторной выдачи",
+                    headers={"Retry-After": "1"},
+                )
+            IDEMPOTENT_REQUESTS.inc("attached")
+            return await self._respond(entry, queue)
+
+        entry = _InFlight(request_fingerprint, self.max_response_bytes)
+        self._in_flight[scope] = entry
+        # Подписка до запуска: исходный клиент получит поток с первого чанка при любом размере
+        queue = entry.subscribe()
+        entry.task = loop.create_task(self._run(scope, entry, call))
+        IDEMPOTENT_REQUESTS.inc("executed")
+        return await self._respond(entry, queue)
+
+    async def _run(self, scope: Tuple[str, str], entry: _InFlight, call: Callable[[], Awaitable[Response]]):
+        body = None
+        try:
+            try:
+                response = await call()
+            except Exception as e:
+                # Ошибки не сохраняются: повтор после них выполнится заново
+                entry.error = e
+                return
+            entry.status_code = response.status_code
+            entry.headers = _stored_headers(response)
+
+            if not isinstance(response, StreamingResponse):
+                body = entry.body = response.body
+                return
+
+            entry.streaming = True
+            entry.ready.set()
+            complete = False
+            try:
+                async for chunk in response.body_iterator:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    entry.push(chunk)
+                complete = True
+            except Exception:
+                logger.exception("Поток ответа на идемпотентный запрос оборван")
+            finally:
+                entry.push(None)
+                if response.background is not None:
+                    await response.background()
+            if complete and entry.chunks is not None:
+                body = b"".join(entry.chunks)
+        finally:
+            entry.ready.set()
+            try:
+                # Запись остается в памяти до сохранения: повтор не проскочит между ними
+                if body is not None and len(body) <= self.max_response_bytes:
+                    await asyncio.get_running_loop().run_in_executor(None, self._save, *scope, entry, body)
+            except Exception:
+                logger.exception("Не удалось сохранить ответ идемпотентного запроса")
+            finally:
+                del self._in_flight[scope]
+
+    async def _respond(self, entry: _InFlight, queue: asyncio.Queue) -> Response:
+        try:
+            await entry.ready.wait()
+        except BaseException:
+            entry.unsubscribe(queue)
+            raise
+        if entry.error is not None:
+            entry.unsubscribe(queue)
+            raise entry.error
+        if not entry.streaming:
+            entry.unsubscribe(queue)
+            return Response(content=entry.body, status_code=entry.status_code, headers=dict(entry.headers))
+        return StreamingResponse(self._drain(entry, queue), status_code=entry.status_code,
+                                 headers=dict(entry.headers))
+
+    @staticmethod
+    async def _drain(entry: _InFlight, queue: asyncio.Queue):
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Отключившийся клиент перестает получать чанки; генерация продолжается для остальных
+            entry.unsubscribe(queue)
+
+    def purge(self) -> int:
+        """Удалить истекшие ответы и самые старые сверх IDEMPOTENCY_MAX_STORED_BYTES"""
+        conn = db.connect()
+        try:
+            removed = conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?", (db.now_ts() - self.ttl,)
+            ).rowcount
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM idempotency_keys").fetchone()[0]
+            if total > self.max_stored_bytes:
+                # Граница по накопленному размеру от новых к старым: все, что за пределом, удаляется
+                removed += conn.execute('''
+                    DELETE FROM idempotency_keys WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, SUM(size) OVER (ORDER BY created_at DESC, rowid DESC) AS kept
+                            FROM idempotency_keys
+                        ) WHERE kept > ?
+                    )
+                ''', (self.max_stored_bytes,)).rowcount
+            conn.commit()
+            return removed
+        finally:
+            conn.close()
+
+    async def _run_purge(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                await loop.run_in_executor(None, self.purge)
+            except Exception:
+                logger.exception("Ошибка очистки сохраненных идемпотентных ответов")
+
+    def start(self):
+        if self._task is None and self.purge_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run_purge())
+
+    async def stop(self):
+        """Остановить очистку и дождаться выполняющихся запросов, в т.ч. брошенных клиентами"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        tasks = [entry.task for entry in self._in_flight.values() if entry.task is not None]
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_RESPONSE_BYTES,
+                                     IDEMPOTENCY_MAX_STORED_BYTES, IDEMPOTENCY_PURGE_INTERVAL)
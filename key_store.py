@@ -0,0 +1,130 @@
+"""
+WindexRouter - Хранение API ключей
+Ключи хранятся как публичный префикс + HMAC-SHA256, полный ключ виден только при создании
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import db
+
+# Длина публичного префикса: "wr_" + 8 hex-символов
+KEY_PREFIX_LENGTH = 11
+
+# Время жизни записей кэша ключей (сек). Ограничивает задержку,
+# с которой изменения ключей в других воркерах становятся видны.
+KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "30"))
+KEY_CACHE_NEGATIVE_TTL = float(os.getenv("API_KEY_CACHE_NEGATIVE_TTL", "5"))
+KEY_CACHE_MAX_SIZE = int(os.getenv("API_KEY_CACHE_MAX_SIZE", "10000"))
+
+PEPPER_SETTING = "api_key_pepper"
+
+_pepper: Optional[bytes] = None
+
+
+def generate_pepper() -> str:
+    """Генерация секрета для HMAC"""
+    return secrets.token_hex(32)
+
+
+def get_pepper() -> bytes:
+    """Секрет HMAC: переменная API_KEY_PEPPER или значение из app_settings"""
+    global _pepper
+    if _pepper is None:
+        value = os.getenv("API_KEY_PEPPER")
+        if not value:
+            conn = db.connect()
+            row = conn.execute('SELECT value FROM app_settings WHERE key = ?', (PEPPER_SETTING,)).fetchone()
+            conn.close()
+            if not row:
+                raise RuntimeError("Секрет для хеширования API ключей не найден: задайте API_KEY_PEPPER")
+            value = row[0]
+        _pepper = value.encode('utf-8')
+    return _pepper
+
+
+def hash_api_key(api_key: str, pepper: Optional[bytes] = None) -> str:
+    """HMAC-SHA256 от API ключа"""
+    return hmac.new(pepper or get_pepper(), api_key.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def key_prefix(api_key: str) -> str:
+    """Публичный префикс ключа для отображения"""
+    return api_key[:KEY_PREFIX_LENGTH]
+
+
+_MISS = object()
+
+
+class KeyCache:
+    """TTL-кэш результатов проверки ключей по их хешу (включая отрицательные)"""
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: Dict[str, Tuple[float, Any, Optional[str]]] = {}
+        self._hash_by_key_id: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key_hash: str) -> Any:
+        """Значение из кэша или KeyCache.MISS"""
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            return _MISS
+        expires, value, _key_id = entry
+        if expires < time.monotonic():
+            return _MISS
+        return value
+
+    def put(self, key_hash: str, value: Any, key_id: Optional[str] = None):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            if key_hash not in self._entries and len(self._entries) >= self.max_size:
+                # Вытесняем самую старую запись (порядок вставки dict)
+                oldest = next(iter(self._entries))
+                _, _, oldest_key_id = self._entries.pop(oldest)
+                if oldest_key_id:
+                    self._hash_by_key_id.pop(oldest_key_id, None)
+            self._entries[key_hash] = (time.monotonic() + ttl, value, key_id)
+            if key_id:
+                self._hash_by_key_id[key_id] = key_hash
+
+    def resize(self, max_size: int):
+        """Изменить размер кэша, вытеснив самые старые записи сверх него"""
+        with self._lock:
+            self.max_size = max_size
+            while len(self._entries) > max_size:
+                _, _, oldest_key_id = self._entries.pop(next(iter(self._entries)))
+                if oldest_key_id:
+                    self._hash_by_key_id.pop(oldest_key_id, None)
+
+    def invalidate_key_id(self, key_id: str):
+        """Сбросить кэш для ключа по его ID (удаление/переключение)"""
+        with self._lock:
+            key_hash = self._hash_by_key_id.pop(key_id, None)
+            if key_hash:
+                self._entries.pop(key_hash, None)
+
+    def invalidate_key_ids(self, key_ids):
+        """Сбросить кэш сразу для нескольких ключей"""
+        with self._lock:
+            for key_id in key_ids:
+                key_hash = self._hash_by_key_id.pop(key_id, None)
+                if key_hash:
+                    self._entries.pop(key_hash, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hash_by_key_id.clear()
+
+
+KeyCache.MISS = _MISS
+
+key_cache = KeyCache(KEY_CACHE_TTL, KEY_CACHE_NEGATIVE_TTL, KEY_CACHE_MAX_SIZE)
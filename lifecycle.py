@@ -0,0 +1,268 @@
+"""
+WindexRouter - Жизненный цикл процесса
+Прогрев при старте, состояние готовности и время холодного старта
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import db
+import metrics
+import proxy
+from key_store import key_cache
+from routing import backend_pool
+
+logger = logging.getLogger("windexrouter.lifecycle")
+
+# Сколько последних строк лога использования смотреть при прогреве кэша ключей
+KEY_CACHE_WARM_ROWS = int(os.getenv("KEY_CACHE_WARM_ROWS", "50000"))
+# Прогрев не должен задерживать готовность дольше этого времени (сек)
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "2.0"))
+# Сколько ждать завершения запросов в обработке после SIGTERM (сек)
+DRAIN_GRACE_PERIOD = float(os.getenv("DRAIN_GRACE_PERIOD", "30"))
+# Пути, которые обслуживаются и во время остановки
+DRAIN_EXEMPT_PATHS = ("/", "/readyz", "/metrics")
+
+STARTUP_SECONDS = metrics.Gauge("windex_startup_seconds", "Длительность этапов холодного старта", ("phase",))
+READY = metrics.Gauge("windex_ready", "Готовность воркера принимать трафик")
+HTTP_IN_FLIGHT = metrics.Gauge("windex_http_in_flight", "HTTP-запросы в обработке (включая потоковые)")
+DRAIN_REJECTED = metrics.Counter("windex_drain_rejected_total", "Запросы, отклоненные во время остановки")
+
+
+class Readiness:
+    """Состояние готовности воркера (отдается через /readyz)"""
+
+    def __init__(self):
+        self.process_started = time.perf_counter()
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self.phases: Dict[str, float] = {}
+        self._idle: Optional[asyncio.Event] = None
+
+    def mark_phase(self, phase: str, started: float) -> float:
+        elapsed = time.perf_counter() - started
+        self.phases[phase] = round(elapsed, 4)
+        STARTUP_SECONDS.set(elapsed, phase)
+        return elapsed
+
+    def set_ready(self):
+        self.ready = True
+        READY.set(1)
+        total = self.mark_phase("total", self.process_started)
+        logger.info("Воркер готов за %.3f с: %s", total, self.phases)
+
+    def snapshot(self) -> dict:
+        if self.draining:
+            status = "draining"
+        else:
+            status = "ready" if self.ready else "starting"
+        return {"status": status, "in_flight": self.in_flight, "startup_seconds": self.phases}
+
+    @property
+    def accepting(self) -> bool:
+        return self.ready and not self.draining
+
+    def request_started(self):
+        self.in_flight += 1
+        HTTP_IN_FLIGHT.set(self.in_flight)
+
+    def request_finished(self):
+        self.in_flight -= 1
+        HTTP_IN_FLIGHT.set(self.in_flight)
+        if self.in_flight == 0 and self._idle is not None:
+            self._idle.set()
+
+    async def drain(self, grace_period: float) -> bool:
+        """Перестать принимать запросы и дождаться текущих. True — все завершились."""
+        self.draining = True
+        READY.set(0)
+        logger.info("Остановка: ожидание %d запросов (до %.0f с)", self.in_flight, grace_period)
+        if self.in_flight == 0:
+            return True
+        self._idle = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=grace_period)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning("Период остановки истек, прерывается %d запросов", self.in_flight)
+            return False
+
+
+readiness = Readiness()
+
+
+def _warm_key_cache(make_entry: Callable) -> int:
+    """Загрузить в кэш ключи, встречавшиеся в последних строках лога использования"""
+    conn = db.connect()
+    try:
+        # Последние строки берутся из свежих партиций, старые месяцы не читаются
+        key_ids = set()
+        remaining = KEY_CACHE_WARM_ROWS
+        for table in reversed(db.usage_partitions(conn)):
+            if remaining <= 0:
+                break
+            recent = conn.execute(
+                f"SELECT api_key_id FROM {table} ORDER BY id DESC LIMIT ?", (remaining,)
+            ).fetchall()
+            key_ids.update(row[0] for row in recent)
+            remaining -= len(recent)
+        conn.execute("CREATE TEMP TABLE warm_key_ids (id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO warm_key_ids VALUES (?)", ((key_id,) for key_id in key_ids))
+        rows = conn.execute('''
+            SELECT ak.key_hash, u.id, u.username, u.email, u.created_at, u.is_active, ak.expires_at, ak.id, ak.is_active
+            FROM api_keys ak
+            JOIN users u ON u.id = ak.user_id
+            WHERE ak.id IN (SELECT id FROM warm_key_ids)
+            LIMIT ?
+        ''', (key_cache.max_size,)).fetchall()
+    finally:
+        conn.close()
+    for row in rows:
+        key_cache.put(row[0], make_entry(row[1:]), key_id=row[7])
+    return len(rows)
+
+
+async def _warm_upstream():
+    """Открыть keep-alive соединения ко всем backend"""
+    client = proxy.get_client()
+
+    async def touch(url: str):
+        try:
+            response = await client.get(url + proxy.MODELS_ROUTE.upstream_path, timeout=WARMUP_TIMEOUT)
+            await response.aclose()
+        except Exception as e:
+            logger.warning("Прогрев backend %s не удался: %s", url, e)
+
+    await asyncio.gather(*(touch(url) for url in backend_pool.backends))
+
+
+async def warm_up(make_entry: Callable):
+    """Параллельный прогрев кэша ключей и пула соединений; затем воркер готов.
+    make_entry строит запись кэша ключей из строки (как validate_api_key)."""
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    async def key_cache_phase():
+        phase_started = time.perf_counter()
+        count = await loop.run_in_executor(None, _warm_key_cache, make_entry)
+        readiness.mark_phase("key_cache", phase_started)
+        logger.info("Кэш ключей прогрет: %d записей", count)
+
+    async def upstream_phase():
+        phase_started = time.perf_counter()
+        await _warm_upstream()
+        readiness.mark_phase("upstream", phase_started)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(key_cache_phase(), upstream_phase()), timeout=WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Прогрев не завершился за %.1f с, воркер помечен готовым", WARMUP_TIMEOUT)
+    except Exception:
+        logger.exception("Ошибка прогрева")
+    readiness.mark_phase("warmup", started)
+    readiness.set_ready()
+
+
+_warmup_task: Optional[asyncio.Task] = None
+
+
+def start_warmup(make_entry: Callable):
+    global _warmup_task
+    _warmup_task = asyncio.get_running_loop().create_task(warm_up(make_entry))
+
+
+async def stop_warmup():
+    if _warmup_task is not None and not _warmup_task.done():
+        _warmup_task.cancel()
+        try:
+            await _warmup_task
+        except asyncio.CancelledError:
+            pass
+
+
+class DrainMiddleware:
+    """Считает HTTP-запросы в обработке и отклоняет новые во время остановки"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if readiness.draining and scope["path"] not in DRAIN_EXEMPT_PATHS:
+            DRAIN_REJECTED.inc()
+            body = json.dumps({"detail": "Сервер останавливается, повторите запрос"}, ensure_ascii=False).encode("utf-8")
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    (b"retry-after", b"1"),
+                    (b"connection", b"close"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        # Запрос считается завершенным, когда ответ (в т.ч. поток) отправлен полностью
+        readiness.request_started()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            readiness.request_finished()
+
+
+def install_drain_handler(on_drained: Callable):
+    """Перехватить SIGTERM: сначала остановка с ожиданием запросов, затем штатный выход.
+    on_drained — корутина, сбрасывающая фоновые очереди до выхода."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+    # Обработчик uvicorn — метод Server: через него ограничивается ожидание соединений при выходе
+    server = getattr(previous, "__self__", None)
+    if not hasattr(server, "force_exit"):
+        server = None
+
+    def exit_now(sig, frame, drained: bool = True, force: bool = False):
+        if server is not None:
+            if not drained:
+                # Период остановки истек: uvicorn сразу отменяет оставшиеся запросы (в т.ч. потоки),
+                # а не ждет закрытия соединений; завершение lifespan при этом выполняется
+                server.config.timeout_graceful_shutdown = 0
+            if force:
+                server.force_exit = True
+        signal.signal(signal.SIGTERM, previous)
+        if callable(previous):
+            previous(sig, frame)
+        else:
+            signal.raise_signal(sig)
+
+    async def drain_and_exit(sig):
+        drained = await readiness.drain(DRAIN_GRACE_PERIOD)
+        try:
+            await on_drained()
+        except Exception:
+            logger.exception("Ошибка при сбросе фоновых очередей")
+        exit_now(sig, None, drained=drained)
+
+    def handle_sigterm(sig, frame):
+        if readiness.draining:
+            # Повторный SIGTERM — выходим, не дожидаясь запросов и завершения lifespan
+            exit_now(sig, frame, drained=False, force=True)
+            return
+        readiness.draining = True
+        loop.call_soon_threadsafe(lambda: loop.create_task(drain_and_exit(sig)))
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
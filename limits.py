@@ -0,0 +1,48 @@
+"""
+WindexRouter - Ограничение частоты запросов
+In-memory token bucket на каждый API ключ (в пределах одного воркера)
+"""
+
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+# Запросов в секунду на ключ; 0 отключает ограничение
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class RateLimiter:
+    """Token bucket: ключ -> (токены, время последнего пополнения)"""
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key: str, cost: float = 1.0) -> Optional[float]:
+        """Списать токены. None — разрешено, иначе число секунд до повтора."""
+        if not self.enabled:
+            return None
+
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate
+
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            self._buckets.pop(next(iter(self._buckets)))
+        self._buckets[key] = (tokens - cost, now)
+        return None
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_RPS, RATE_LIMIT_BURST, RATE_LIMIT_MAX_KEYS)
@@ -0,0 +1,125 @@
+"""
+WindexRouter - Контроль блокировок event loop
+Задержка event loop измеряется постоянно и отдается в метриках; сторожевой поток
+замечает вызовы, блокирующие loop дольше порога, и пишет в лог их стек
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger("windexrouter.loop")
+
+# 0 — мониторинг выключен
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "1") == "1"
+# Период замера задержки (сек)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+# Блокировка дольше порога (сек) логируется со стеком потока event loop
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.1"))
+# 1 — дополнительно включить отладочный режим asyncio (медленные колбэки, незакрытые ресурсы).
+# Заметно замедляет loop: только для диагностики
+LOOP_ASYNCIO_DEBUG = os.getenv("LOOP_ASYNCIO_DEBUG", "0") == "1"
+
+# Один и тот же блокирующий вызов на каждом запросе не должен заваливать лог
+_LOG_MIN_INTERVAL = 1.0
+
+_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+LOOP_LAG = metrics.Histogram(
+    "windex_event_loop_lag_seconds", "Задержка запуска колбэков event loop", buckets=_LAG_BUCKETS
+)
+LOOP_LAG_LAST = metrics.Gauge("windex_event_loop_lag_last_seconds", "Последний замер задержки event loop")
+LOOP_BLOCKED = metrics.Counter(
+    "windex_event_loop_blocked_total", "Блокировки event loop дольше LOOP_BLOCK_THRESHOLD"
+)
+
+
+class LoopMonitor:
+    """Замер задержки event loop и сторожевой поток для поиска блокирующих вызовов"""
+
+    def __init__(self, enabled: bool, interval: float, block_threshold: float, asyncio_debug: bool):
+        self.enabled = enabled
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.asyncio_debug = asyncio_debug
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id = 0
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._last_logged = 0.0
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+    def _report_blocked(self, started: float):
+        """Стек потока event loop в момент блокировки"""
+        LOOP_BLOCKED.inc()
+        now = time.monotonic()
+        if now - self._last_logged < _LOG_MIN_INTERVAL:
+            return
+        self._last_logged = now
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(стек недоступен)\n"
+        logger.warning("Event loop заблокирован дольше %.0f мс, стек:\n%s",
+                       (now - started) * 1000, stack.rstrip())
+
+    def _watch(self):
+        # Колбэк ставится в loop из другого потока: если он не выполнился за порог, loop занят
+        while not self._stopped.wait(self.interval):
+            answered = threading.Event()
+            started = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:  # loop закрыт
+                return
+            if answered.wait(self.block_threshold):
+                continue
+            self._report_blocked(started)
+            while not answered.wait(self.interval):
+                if self._stopped.is_set():
+                    return
+            blocked = time.monotonic() - started
+            if blocked >= 1.0:
+                logger.warning("Event loop был заблокирован %.2f с", blocked)
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if self.asyncio_debug:
+            self._loop.set_debug(True)
+            self._loop.slow_callback_duration = self.block_threshold
+        self._task = self._loop.create_task(self._measure())
+        self._stopped.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._watchdog = None
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR, LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_ASYNCIO_DEBUG)
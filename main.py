@@ -1,27 +1,141 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request
+from fastapi import FastAPI, HTTPException, Depends, Query, status, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional, Dict, Any
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from pydantic import BaseModel, EmailStr, Field
+from typing import List, Literal, Optional, Dict, Any
 import sqlite3
 import uuid
+import base64
 import hashlib
 import secrets
-from datetime import datetime, timedelta
-import os
-import httpx
+from datetime import timedelta
+import asyncio
 import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import batch_jobs
+import db
+import idempotency
+import key_store
+import lifecycle
+import metrics
+import proxy
+import quotas
+import routing
+import sessions
+from archive import usage_archiver
+from batch_jobs import batch_runner
+from batching import embedding_batcher
+from compression import CompressionMiddleware
+from config import parse_list, runtime_config
+from context_window import context_limits
+from idempotency import IDEMPOTENCY_HEADER, idempotency_store
+from key_store import key_cache
+from lifecycle import DrainMiddleware, readiness
+from loop_monitor import loop_monitor
+from limits import rate_limiter
+from proxy import CHAT_ROUTE, PROXY_ROUTES, ProxyRoute
+from quotas import quota_manager
+from shadow import shadow_mirror
+from usage import usage_writer
+from ws_chat import ChatSocketSession
+
+
+async def flush_background_queues():
+    """Отправить открытые пачки и записать буферизованный лог использования"""
+    await embedding_batcher.drain()
+    await usage_writer.flush()
+    await quota_manager.sync()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop_monitor.start()
+    await runtime_config.start()
+    # Проверка схемы выполняется один раз на старте воркера, а не при импорте;
+    # прогрев идет в фоне, готовность сообщает /readyz
+    started = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(None, init_db)
+    readiness.mark_phase("schema", started)
+    # Квоты проверяются по счетчикам в памяти: суммы текущих окон загружаются до приема трафика
+    quotas_started = time.perf_counter()
+    await quota_manager.load()
+    readiness.mark_phase("quotas", quotas_started)
+    quota_manager.start()
+    context_limits.start()
+    batch_runner.start()
+    idempotency_store.start()
+    if sessions.SIGNED_SESSIONS:
+        await sessions.revocations.start()
+    usage_writer.start()
+    usage_archiver.start()
+    lifecycle.start_warmup(key_cache_entry)
+    lifecycle.install_drain_handler(flush_background_queues)
+    yield
+    await lifecycle.stop_warmup()
+    await batch_runner.stop()
+    await idempotency_store.stop()
+    await usage_archiver.stop()
+    await context_limits.stop()
+    await sessions.revocations.stop()
+    await shadow_mirror.stop()
+    await embedding_batcher.drain()
+    await usage_writer.stop()
+    await quota_manager.stop()
+    await proxy.close_client()
+    await runtime_config.stop()
+    await loop_monitor.stop()
+
+
+app = FastAPI(title="WindexRouter API", description="API для генерации и управления API ключами", lifespan=lifespan)
+
+# CORS для работы с Streamlit: источники через запятую (перезагружаемая настройка, см. config.py)
+CORS_OPTIONS = dict(allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+
+
+class CORSOrigins:
+    """Разрешенные источники CORS; version меняется при каждой замене списка"""
+
+    def __init__(self, origins: List[str]):
+        self.origins = origins
+        self.version = 0
+
+    def set(self, origins: List[str]):
+        self.origins = origins
+        self.version += 1
+
 
-app = FastAPI(title="WindexRouter API", description="API для генерации и управления API ключами")
+class ReloadableCORSMiddleware:
+    """CORSMiddleware со сменой источников без перезапуска: при новой версии списка
+    собирается новый экземпляр через публичный конструктор"""
 
-# CORS для работы с Streamlit
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def __init__(self, app, origins: CORSOrigins, **options):
+        self.app = app
+        self.origins = origins
+        self.options = options
+        self._version = -1
+        self._cors = None
+
+    async def __call__(self, scope, receive, send):
+        if self._version != self.origins.version:
+            self._cors = CORSMiddleware(self.app, allow_origins=self.origins.origins, **self.options)
+            self._version = self.origins.version
+        await self._cors(scope, receive, send)
+
+
+cors_origins = CORSOrigins(parse_list(os.getenv("CORS_ALLOW_ORIGINS", "*")))
+app.add_middleware(ReloadableCORSMiddleware, origins=cors_origins, **CORS_OPTIONS)
+
+runtime_config.register("CORS_ALLOW_ORIGINS", parse_list, lambda: cors_origins.origins, cors_origins.set)
+
+# Сжатие ответов по Accept-Encoding (gzip, а также br/zstd при наличии библиотек)
+app.add_middleware(CompressionMiddleware)
+
+# Учет запросов в обработке и отказ новым запросам во время остановки (SIGTERM)
+app.add_middleware(DrainMiddleware)
 
 # Модель для пользователя
 class User(BaseModel):
@@ -31,6 +145,27 @@ class User(BaseModel):
     created_at: str
     is_active: bool = True
 
+# Пользователь запроса внутри роутера: строится на каждый запрос (токен, API ключ),
+# поэтому без валидации Pydantic; модель User — только на границе ответа
+class UserRecord:
+    __slots__ = ("id", "username", "email", "created_at", "is_active")
+
+    def __init__(self, id: str, username: str, email: str, created_at: int, is_active: bool = True):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.created_at = created_at
+        self.is_active = is_active
+
+    def to_model(self) -> User:
+        return User(
+            id=self.id,
+            username=self.username,
+            email=self.email,
+            created_at=db.ts_to_iso(self.created_at),
+            is_active=self.is_active
+        )
+
 # Модель для регистрации
 class UserRegister(BaseModel):
     username: str
@@ -48,11 +183,12 @@ class Token(BaseModel):
     token_type: str
     expires_at: str
 
-# Модель для API ключа
+# Модель для API ключа (полный ключ возвращается только при создании)
 class APIKey(BaseModel):
     id: str
     name: str
-    key: str
+    key_prefix: str
+    key: Optional[str] = None
     created_at: str
     expires_at: Optional[str] = None
     is_active: bool = True
@@ -63,66 +199,29 @@ class CreateKeyRequest(BaseModel):
     name: str
     expires_in_days: Optional[int] = None
 
+# Модель операции массового управления ключами
+class BulkKeyOperation(BaseModel):
+    op: Literal["create", "revoke", "activate", "deactivate"]
+    id: Optional[str] = None               # для revoke/activate/deactivate
+    name: Optional[str] = None             # для create
+    expires_in_days: Optional[int] = None  # для create
+
+# Модель запроса массовых операций
+class BulkKeyRequest(BaseModel):
+    operations: List[BulkKeyOperation]
+
+# Модель квоты ключа на период (0 = без ограничения)
+class QuotaRequest(BaseModel):
+    period: Literal["day", "month"]
+    max_tokens: int = Field(0, ge=0)
+    max_requests: int = Field(0, ge=0)
+
 # Безопасность
 security = HTTPBearer()
 
-# Инициализация базы данных
+# Инициализация базы данных: применяет только недостающие миграции (см. db.py)
 def init_db():
-    conn = sqlite3.connect('api_keys.db')
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            is_active INTEGER DEFAULT 1
-        )
-    ''')
-    
-    # Таблица токенов
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tokens (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            token TEXT UNIQUE NOT NULL,
-            expires_at TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Обновленная таблица API ключей с привязкой к пользователю
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_keys (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            key TEXT UNIQUE NOT NULL,
-            created_at TEXT NOT NULL,
-            expires_at TEXT,
-            is_active INTEGER DEFAULT 1,
-            user_id TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Таблица для логирования использования API
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_usage_log (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            api_key_id TEXT NOT NULL,
-            endpoint TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    db.run_migrations()
 
 # Функции для работы с паролями
 def hash_password(password: str) -> str:
@@ -145,22 +244,35 @@ def generate_token() -> str:
     """Генерация токена"""
     return secrets.token_urlsafe(32)
 
-def get_token_expires() -> str:
+TOKEN_LIFETIME = int(timedelta(hours=24).total_seconds())
+
+def get_token_expires() -> int:
     """Получение времени истечения токена (24 часа)"""
-    return (datetime.now() + timedelta(hours=24)).isoformat()
+    return db.now_ts() + TOKEN_LIFETIME
 
 # Генерация уникального API ключа
 def generate_api_key():
     return f"wr_{uuid.uuid4().hex}"
 
 # Получение даты истечения
-def get_expires_date(days: int):
-    return (datetime.now() + timedelta(days=days)).isoformat()
+def get_expires_date(days: int) -> int:
+    return db.now_ts() + int(timedelta(days=days).total_seconds())
 
 # Функция для получения текущего пользователя
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Получение текущего пользователя по токену"""
-    conn = sqlite3.connect('api_keys.db')
+    if sessions.SIGNED_SESSIONS:
+        # Подписанный токен проверяется в памяти, без обращения к БД
+        claims = sessions.verify_token(credentials.credentials)
+        if claims is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Недействительный токен",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return UserRecord(claims["sub"], claims["usr"], claims["eml"], claims["cat"])
+
+    conn = db.connect()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -168,7 +280,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         FROM users u
         JOIN tokens t ON u.id = t.user_id
         WHERE t.token = ? AND t.expires_at > ? AND u.is_active = 1
-    ''', (credentials.credentials, datetime.now().isoformat()))
+    ''', (credentials.credentials, db.now_ts()))
     
     result = cursor.fetchone()
     conn.close()
@@ -180,62 +292,60 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return User(
-        id=result[0],
-        username=result[1],
-        email=result[2],
-        created_at=result[3],
-        is_active=bool(result[4])
-    )
+    return UserRecord(result[0], result[1], result[2], result[3], bool(result[4]))
+
+# Запись кэша ключей из строки (u.id, u.username, u.email, u.created_at, u.is_active,
+# ak.expires_at, ak.id, ak.is_active)
+def key_cache_entry(row) -> tuple:
+    return UserRecord(row[0], row[1], row[2], row[3], bool(row[4])), row[6], row[5], bool(row[7])
 
 # Функция для валидации API ключа
 async def validate_api_key(api_key: str) -> Optional[tuple]:
     """Валидация API ключа и получение пользователя и ID ключа"""
-    conn = sqlite3.connect('api_keys.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT u.id, u.username, u.email, u.created_at, u.is_active, ak.expires_at, ak.id
-        FROM users u
-        JOIN api_keys ak ON u.id = ak.user_id
-        WHERE ak.key = ? AND ak.is_active = 1 AND u.is_active = 1
-    ''', (api_key,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return None
-    
-    # Проверяем срок действия ключа
-    if result[5]:  # expires_at
-        expires_at = datetime.fromisoformat(result[5])
-        if expires_at < datetime.now():
+    key_hash = key_store.hash_api_key(api_key)
+
+    # Кэш хранит запись ключа вместе с флагами активности, чтобы
+    # переключение ключа сбрасывало именно ее (по ID ключа)
+    cached = key_cache.get(key_hash)
+    if cached is key_cache.MISS:
+        conn = db.connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT u.id, u.username, u.email, u.created_at, u.is_active, ak.expires_at, ak.id, ak.is_active
+            FROM users u
+            JOIN api_keys ak ON u.id = ak.user_id
+            WHERE ak.key_hash = ?
+        ''', (key_hash,))
+
+        result = cursor.fetchone()
+        conn.close()
+
+        if not result:
+            key_cache.put(key_hash, None)
             return None
-    
-    user = User(
-        id=result[0],
-        username=result[1],
-        email=result[2],
-        created_at=result[3],
-        is_active=bool(result[4])
-    )
-    
-    return user, result[6]  # Возвращаем пользователя и ID ключа
 
-# DeepSeek API конфигурация
-DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "http://localhost:1103")
-# DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "http://localhost:1103/api/chat/completions")  # Local DeepSeek endpoint
-#DEEPSEEK_FORWARD_URL = os.getenv("DEEPSEEK_FORWARD_URL", DEEPSEEK_API_URL)
+        cached = key_cache_entry(result)
+        key_cache.put(key_hash, cached, key_id=result[6])
+
+    if cached is None:
+        return None
+
+    user, key_id, expires_at, key_active = cached
+    if not key_active or not user.is_active:
+        return None
+
+    # Проверяем срок действия ключа
+    if expires_at and expires_at < db.now_ts():
+        return None
 
-# Инициализация БД при запуске
-init_db()
+    return user, key_id  # Возвращаем пользователя и ID ключа
 
 # Endpoints для аутентификации
 @app.post("/api/auth/register", response_model=User)
 async def register_user(user_data: UserRegister):
     """Регистрация нового пользователя"""
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Проверяем, существует ли пользователь
@@ -247,7 +357,7 @@ async def register_user(user_data: UserRegister):
     # Создаем пользователя
     user_id = str(uuid.uuid4())
     password_hash = hash_password(user_data.password)
-    created_at = datetime.now().isoformat()
+    created_at = db.now_ts()
     
     try:
         cursor.execute('''
@@ -261,7 +371,7 @@ async def register_user(user_data: UserRegister):
             id=user_id,
             username=user_data.username,
             email=user_data.email,
-            created_at=created_at,
+            created_at=db.ts_to_iso(created_at),
             is_active=True
         )
     except sqlite3.IntegrityError:
@@ -273,7 +383,7 @@ async def register_user(user_data: UserRegister):
 @app.post("/api/auth/login", response_model=Token)
 async def login_user(login_data: UserLogin):
     """Вход пользователя"""
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
     
     # Находим пользователя
@@ -284,11 +394,19 @@ async def login_user(login_data: UserLogin):
         conn.close()
         raise HTTPException(status_code=401, detail="Неверное имя пользователя или пароль")
     
+    expires_at = get_token_expires()
+    if sessions.SIGNED_SESSIONS:
+        conn.close()
+        return Token(
+            access_token=sessions.issue_token(user[0], user[1], user[2], user[4], expires_at),
+            token_type="bearer",
+            expires_at=db.ts_to_iso(expires_at)
+        )
+
     # Создаем токен
     token = generate_token()
     token_id = str(uuid.uuid4())
-    expires_at = get_token_expires()
-    created_at = datetime.now().isoformat()
+    created_at = db.now_ts()
     
     cursor.execute('''
         INSERT INTO tokens (id, user_id, token, expires_at, created_at)
@@ -301,54 +419,59 @@ async def login_user(login_data: UserLogin):
     return Token(
         access_token=token,
         token_type="bearer",
-        expires_at=expires_at
+        expires_at=db.ts_to_iso(expires_at)
     )
 
 @app.get("/api/auth/me", response_model=User)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: UserRecord = Depends(get_current_user)):
     """Получение информации о текущем пользователе"""
-    return current_user
+    return current_user.to_model()
 
 @app.post("/api/auth/logout")
-async def logout_user(current_user: User = Depends(get_current_user)):
+async def logout_user(current_user: UserRecord = Depends(get_current_user)):
     """Выход пользователя (удаление токена)"""
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM tokens WHERE user_id = ?', (current_user.id,))
     conn.commit()
     conn.close()
+
+    if sessions.SIGNED_SESSIONS:
+        sessions.revocations.revoke_user(current_user.id, TOKEN_LIFETIME)
     
     return {"message": "Успешный выход"}
 
 @app.post("/api/keys", response_model=APIKey)
-async def create_api_key(request: CreateKeyRequest, current_user: User = Depends(get_current_user)):
+async def create_api_key(request: CreateKeyRequest, current_user: UserRecord = Depends(get_current_user)):
     """Создать новый API ключ"""
     api_key_value = generate_api_key()
     key_id = str(uuid.uuid4())
-    created_at = datetime.now().isoformat()
+    created_at = db.now_ts()
 
     expires_at = None
     if request.expires_in_days:
         expires_at = get_expires_date(request.expires_in_days)
 
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
 
     try:
         cursor.execute('''
-            INSERT INTO api_keys (id, name, key, created_at, expires_at, is_active, user_id)
-            VALUES (?, ?, ?, ?, ?, 1, ?)
-        ''', (key_id, request.name, api_key_value, created_at, expires_at, current_user.id))
+            INSERT INTO api_keys (id, name, key_prefix, key_hash, created_at, expires_at, is_active, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+        ''', (key_id, request.name, key_store.key_prefix(api_key_value), key_store.hash_api_key(api_key_value),
+              created_at, expires_at, current_user.id))
 
         conn.commit()
 
         return APIKey(
             id=key_id,
             name=request.name,
+            key_prefix=key_store.key_prefix(api_key_value),
             key=api_key_value,
-            created_at=created_at,
-            expires_at=expires_at,
+            created_at=db.ts_to_iso(created_at),
+            expires_at=db.ts_to_iso(expires_at),
             is_active=True,
             user_id=current_user.id
         )
@@ -357,49 +480,128 @@ async def create_api_key(request: CreateKeyRequest, current_user: User = Depends
     finally:
         conn.close()
 
-@app.get("/api/keys", response_model=List[APIKey])
-async def get_api_keys(current_user: User = Depends(get_current_user)):
-    """Получить все API ключи пользователя"""
-    conn = sqlite3.connect('api_keys.db')
-    cursor = conn.cursor()
+# Поля ключа, доступные для выборки через fields=
+API_KEY_FIELDS = ("id", "name", "key_prefix", "created_at", "expires_at", "is_active", "user_id")
+# Приведение значений столбцов к JSON-типам ответа (остальные поля — как есть)
+API_KEY_CONVERTERS = {"created_at": db.ts_to_iso, "expires_at": db.ts_to_iso, "is_active": bool}
+API_KEYS_PAGE_DEFAULT = 50
+API_KEYS_PAGE_MAX = 500
+
 
-    cursor.execute('SELECT id, name, key, created_at, expires_at, is_active, user_id FROM api_keys WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,))
+def encode_keys_cursor(created_at: int, key_id: str) -> str:
+    """Непрозрачный курсор для keyset-пагинации по (created_at, id)"""
+    return base64.urlsafe_b64encode(f"{created_at}:{key_id}".encode()).decode().rstrip("=")
+
+
+def decode_keys_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, key_id = raw.split(":", 1)
+        return int(created_at), key_id
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
 
-    keys = []
-    for row in cursor.fetchall():
-        keys.append(APIKey(
-            id=row[0],
-            name=row[1],
-            key=row[2],
-            created_at=row[3],
-            expires_at=row[4],
-            is_active=bool(row[5]),
-            user_id=row[6]
-        ))
 
+@app.get("/api/keys")
+async def get_api_keys(
+    limit: int = Query(API_KEYS_PAGE_DEFAULT, ge=1, le=API_KEYS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Список полей через запятую"),
+    key_status: Optional[str] = Query(None, alias="status", pattern="^(active|inactive|expired)$"),
+    name: Optional[str] = Query(None, description="Подстрока названия ключа"),
+    current_user: UserRecord = Depends(get_current_user),
+):
+    """Получить API ключи пользователя постранично (новые сначала)"""
+    if fields:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in selected if field not in API_KEY_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(unknown)}")
+    else:
+        selected = list(API_KEY_FIELDS)
+
+    # created_at и id нужны для курсора, даже если не запрошены
+    columns = list(dict.fromkeys(selected + ["created_at", "id"]))
+    where = ["user_id = ?"]
+    params: list = [current_user.id]
+
+    if cursor:
+        cursor_created_at, cursor_id = decode_keys_cursor(cursor)
+        # Сравнение row value позволяет SQLite начать обход индекса прямо с курсора
+        where.append("(created_at, id) < (?, ?)")
+        params.extend([cursor_created_at, cursor_id])
+
+    now = db.now_ts()
+    if key_status == "active":
+        where.append("is_active = 1 AND (expires_at IS NULL OR expires_at > ?)")
+        params.append(now)
+    elif key_status == "inactive":
+        where.append("is_active = 0")
+    elif key_status == "expired":
+        where.append("expires_at IS NOT NULL AND expires_at <= ?")
+        params.append(now)
+
+    if name:
+        escaped = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("name LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped}%")
+
+    params.append(limit + 1)
+
+    conn = db.connect()
+    cursor_db = conn.cursor()
+    cursor_db.execute(
+        f"SELECT {', '.join(columns)} FROM api_keys WHERE {' AND '.join(where)} "
+        "ORDER BY created_at DESC, id DESC LIMIT ?",
+        params,
+    )
+    rows = cursor_db.fetchall()
     conn.close()
-    return keys
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    created_at_index = columns.index("created_at")
+    id_index = columns.index("id")
+    positions = [(field, columns.index(field), API_KEY_CONVERTERS.get(field)) for field in selected]
+    items = [
+        {field: row[position] if convert is None else convert(row[position])
+         for field, position, convert in positions}
+        for row in rows
+    ]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_keys_cursor(last[created_at_index], last[id_index])
+
+    # Строки уже приведены к JSON-типам: ответ сериализуется напрямую, без jsonable_encoder
+    return JSONResponse({"data": items, "next_cursor": next_cursor})
 
 @app.delete("/api/keys/{key_id}")
-async def delete_api_key(key_id: str, current_user: User = Depends(get_current_user)):
+async def delete_api_key(key_id: str, current_user: UserRecord = Depends(get_current_user)):
     """Удалить API ключ"""
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
 
     cursor.execute('DELETE FROM api_keys WHERE id = ? AND user_id = ?', (key_id, current_user.id))
     deleted = cursor.rowcount > 0
+    if deleted:
+        cursor.execute("DELETE FROM quotas WHERE scope = 'key' AND subject_id = ?", (key_id,))
     conn.commit()
     conn.close()
 
     if not deleted:
         raise HTTPException(status_code=404, detail="Ключ не найден")
 
+    key_cache.invalidate_key_id(key_id)
+
     return {"message": "Ключ успешно удален"}
 
 @app.put("/api/keys/{key_id}/toggle")
-async def toggle_api_key(key_id: str, current_user: User = Depends(get_current_user)):
+async def toggle_api_key(key_id: str, current_user: UserRecord = Depends(get_current_user)):
     """Включить/выключить API ключ"""
-    conn = sqlite3.connect('api_keys.db')
+    conn = db.connect()
     cursor = conn.cursor()
 
     # Получить текущее состояние
@@ -414,14 +616,146 @@ async def toggle_api_key(key_id: str, current_user: User = Depends(get_current_u
     cursor.execute('UPDATE api_keys SET is_active = ? WHERE id = ? AND user_id = ?', (new_status, key_id, current_user.id))
     conn.commit()
     conn.close()
+    key_cache.invalidate_key_id(key_id)
 
     return {"message": f"Ключ {'активирован' if new_status else 'деактивирован'}"}
 
-# DeepSeek API проксирование
-@app.post("/api/deepseek/chat/completions")
-async def deepseek_chat_completions(request: Request):
-    """Проксирование запросов к DeepSeek API"""
-    # Получаем API ключ из заголовка Authorization
+def quota_status(scope: str, subject_id: str) -> dict:
+    """Квоты и израсходованное за текущие окна (из счетчиков в памяти)"""
+    limits = quota_manager.limits_for(scope, subject_id)
+    result = {}
+    for period in quotas.PERIODS:
+        max_tokens, max_requests = limits.get(period, (0, 0))
+        tokens, requests = quota_manager.used(scope, subject_id, period)
+        result[period] = {
+            "max_tokens": max_tokens, "max_requests": max_requests,
+            "used_tokens": tokens, "used_requests": requests,
+        }
+    return result
+
+@app.get("/api/quota")
+async def get_user_quota(current_user: UserRecord = Depends(get_current_user)):
+    """Квоты пользователя и расход за текущий день/месяц"""
+    return quota_status("user", current_user.id)
+
+@app.get("/api/keys/{key_id}/quota")
+async def get_key_quota(key_id: str, current_user: UserRecord = Depends(get_current_user)):
+    """Квоты ключа и расход за текущий день/месяц"""
+    conn = db.connect()
+    try:
+        found = conn.execute('SELECT 1 FROM api_keys WHERE id = ? AND user_id = ?', (key_id, current_user.id)).fetchone()
+    finally:
+        conn.close()
+    if not found:
+        raise HTTPException(status_code=404, detail="Ключ не найден")
+    return quota_status("key", key_id)
+
+@app.put("/api/keys/{key_id}/quota")
+async def set_key_quota(key_id: str, request: QuotaRequest, current_user: UserRecord = Depends(get_current_user)):
+    """Задать квоту токенов/запросов ключа на день или месяц"""
+    conn = db.connect()
+    try:
+        found = conn.execute('SELECT 1 FROM api_keys WHERE id = ? AND user_id = ?', (key_id, current_user.id)).fetchone()
+        if not found:
+            raise HTTPException(status_code=404, detail="Ключ не найден")
+        conn.execute('''
+            INSERT INTO quotas (scope, subject_id, period, max_tokens, max_requests)
+            VALUES ('key', ?, ?, ?, ?)
+            ON CONFLICT (scope, subject_id, period)
+            DO UPDATE SET max_tokens = excluded.max_tokens, max_requests = excluded.max_requests
+        ''', (key_id, request.period, request.max_tokens, request.max_requests))
+        conn.commit()
+    finally:
+        conn.close()
+
+    quota_manager.set_limit("key", key_id, request.period, request.max_tokens, request.max_requests)
+    return quota_status("key", key_id)
+
+BULK_MAX_OPERATIONS = 1000
+# Ограничение числа параметров в одном SQL-запросе
+SQL_CHUNK_SIZE = 500
+
+@app.post("/api/keys/bulk")
+async def bulk_api_keys(request: BulkKeyRequest, current_user: UserRecord = Depends(get_current_user)):
+    """Массовое создание, отзыв и (де)активация ключей в одной транзакции"""
+    if len(request.operations) > BULK_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Не более {BULK_MAX_OPERATIONS} операций за запрос")
+
+    conn = db.connect()
+    cursor = conn.cursor()
+
+    try:
+        # Какие из упомянутых ключей принадлежат пользователю — одним проходом
+        referenced = list({op.id for op in request.operations if op.op != "create" and op.id})
+        existing = set()
+        for start in range(0, len(referenced), SQL_CHUNK_SIZE):
+            chunk = referenced[start:start + SQL_CHUNK_SIZE]
+            cursor.execute(
+                f"SELECT id FROM api_keys WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})",
+                [current_user.id, *chunk],
+            )
+            existing.update(row[0] for row in cursor.fetchall())
+
+        created_at = db.now_ts()
+        inserts = []
+        updates = []
+        deletes = []
+        results = []
+        for index, op in enumerate(request.operations):
+            if op.op == "create":
+                if not op.name or not op.name.strip():
+                    results.append({"index": index, "op": op.op, "status": "error", "detail": "Не указано название ключа"})
+                    continue
+                api_key_value = generate_api_key()
+                key_id = str(uuid.uuid4())
+                expires_at = get_expires_date(op.expires_in_days) if op.expires_in_days else None
+                inserts.append((key_id, op.name, key_store.key_prefix(api_key_value), key_store.hash_api_key(api_key_value),
+                                created_at, expires_at, current_user.id))
+                results.append({
+                    "index": index, "op": op.op, "status": "ok", "id": key_id,
+                    "key": api_key_value, "key_prefix": key_store.key_prefix(api_key_value),
+                    "created_at": db.ts_to_iso(created_at), "expires_at": db.ts_to_iso(expires_at),
+                })
+                continue
+
+            if not op.id or op.id not in existing:
+                results.append({"index": index, "op": op.op, "status": "error", "id": op.id, "detail": "Ключ не найден"})
+                continue
+
+            if op.op == "revoke":
+                existing.discard(op.id)
+                deletes.append((op.id, current_user.id))
+            else:
+                updates.append((1 if op.op == "activate" else 0, op.id, current_user.id))
+            results.append({"index": index, "op": op.op, "status": "ok", "id": op.id})
+
+        # Порядок групп безопасен: отозванные ключи исключены из existing выше,
+        # поэтому обновление после удаления того же ключа невозможно
+        if inserts:
+            cursor.executemany('''
+                INSERT INTO api_keys (id, name, key_prefix, key_hash, created_at, expires_at, is_active, user_id)
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+            ''', inserts)
+        if updates:
+            cursor.executemany('UPDATE api_keys SET is_active = ? WHERE id = ? AND user_id = ?', updates)
+        if deletes:
+            cursor.executemany('DELETE FROM api_keys WHERE id = ? AND user_id = ?', deletes)
+            cursor.executemany("DELETE FROM quotas WHERE scope = 'key' AND subject_id = ?",
+                               [(key_id,) for key_id, _ in deletes])
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        raise HTTPException(status_code=400, detail="Ключ с таким значением уже существует")
+    finally:
+        conn.close()
+
+    key_cache.invalidate_key_ids([key_id for _, key_id, _ in updates] + [key_id for key_id, _ in deletes])
+
+    return {"results": results}
+
+# Проверка API ключа для проксируемых маршрутов
+async def require_api_key(request: Request) -> tuple:
+    """Зависимость FastAPI: пользователь и ID ключа из заголовка Authorization"""
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(
@@ -429,10 +763,9 @@ async def deepseek_chat_completions(request: Request):
             detail="Требуется API ключ в заголовке Authorization: Bearer <your-api-key>",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
+
     api_key = auth_header[7:]  # Убираем "Bearer "
-    
-    # Валидируем API ключ
+
     validation_result = await validate_api_key(api_key)
     if not validation_result:
         raise HTTPException(
@@ -440,116 +773,300 @@ async def deepseek_chat_completions(request: Request):
             detail="Недействительный или истекший API ключ",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    
-    user, key_id = validation_result
-    
-    # Получаем данные запроса
-    try:
-        request_data = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Неверный JSON в теле запроса"
-        )
-    
-    # Проверяем наличие обязательных полей
-    if "messages" not in request_data:
+
+    return validation_result
+
+
+QUOTA_EXCEEDED_DETAIL = "Исчерпана квота {resource} {scope} на {period}"
+QUOTA_WORDS = {
+    "tokens": "токенов", "requests": "запросов",
+    "key": "API ключа", "user": "пользователя",
+    "day": "день", "month": "месяц",
+}
+
+
+def admit_request(route: ProxyRoute, user: UserRecord, key_id: str):
+    """Лимит запросов и квоты до обращения к upstream (HTTPException 429 при отказе)"""
+    retry_after = rate_limiter.acquire(key_id)
+    if retry_after is not None:
+        metrics.RATE_LIMITED.inc(route.name)
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Отсутствует поле 'messages' в запросе"
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Превышен лимит запросов для API ключа",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
         )
-    
-    # Подготавливаем запрос к локальному DeepSeek
-    deepseek_url = f"{DEEPSEEK_API_BASE}/api/chat/completions"
-    deepseek_headers = {"Content-Type": "application/json"}
-    
-    # Добавляем логирование использования
-    conn = sqlite3.connect('api_keys.db')
-    cursor = conn.cursor()
-    log_id = str(uuid.uuid4())
-    cursor.execute('''
-        INSERT INTO api_usage_log (id, user_id, api_key_id, endpoint, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (log_id, user.id, key_id, "deepseek_chat", datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-    
-    # Отправляем запрос к DeepSeek
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                deepseek_url,
-                json=request_data,
-                headers=deepseek_headers
+
+    if route.log_usage:
+        exceeded = quota_manager.check(user.id, key_id)
+        if exceeded is not None:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=QUOTA_EXCEEDED_DETAIL.format(
+                    resource=QUOTA_WORDS[exceeded.resource],
+                    scope=QUOTA_WORDS[exceeded.scope],
+                    period=QUOTA_WORDS[exceeded.period],
+                ),
+                headers={"Retry-After": str(max(1, exceeded.retry_after))},
             )
-            
-            if response.status_code == 200:
-                return response.json()
+
+
+def track_usage(route: ProxyRoute, user: UserRecord, key_id: str, sample=None):
+    """Записать запрос в лог использования и вернуть обработчик usage ответа (или None)"""
+    if route.log_usage:
+        usage_writer.record(user.id, key_id, route.name)
+        quota_manager.record_request(user.id, key_id)
+    elif sample is None:
+        return None
+
+    def on_usage(usage: Optional[dict]):
+        if route.log_usage:
+            quota_manager.record_tokens(user.id, key_id, usage)
+        if sample is not None:
+            sample.primary_done(usage)
+
+    return on_usage
+
+
+def make_proxy_handler(route: ProxyRoute):
+    """Обработчик для маршрута из таблицы PROXY_ROUTES"""
+
+    async def execute(accept_encoding: Optional[str], user: UserRecord, key_id: str, body: Optional[bytes],
+                      request_data: Optional[dict], stream: bool, trimmed: int) -> Response:
+        """Выполнить проверенный запрос: shadow, учет использования, обращение к upstream"""
+        # Копия выборки запросов чата уходит на теневой backend в фоне
+        sample = shadow_mirror.mirror(route, body, stream) if route is CHAT_ROUTE else None
+
+        on_usage = track_usage(route, user, key_id, sample)
+
+        started = time.perf_counter()
+        metrics.IN_FLIGHT.inc(route.name)
+        status_code = 500
+        try:
+            if route is embedding_batcher.route and embedding_batcher.accepts(request_data):
+                # Мелкие запросы эмбеддингов объединяются в общий вызов upstream
+                result = await embedding_batcher.submit(request_data)
+                if on_usage is not None:
+                    on_usage(result["usage"])
+                response = JSONResponse(result)
             else:
+                affinity = None
+                if routing.STICKY_ROUTING and route is CHAT_ROUTE:
+                    affinity = routing.prefix_key(request_data)
+                response = await proxy.forward(
+                    route, body, stream=stream,
+                    accept_encoding=accept_encoding,
+                    affinity=affinity,
+                    on_usage=on_usage,
+                    on_first_chunk=sample.primary_first_chunk if sample is not None else None,
+                    model=request_data.get("model") if request_data else None,
+                    max_tokens=request_data.get("max_tokens") if request_data else None,
+                    cost=routing.request_cost(request_data),
+                )
+            if trimmed:
+                response.headers["X-Context-Trimmed"] = str(trimmed)
+            status_code = response.status_code
+            return response
+        except HTTPException as e:
+            status_code = e.status_code
+            if e.status_code in (status.HTTP_502_BAD_GATEWAY, status.HTTP_504_GATEWAY_TIMEOUT):
+                metrics.UPSTREAM_ERRORS.inc(route.name, str(e.status_code))
+            raise
+        finally:
+            metrics.IN_FLIGHT.dec(route.name)
+            metrics.REQUESTS_TOTAL.inc(route.name, str(status_code))
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - started, route.name)
+
+    async def proxy_handler(request: Request, auth: tuple = Depends(require_api_key)):
+        user, key_id = auth
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER) if route.method == "POST" else None
+        if idempotency_key is None:
+            admit_request(route, user, key_id)
+        else:
+            # Лимиты и квоты проверяются только при реальном выполнении, а не на повторе
+            idempotency_store.validate_key(idempotency_key)
+
+        body = None
+        request_data = None
+        stream = False
+        trimmed = 0
+        if route.method == "POST":
+            body = await request.body()
+            try:
+                request_data = json.loads(body)
+            except (json.JSONDecodeError, UnicodeDecodeError):
                 raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Ошибка DeepSeek API: {response.text}"
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Неверный JSON в теле запроса"
                 )
-                
-    except httpx.TimeoutException:
-        raise HTTPException(
-            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-            detail="Таймаут при обращении к DeepSeek API"
-        )
-    except httpx.RequestError as e:
+            if not isinstance(request_data, dict):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Тело запроса должно быть JSON-объектом"
+                )
+            if route.required_field and route.required_field not in request_data:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Отсутствует поле '{route.required_field}' в запросе"
+                )
+            stream = bool(request_data.get("stream"))
+            # Отпечаток — только для запросов с Idempotency-Key: хешировать каждый промпт незачем
+            request_fingerprint = idempotency.fingerprint(route.name, body) if idempotency_key is not None else None
+            # Запрос, не помещающийся в окно контекста модели, отклоняется до обращения к upstream
+            trimmed = context_limits.fit(route, request_data)
+            if trimmed:
+                body = json.dumps(request_data, ensure_ascii=False).encode("utf-8")
+
+        if idempotency_key is None:
+            return await execute(request.headers.get("Accept-Encoding"), user, key_id,
+                                 body, request_data, stream, trimmed)
+
+        async def admitted_execute():
+            admit_request(route, user, key_id)
+            # Ответ отдается разным клиентам и хранится: тело upstream запрашивается без сжатия
+            return await execute(None, user, key_id, body, request_data, stream, trimmed)
+
+        return await idempotency_store.execute(key_id, idempotency_key, request_fingerprint, admitted_execute)
+
+    proxy_handler.__name__ = f"proxy_{route.name}"
+    return proxy_handler
+
+
+# Регистрация OpenAI-совместимых маршрутов (/v1/...) и исторических /api/deepseek/...
+for _path, _route in PROXY_ROUTES.items():
+    app.add_api_route(_path, make_proxy_handler(_route), methods=[_route.method], tags=["proxy"])
+
+
+@app.websocket("/v1/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Чат через WebSocket: ключ проверяется один раз на соединение, реплики идут потоком"""
+    await ChatSocketSession(websocket, validate_api_key, admit_request, track_usage).run()
+
+
+async def _read_batch_upload(request: Request) -> bytes:
+    size = 0
+    parts = []
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > batch_jobs.BATCH_MAX_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Файл задания больше {batch_jobs.BATCH_MAX_BYTES} байт"
+            )
+        parts.append(chunk)
+    return b"".join(parts)
+
+
+@app.post("/v1/batches", tags=["batch"])
+async def create_batch(request: Request, auth: tuple = Depends(require_api_key)):
+    """Создать пакетное задание: тело — JSONL, по запросу на строку"""
+    user, key_id = auth
+    content = await _read_batch_upload(request)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, batch_jobs.create_job, user.id, key_id, content)
+
+
+@app.get("/v1/batches", tags=["batch"])
+async def list_batches(limit: int = Query(20, ge=1, le=100), auth: tuple = Depends(require_api_key)):
+    """Пакетные задания пользователя, от новых к старым"""
+    user, _ = auth
+    return {"data": batch_jobs.list_jobs(user.id, limit)}
+
+
+def _batch_or_404(job: Optional[dict]) -> dict:
+    if job is None:
         raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Ошибка подключения к DeepSeek API: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Пакетное задание не найдено"
         )
+    return job
 
-@app.get("/api/deepseek/models")
-async def deepseek_models(request: Request):
-    """Получение списка доступных моделей DeepSeek"""
-    # Получаем API ключ из заголовка Authorization
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
+
+@app.get("/v1/batches/{job_id}", tags=["batch"])
+async def get_batch(job_id: str, auth: tuple = Depends(require_api_key)):
+    """Состояние и прогресс пакетного задания"""
+    user, _ = auth
+    return _batch_or_404(batch_jobs.get_job(job_id, user.id))
+
+
+@app.post("/v1/batches/{job_id}/cancel", tags=["batch"])
+async def cancel_batch(job_id: str, auth: tuple = Depends(require_api_key)):
+    """Отменить задание; уже полученные результаты остаются доступными"""
+    user, _ = auth
+    return _batch_or_404(batch_jobs.cancel_job(job_id, user.id))
+
+
+@app.get("/v1/batches/{job_id}/output", tags=["batch"])
+async def download_batch_output(job_id: str, auth: tuple = Depends(require_api_key)):
+    """Результаты задания в JSONL (для незавершенного задания — уже готовая часть)"""
+    user, _ = auth
+    _batch_or_404(batch_jobs.get_job(job_id, user.id))
+    path = batch_jobs.output_path(job_id)
+    if not os.path.exists(path):
+        return PlainTextResponse("", media_type="application/x-ndjson")
+    return FileResponse(path, media_type="application/x-ndjson", filename=f"{job_id}.jsonl")
+
+
+@app.delete("/v1/batches/{job_id}", tags=["batch"])
+async def delete_batch(job_id: str, auth: tuple = Depends(require_api_key)):
+    """Удалить завершенное задание вместе с файлами"""
+    user, _ = auth
+    deleted = batch_jobs.delete_job(job_id, user.id)
+    if deleted is None:
+        _batch_or_404(None)
+    if not deleted:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Требуется API ключ в заголовке Authorization: Bearer <your-api-key>",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Задание еще выполняется: сначала отмените его"
         )
-    
-    api_key = auth_header[7:]  # Убираем "Bearer "
-    
-    # Валидируем API ключ
-    validation_result = await validate_api_key(api_key)
-    if not validation_result:
+    return {"message": "Пакетное задание удалено"}
+
+
+# Токен администратора для /admin/* (пусто — админ-эндпоинты выключены)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def require_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Зависимость FastAPI: заголовок Authorization: Bearer <ADMIN_TOKEN>"""
+    if not ADMIN_TOKEN or not secrets.compare_digest(credentials.credentials.encode('utf-8'),
+                                                     ADMIN_TOKEN.encode('utf-8')):
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Недействительный или истекший API ключ",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Требуется токен администратора"
         )
-    
-    user, key_id = validation_result
-    
-    # Проксируем запрос к локальному DeepSeek
-    models_url = f"{DEEPSEEK_API_BASE}/api/models"
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.get(models_url)
-            if resp.status_code == 200:
-                return resp.json()
-            else:
-                raise HTTPException(
-                    status_code=resp.status_code,
-                    detail=f"DeepSeek error: {resp.text}"
-                )
-    except httpx.RequestError as e:
+
+
+@app.get("/admin/config", tags=["admin"], dependencies=[Depends(require_admin)])
+async def get_runtime_config():
+    """Версия и действующие значения перезагружаемой конфигурации этого воркера"""
+    return runtime_config.snapshot()
+
+
+@app.post("/admin/config/reload", tags=["admin"], dependencies=[Depends(require_admin)])
+async def reload_runtime_config():
+    """Перечитать файл конфигурации (как SIGHUP); при ошибке остается прежняя версия"""
+    if not await runtime_config.reload("админ-эндпоинт"):
         raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Ошибка подключения к DeepSeek: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Конфигурация не применена: {runtime_config.last_error}"
         )
+    return runtime_config.snapshot()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(metrics.render_latest(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
-    """Главная страница"""
+    """Главная страница (проверка живости процесса)"""
     return {"message": "WindexRouter API", "version": "1.0.0"}
 
+@app.get("/readyz")
+async def readyz():
+    """Готовность принимать трафик: 503 во время прогрева и остановки"""
+    return JSONResponse(readiness.snapshot(), status_code=200 if readiness.accepting else 503)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=1101)
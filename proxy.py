@@ -0,0 +1,318 @@
+"""
+WindexRouter - Проксирование запросов к DeepSeek
+Общий пул соединений к upstream и таблица OpenAI-совместимых маршрутов
+"""
+
+import asyncio
+import json
+import os
+import time
+import zlib
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import httpx
+from fastapi import HTTPException, status
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTasks
+
+from compression import brotli, zstandard
+from routing import backend_pool
+from timeouts import UPSTREAM_TIMEOUTS, TimeoutLimits, adaptive_timeouts
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "50"))
+
+# Заголовки ответа upstream, которые передаются клиенту как есть
+PASSTHROUGH_HEADERS = ("content-type", "content-encoding", "cache-control")
+
+
+@dataclass(frozen=True)
+class ProxyRoute:
+    """Описание проксируемого маршрута"""
+    name: str                             # имя для метрик и лога использования
+    method: str
+    upstream_path: str
+    required_field: Optional[str] = None  # обязательное поле JSON-тела
+    timeout: float = 60.0
+    log_usage: bool = True
+
+
+CHAT_ROUTE = ProxyRoute("deepseek_chat", "POST", "/api/chat/completions", "messages")
+EMBEDDINGS_ROUTE = ProxyRoute("embeddings", "POST", "/api/embeddings", "input")
+MODELS_ROUTE = ProxyRoute("models", "GET", "/api/models", timeout=30.0, log_usage=False)
+
+# Таблица маршрутов: путь роутера -> маршрут upstream
+PROXY_ROUTES: Dict[str, ProxyRoute] = {
+    "/v1/chat/completions": CHAT_ROUTE,
+    "/v1/completions": ProxyRoute("completions", "POST", "/api/completions", "prompt"),
+    "/v1/embeddings": EMBEDDINGS_ROUTE,
+    "/v1/models": MODELS_ROUTE,
+    # Исторические пути
+    "/api/deepseek/chat/completions": CHAT_ROUTE,
+    "/api/deepseek/models": MODELS_ROUTE,
+}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Общий AsyncClient с keep-alive соединениями к upstream"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _connect_tracer(backend_url: str) -> Callable:
+    """Trace-хук httpcore: время установления TCP-соединения с backend"""
+    started = None
+
+    async def trace(event: str, info: dict):
+        nonlocal started
+        if event == "connection.connect_tcp.started":
+            started = time.perf_counter()
+        elif event == "connection.connect_tcp.complete" and started is not None:
+            adaptive_timeouts.observe_connect(backend_url, time.perf_counter() - started)
+
+    return trace
+
+
+def _response_headers(upstream: httpx.Response) -> Dict[str, str]:
+    return {name: upstream.headers[name] for name in PASSTHROUGH_HEADERS if name in upstream.headers}
+
+
+def _decode_body(content: bytes, encoding: Optional[str]) -> bytes:
+    if not encoding or encoding == "identity":
+        return content
+    if encoding == "gzip":
+        return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompress(content)
+    if encoding == "br" and brotli is not None:
+        return brotli.decompress(content)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    raise ValueError(f"неизвестная кодировка {encoding}")
+
+
+def usage_from_body(content: bytes, encoding: Optional[str] = None) -> Optional[dict]:
+    """Поле usage из JSON-ответа upstream (None, если его нет или тело не разобрать)"""
+    try:
+        usage = json.loads(_decode_body(content, encoding)).get("usage")
+    except (ValueError, AttributeError, zlib.error):
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+async def report_stream_usage(chunks: AsyncIterator[bytes], on_usage: Callable,
+                              on_first_chunk: Optional[Callable[[], None]] = None) -> AsyncIterator[bytes]:
+    """Передать чанки SSE как есть, запомнив последнее поле usage; в конце потока
+    вызвать on_usage с ним (или с None, если usage не было)"""
+    usage = None
+    tail = b""
+    try:
+        async for chunk in chunks:
+            if on_first_chunk is not None:
+                on_first_chunk()
+                on_first_chunk = None
+            yield chunk
+            if b"\n" not in chunk:
+                tail += chunk
+                continue
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.startswith(b"data:") and b'"usage"' in line:
+                    try:
+                        value = json.loads(line[5:]).get("usage")
+                    except (ValueError, AttributeError):
+                        continue
+                    if isinstance(value, dict):
+                        usage = value
+    finally:
+        on_usage(usage)
+
+
+class _PhaseTimeout(Exception):
+    """Истек таймаут фазы ответа upstream (first_byte / idle)"""
+
+    def __init__(self, phase: str):
+        super().__init__(phase)
+        self.phase = phase
+
+
+async def _timed_chunks(upstream: httpx.Response, route: ProxyRoute, model: str, backend_url: str,
+                        sent: float, limits: TimeoutLimits, stream: bool) -> AsyncIterator[bytes]:
+    """Чанки тела с таймаутами на первый байт и паузу между чанками; замеры идут в адаптивные таймауты.
+    Для потока истекший таймаут завершает поток (клиент получает оборванный ответ), иначе — _PhaseTimeout."""
+    iterator = upstream.aiter_raw().__aiter__()
+    phase = "first_byte"
+    timeout = max(0.001, limits.first_byte - (time.perf_counter() - sent))
+    last = None
+    max_gap = 0.0
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            UPSTREAM_TIMEOUTS.inc(route.name, phase)
+            if stream:
+                return
+            raise _PhaseTimeout(phase)
+        now = time.perf_counter()
+        if last is None:
+            if stream:
+                adaptive_timeouts.observe_first_byte(route.name, model, backend_url, now - sent)
+            phase = "idle"
+            timeout = limits.idle
+        elif now - last > max_gap:
+            max_gap = now - last
+        last = now
+        yield chunk
+    if stream and max_gap > 0:
+        adaptive_timeouts.observe_idle(route.name, model, backend_url, max_gap)
+
+
+async def forward(route: ProxyRoute, body: Optional[bytes] = None, stream: bool = False,
+                  accept_encoding: Optional[str] = None, affinity: Optional[str] = None,
+                  on_usage: Optional[Callable[[Optional[dict]], None]] = None,
+                  on_first_chunk: Optional[Callable[[], None]] = None,
+                  model: Optional[str] = None, max_tokens: Optional[int] = None, cost: int = 1) -> Response:
+    """Отправить запрос в upstream и вернуть ответ без повторной сериализации.
+    on_usage вызывается в конце ответа с полем usage (для потоков — по завершении потока),
+    on_first_chunk — при получении первого чанка тела.
+    model и max_tokens уточняют адаптивные таймауты (см. timeouts.py),
+    cost — оценочная стоимость запроса в токенах для выбора backend (routing.request_cost)."""
+    client = get_client()
+    backend = backend_pool.select(affinity, cost)
+    model = model if isinstance(model, str) else ""
+    limits = adaptive_timeouts.limits(route.name, route.timeout, model, backend.url, stream, max_tokens)
+    # Кодировку ответа выбирает клиент: тело upstream передается ему без перекодирования.
+    # Поток с учетом usage запрашивается без сжатия, чтобы читать события; сжимает его middleware
+    if stream and on_usage is not None:
+        accept_encoding = None
+    headers = {"Accept-Encoding": accept_encoding or "identity"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    # Ожидание ответа (первый байт, паузы между чанками) ограничивается здесь, а не read у httpx:
+    # у фаз разные лимиты, а прерванный по таймауту поток должен завершаться штатно
+    request = client.build_request(
+        route.method,
+        backend.url + route.upstream_path,
+        content=body,
+        headers=headers,
+        timeout=httpx.Timeout(connect=limits.connect, pool=limits.connect, read=None, write=limits.idle),
+        extensions={"trace": _connect_tracer(backend.url)},
+    )
+
+    backend.acquire(cost)
+    sent = time.perf_counter()
+    try:
+        upstream = await asyncio.wait_for(client.send(request, stream=True), limits.first_byte)
+    except asyncio.TimeoutError:
+        backend.release(cost)
+        UPSTREAM_TIMEOUTS.inc(route.name, "first_byte")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Таймаут ожидания ответа DeepSeek API"
+        )
+    except httpx.ConnectTimeout:
+        backend.release(cost)
+        UPSTREAM_TIMEOUTS.inc(route.name, "connect")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Таймаут подключения к DeepSeek API"
+        )
+    except httpx.TimeoutException:
+        backend.release(cost)
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Таймаут при обращении к DeepSeek API"
+        )
+    except httpx.RequestError as e:
+        backend.release(cost)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Ошибка подключения к DeepSeek API: {str(e)}"
+        )
+    except BaseException:
+        # Отмена (обрыв WebSocket, остановка shadow и пакетов) тоже освобождает backend
+        backend.release(cost)
+        raise
+
+    if upstream.status_code != 200:
+        try:
+            await upstream.aread()
+        finally:
+            await upstream.aclose()
+            backend.release(cost)
+        raise HTTPException(
+            status_code=upstream.status_code,
+            detail=f"Ошибка DeepSeek API: {upstream.text}"
+        )
+
+    if stream:
+        # Потоковый ответ (SSE): чанки передаются клиенту по мере поступления,
+        # backend считается занятым до конца потока
+        cleanup = BackgroundTasks()
+        cleanup.add_task(upstream.aclose)
+        cleanup.add_task(backend.release, cost)
+        chunks = _timed_chunks(upstream, route, model, backend.url, sent, limits, stream=True)
+        if on_usage is not None:
+            chunks = report_stream_usage(chunks, on_usage, on_first_chunk)
+        return StreamingResponse(
+            chunks,
+            status_code=upstream.status_code,
+            headers=_response_headers(upstream),
+            background=cleanup,
+        )
+
+    try:
+        # Сырые байты: сжатое upstream тело передается без распаковки
+        parts = []
+        async for chunk in _timed_chunks(upstream, route, model, backend.url, sent, limits, stream=False):
+            if on_first_chunk is not None and not parts:
+                on_first_chunk()
+            parts.append(chunk)
+        content = b"".join(parts)
+    except _PhaseTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Таймаут при получении ответа DeepSeek API"
+        )
+    except httpx.TimeoutException:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Таймаут при обращении к DeepSeek API"
+        )
+    except httpx.RequestError as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Ошибка подключения к DeepSeek API: {str(e)}"
+        )
+    finally:
+        await upstream.aclose()
+        backend.release(cost)
+
+    usage = None
+    if on_usage is not None:
+        usage = usage_from_body(content, upstream.headers.get("content-encoding"))
+        on_usage(usage)
+    adaptive_timeouts.observe_generation(route.name, model, backend.url, time.perf_counter() - sent, usage)
+
+    return Response(content=content, status_code=upstream.status_code, headers=_response_headers(upstream))
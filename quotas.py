@@ -0,0 +1,250 @@
+"""
+WindexRouter - Квоты токенов и запросов
+Счетчики в памяти по ключу и пользователю за день/месяц, фоновая синхронизация с БД
+"""
+
+import asyncio
+import calendar
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import db
+import metrics
+
+logger = logging.getLogger("windexrouter.quotas")
+
+QUOTA_SYNC_INTERVAL = float(os.getenv("QUOTA_SYNC_INTERVAL", "5.0"))
+# Квоты пользователя по умолчанию (0 = без ограничения); переопределяются в таблице quotas
+QUOTA_USER_DAY_TOKENS = int(os.getenv("QUOTA_USER_DAY_TOKENS", "0"))
+QUOTA_USER_MONTH_TOKENS = int(os.getenv("QUOTA_USER_MONTH_TOKENS", "0"))
+QUOTA_USER_DAY_REQUESTS = int(os.getenv("QUOTA_USER_DAY_REQUESTS", "0"))
+QUOTA_USER_MONTH_REQUESTS = int(os.getenv("QUOTA_USER_MONTH_REQUESTS", "0"))
+
+SCOPES = ("key", "user")
+PERIODS = ("day", "month")
+
+QUOTA_REJECTED = metrics.Counter(
+    "windex_quota_rejected_total", "Запросы, отклоненные из-за исчерпанной квоты", ("scope", "period")
+)
+
+Limit = Tuple[int, int]                     # max_tokens, max_requests (0 = без ограничения)
+CounterKey = Tuple[str, str, str, int]      # scope, subject_id, period, window_start
+
+
+class QuotaExceeded:
+    """Какая квота исчерпана и когда она обновится"""
+    __slots__ = ("scope", "period", "resource", "retry_after")
+
+    def __init__(self, scope: str, period: str, resource: str, retry_after: int):
+        self.scope = scope
+        self.period = period
+        self.resource = resource
+        self.retry_after = retry_after
+
+
+def _month_bounds(ts: int) -> Tuple[int, int]:
+    """Начало текущего и следующего месяца (UTC)"""
+    tm = time.gmtime(ts)
+    start = calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+    year, month = (tm.tm_year + 1, 1) if tm.tm_mon == 12 else (tm.tm_year, tm.tm_mon + 1)
+    return start, calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def _load_state(day_start: int, month_start: int):
+    conn = db.connect()
+    try:
+        limits = conn.execute(
+            "SELECT scope, subject_id, period, max_tokens, max_requests FROM quotas"
+        ).fetchall()
+        totals = conn.execute('''
+            SELECT scope, subject_id, period, window_start, tokens, requests FROM usage_rollups
+            WHERE (period = 'day' AND window_start = ?) OR (period = 'month' AND window_start = ?)
+        ''', (day_start, month_start)).fetchall()
+    finally:
+        conn.close()
+    return limits, totals
+
+
+def _write_deltas(rows: List[Tuple[str, str, str, int, int, int]]):
+    conn = db.connect()
+    try:
+        conn.executemany('''
+            INSERT INTO usage_rollups (scope, subject_id, period, window_start, tokens, requests)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (scope, subject_id, period, window_start)
+            DO UPDATE SET tokens = tokens + excluded.tokens, requests = requests + excluded.requests
+        ''', rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class QuotaManager:
+    """Проверка квот без обращения к БД: суммы за окна держатся в памяти.
+
+    Каждый воркер копит свои приращения и периодически дописывает их в usage_rollups,
+    после чего перечитывает общие суммы — так учитываются запросы других воркеров."""
+
+    def __init__(self, sync_interval: float, user_defaults: Dict[str, Limit]):
+        self.sync_interval = sync_interval
+        self.user_defaults = {period: limit for period, limit in user_defaults.items() if any(limit)}
+        self._limits: Dict[Tuple[str, str], Dict[str, Limit]] = {}
+        self._totals: Dict[CounterKey, List[int]] = {}
+        self._pending: Dict[CounterKey, List[int]] = {}
+        self._day_start = 0
+        self._month_start = 0
+        self._month_end = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _windows(self, now: int) -> Dict[str, Tuple[int, int]]:
+        """Начало и конец текущих окон day/month"""
+        day_start = now - now % 86400
+        if now >= self._month_end:
+            self._month_start, self._month_end = _month_bounds(now)
+        return {"day": (day_start, day_start + 86400), "month": (self._month_start, self._month_end)}
+
+    def limits_for(self, scope: str, subject_id: str) -> Dict[str, Limit]:
+        limits = self._limits.get((scope, subject_id))
+        if limits is not None:
+            return limits
+        return self.user_defaults if scope == "user" else {}
+
+    def set_limit(self, scope: str, subject_id: str, period: str, max_tokens: int, max_requests: int):
+        """Применить квоту в этом воркере сразу (остальные увидят ее при синхронизации)"""
+        limits = dict(self.limits_for(scope, subject_id))
+        limits[period] = (max_tokens, max_requests)
+        self._limits[(scope, subject_id)] = limits
+
+    def used(self, scope: str, subject_id: str, period: str, now: Optional[int] = None) -> Tuple[int, int]:
+        window_start = self._windows(now or db.now_ts())[period][0]
+        tokens, requests = self._totals.get((scope, subject_id, period, window_start), (0, 0))
+        return tokens, requests
+
+    def check(self, user_id: str, key_id: str) -> Optional[QuotaExceeded]:
+        """Первая исчерпанная квота ключа или пользователя; None — запрос можно пропустить"""
+        now = db.now_ts()
+        windows = None
+        for scope, subject_id in (("key", key_id), ("user", user_id)):
+            limits = self.limits_for(scope, subject_id)
+            if not limits:
+                continue
+            if windows is None:
+                windows = self._windows(now)
+            for period, (max_tokens, max_requests) in limits.items():
+                window_start, window_end = windows[period]
+                tokens, requests = self._totals.get((scope, subject_id, period, window_start), (0, 0))
+                resource = None
+                if max_tokens and tokens >= max_tokens:
+                    resource = "tokens"
+                elif max_requests and requests >= max_requests:
+                    resource = "requests"
+                if resource is not None:
+                    QUOTA_REJECTED.inc(scope, period)
+                    return QuotaExceeded(scope, period, resource, window_end - now)
+        return None
+
+    def _add(self, user_id: str, key_id: str, tokens: int, requests: int):
+        windows = self._windows(db.now_ts())
+        for scope, subject_id in (("key", key_id), ("user", user_id)):
+            for period in PERIODS:
+                counter_key = (scope, subject_id, period, windows[period][0])
+                for store in (self._totals, self._pending):
+                    values = store.get(counter_key)
+                    if values is None:
+                        store[counter_key] = [tokens, requests]
+                    else:
+                        values[0] += tokens
+                        values[1] += requests
+
+    def record_request(self, user_id: str, key_id: str):
+        self._add(user_id, key_id, 0, 1)
+
+    def record_tokens(self, user_id: str, key_id: str, usage: Optional[dict]):
+        """Учесть токены из поля usage ответа upstream"""
+        if not isinstance(usage, dict):
+            return
+        tokens = usage.get("total_tokens")
+        if tokens is None:
+            tokens = (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        if isinstance(tokens, int) and tokens > 0:
+            self._add(user_id, key_id, tokens, 0)
+
+    def _apply_state(self, limits: Iterable[tuple], totals: Iterable[tuple], day_start: int, month_start: int):
+        loaded: Dict[Tuple[str, str], Dict[str, Limit]] = {}
+        for scope, subject_id, period, max_tokens, max_requests in limits:
+            if scope == "user":
+                loaded.setdefault((scope, subject_id), dict(self.user_defaults))
+            loaded.setdefault((scope, subject_id), {})[period] = (max_tokens or 0, max_requests or 0)
+        self._limits = {
+            subject: {period: limit for period, limit in periods.items() if any(limit)}
+            for subject, periods in loaded.items()
+        }
+
+        # Суммы из БД плюс приращения, которые еще не записаны; прошедшие окна отбрасываются
+        fresh: Dict[CounterKey, List[int]] = {}
+        for scope, subject_id, period, window_start, tokens, requests in totals:
+            fresh[(scope, subject_id, period, window_start)] = [tokens, requests]
+        current = {("day", day_start), ("month", month_start)}
+        for counter_key, (tokens, requests) in list(self._pending.items()):
+            if (counter_key[2], counter_key[3]) not in current:
+                continue
+            values = fresh.setdefault(counter_key, [0, 0])
+            values[0] += tokens
+            values[1] += requests
+        self._totals = fresh
+
+    async def load(self):
+        """Загрузить квоты и суммы текущих окон из usage_rollups"""
+        windows = self._windows(db.now_ts())
+        day_start, month_start = windows["day"][0], windows["month"][0]
+        loop = asyncio.get_running_loop()
+        limits, totals = await loop.run_in_executor(None, _load_state, day_start, month_start)
+        self._apply_state(limits, totals, day_start, month_start)
+
+    async def sync(self):
+        """Дописать приращения в БД и перечитать общие суммы"""
+        loop = asyncio.get_running_loop()
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            rows = [(*counter_key, tokens, requests) for counter_key, (tokens, requests) in pending.items()]
+            try:
+                await loop.run_in_executor(None, _write_deltas, rows)
+            except Exception:
+                logger.exception("Не удалось записать %d счетчиков квот", len(rows))
+                for counter_key, (tokens, requests) in pending.items():
+                    values = self._pending.setdefault(counter_key, [0, 0])
+                    values[0] += tokens
+                    values[1] += requests
+                return
+        await self.load()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Ошибка синхронизации квот")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую синхронизацию и записать остаток приращений"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.sync()
+
+
+quota_manager = QuotaManager(QUOTA_SYNC_INTERVAL, {
+    "day": (QUOTA_USER_DAY_TOKENS, QUOTA_USER_DAY_REQUESTS),
+    "month": (QUOTA_USER_MONTH_TOKENS, QUOTA_USER_MONTH_REQUESTS),
+})
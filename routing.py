@@ -0,0 +1,180 @@
+"""
+WindexRouter - Выбор backend для запросов
+Пул upstream серверов и консистентное хеширование по префиксу диалога
+"""
+
+import bisect
+import hashlib
+import json
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+import metrics
+from token_count import prompt_tokens
+
+
+def parse_backends(value: str) -> List[str]:
+    return [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+
+
+# Список backend через запятую; по умолчанию единственный DEEPSEEK_API_BASE
+DEEPSEEK_BACKENDS = parse_backends(
+    os.getenv("DEEPSEEK_BACKENDS", os.getenv("DEEPSEEK_API_BASE", "http://localhost:1103"))
+)
+
+# Липкая маршрутизация по префиксу messages для повторного использования KV-кэша
+STICKY_ROUTING = os.getenv("STICKY_ROUTING", "0") == "1"
+# Сколько первых реплик (помимо системных сообщений) входит в ключ префикса
+STICKY_PREFIX_TURNS = int(os.getenv("STICKY_PREFIX_TURNS", "1"))
+# Backend считается перегруженным, если его нагрузка выше средней в STICKY_LOAD_FACTOR раз
+STICKY_LOAD_FACTOR = float(os.getenv("STICKY_LOAD_FACTOR", "1.25"))
+RING_VIRTUAL_NODES = int(os.getenv("RING_VIRTUAL_NODES", "100"))
+# Учет нагрузки в оценочных токенах (промпт + ответ) вместо числа запросов
+TOKEN_AWARE_ROUTING = os.getenv("TOKEN_AWARE_ROUTING", "1") == "1"
+# Токены ответа в оценке стоимости: max_tokens запроса, но не больше этого значения
+ROUTING_COMPLETION_TOKENS = int(os.getenv("ROUTING_COMPLETION_TOKENS", "256"))
+
+BACKEND_IN_FLIGHT = metrics.Gauge("windex_backend_in_flight", "Запросы в обработке на backend", ("backend",))
+BACKEND_TOKENS_IN_FLIGHT = metrics.Gauge(
+    "windex_backend_tokens_in_flight", "Оценочные токены запросов в обработке на backend", ("backend",)
+)
+STICKY_DECISIONS = metrics.Counter(
+    "windex_sticky_routing_total", "Решения липкой маршрутизации", ("result",)
+)
+
+
+class Backend:
+    """Upstream сервер и его текущая нагрузка"""
+    __slots__ = ("url", "in_flight", "tokens_in_flight")
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.tokens_in_flight = 0
+
+    @property
+    def load(self) -> int:
+        return self.tokens_in_flight if TOKEN_AWARE_ROUTING else self.in_flight
+
+    def acquire(self, cost: int = 1):
+        self.in_flight += 1
+        self.tokens_in_flight += cost
+        BACKEND_IN_FLIGHT.set(self.in_flight, self.url)
+        BACKEND_TOKENS_IN_FLIGHT.set(self.tokens_in_flight, self.url)
+
+    def release(self, cost: int = 1):
+        self.in_flight -= 1
+        self.tokens_in_flight -= cost
+        BACKEND_IN_FLIGHT.set(self.in_flight, self.url)
+        BACKEND_TOKENS_IN_FLIGHT.set(self.tokens_in_flight, self.url)
+
+
+def request_cost(request_data: Optional[Dict[str, Any]]) -> int:
+    """Оценочная стоимость запроса в токенах: промпт плюс ожидаемая длина ответа"""
+    if not isinstance(request_data, dict):
+        return 1
+    if "messages" not in request_data and "prompt" not in request_data:
+        # Эмбеддинги и прочие запросы без генерации: только входные токены
+        return max(1, prompt_tokens(request_data))
+    max_tokens = request_data.get("max_tokens")
+    if isinstance(max_tokens, int) and max_tokens > 0:
+        completion = min(max_tokens, ROUTING_COMPLETION_TOKENS)
+    else:
+        completion = ROUTING_COMPLETION_TOKENS
+    return prompt_tokens(request_data) + completion
+
+
+def _ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def prefix_key(request_data: Dict[str, Any], turns: Optional[int] = None) -> Optional[str]:
+    """Ключ префикса диалога: модель, системные сообщения и первые N реплик"""
+    if turns is None:
+        turns = STICKY_PREFIX_TURNS
+    messages = request_data.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return None
+
+    prefix: List[Any] = []
+    taken = 0
+    for message in messages:
+        if isinstance(message, dict) and message.get("role") == "system":
+            prefix.append(message)
+            continue
+        if taken >= turns:
+            break
+        prefix.append(message)
+        taken += 1
+
+    raw = json.dumps([request_data.get("model"), prefix], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class BackendPool:
+    """Пул backend: наименее загруженный или консистентный хеш с ограничением нагрузки"""
+
+    def __init__(self, urls: List[str], load_factor: float, virtual_nodes: int):
+        self.load_factor = load_factor
+        self.virtual_nodes = virtual_nodes
+        self.backends: Dict[str, Backend] = {}
+        self._ring: List[int] = []
+        self._ring_owners: List[Backend] = []
+        self.set_backends(urls)
+
+    def set_backends(self, urls: List[str]):
+        """Заменить список backend. Ключи остальных backend на кольце не перемещаются."""
+        backends = {url: self.backends.get(url) or Backend(url) for url in urls}
+        points = sorted(
+            (_ring_hash(f"{url}#{replica}"), url)
+            for url in backends
+            for replica in range(self.virtual_nodes)
+        )
+        self._ring = [point for point, _ in points]
+        self._ring_owners = [backends[url] for _, url in points]
+        self.backends = backends
+
+    @property
+    def in_flight(self) -> int:
+        """Запросы upstream в обработке на всех backend"""
+        return sum(backend.in_flight for backend in self.backends.values())
+
+    def least_loaded(self) -> Backend:
+        return min(self.backends.values(), key=lambda backend: (backend.load, backend.in_flight))
+
+    def _load_limit(self, cost: int) -> int:
+        total = sum(backend.load for backend in self.backends.values()) + cost
+        return max(cost, math.ceil(total * self.load_factor / len(self.backends)))
+
+    def select(self, affinity: Optional[str] = None, cost: int = 1) -> Backend:
+        """Backend для запроса; affinity — ключ префикса для липкой маршрутизации,
+        cost — оценочная стоимость запроса в токенах (см. request_cost)"""
+        if not self.backends:
+            raise RuntimeError("Не настроен ни один backend DeepSeek")
+        if not TOKEN_AWARE_ROUTING:
+            cost = 1
+        if affinity is None or len(self.backends) == 1:
+            return self.least_loaded()
+
+        # Консистентное хеширование с ограниченной нагрузкой: идем по кольцу
+        # от точки ключа, пропуская backend, нагрузка которого с этим запросом превысит лимит
+        limit = self._load_limit(cost)
+        start = bisect.bisect(self._ring, _ring_hash(affinity)) % len(self._ring)
+        seen = set()
+        for offset in range(len(self._ring)):
+            backend = self._ring_owners[(start + offset) % len(self._ring)]
+            if backend.url in seen:
+                continue
+            if backend.load + cost <= limit or backend.in_flight == 0:
+                STICKY_DECISIONS.inc("primary" if not seen else "fallback")
+                return backend
+            seen.add(backend.url)
+            if len(seen) == len(self.backends):
+                break
+
+        STICKY_DECISIONS.inc("overloaded")
+        return self.least_loaded()
+
+
+backend_pool = BackendPool(DEEPSEEK_BACKENDS, STICKY_LOAD_FACTOR, RING_VIRTUAL_NODES)
@@ -0,0 +1,170 @@
+"""
+WindexRouter - Подписанные токены сессий
+Токен несет данные пользователя и срок действия, проверяется по HMAC без чтения БД.
+Выход и деактивация отзывают токены через список отзыва, общий для воркеров.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Dict, Optional
+
+import db
+
+logger = logging.getLogger("windexrouter.sessions")
+
+# Режим токенов сессий: "db" — таблица tokens, "signed" — подписанные токены без БД
+SESSION_TOKENS = os.getenv("SESSION_TOKENS", "db")
+SIGNED_SESSIONS = SESSION_TOKENS == "signed"
+# Как часто воркер подтягивает отзывы, сделанные другими воркерами (сек)
+SESSION_REVOCATION_SYNC_INTERVAL = float(os.getenv("SESSION_REVOCATION_SYNC_INTERVAL", "2.0"))
+
+SYNC_OVERLAP_MS = 60_000
+
+SECRET_SETTING = "session_secret"
+TOKEN_PREFIX = "ws1."
+
+_secret: Optional[bytes] = None
+
+
+def generate_secret() -> str:
+    return secrets.token_hex(32)
+
+
+def get_secret() -> bytes:
+    """Секрет подписи: переменная SESSION_SECRET или значение из app_settings"""
+    global _secret
+    if _secret is None:
+        value = os.getenv("SESSION_SECRET")
+        if not value:
+            conn = db.connect()
+            row = conn.execute('SELECT value FROM app_settings WHERE key = ?', (SECRET_SETTING,)).fetchone()
+            conn.close()
+            if not row:
+                raise RuntimeError("Секрет подписи сессий не найден: задайте SESSION_SECRET")
+            value = row[0]
+        _secret = value.encode('utf-8')
+    return _secret
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(get_secret(), payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue_token(user_id: str, username: str, email: str, created_at: int, expires_at: int) -> str:
+    """Подписанный токен: ws1.<данные>.<подпись>"""
+    claims = {"sub": user_id, "usr": username, "eml": email, "cat": created_at,
+              "iat": now_ms(), "exp": expires_at}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":"), ensure_ascii=False).encode('utf-8'))
+    return f"{TOKEN_PREFIX}{payload}.{_sign(payload)}"
+
+
+class RevocationList:
+    """Для каждого пользователя — момент (мс), раньше которого выданные токены недействительны"""
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self._revoked_before: Dict[str, int] = {}
+        self._synced_until = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def is_revoked(self, user_id: str, issued_at: int) -> bool:
+        revoked_before = self._revoked_before.get(user_id)
+        return revoked_before is not None and issued_at <= revoked_before
+
+    def revoke_user(self, user_id: str, token_lifetime: int):
+        """Отозвать все выданные пользователю токены (в этом воркере сразу, в остальных — при синхронизации)"""
+        revoked_before = now_ms()
+        conn = db.connect()
+        try:
+            conn.execute('''
+                INSERT INTO session_revocations (user_id, revoked_before, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    revoked_before = excluded.revoked_before, expires_at = excluded.expires_at
+            ''', (user_id, revoked_before, db.now_ts() + token_lifetime))
+            conn.commit()
+        finally:
+            conn.close()
+        self._revoked_before[user_id] = max(revoked_before, self._revoked_before.get(user_id, 0))
+
+    def _fetch(self, since: int):
+        conn = db.connect()
+        try:
+            # Отзывы, пережившие срок действия всех затронутых токенов, больше не нужны
+            conn.execute('DELETE FROM session_revocations WHERE expires_at < ?', (db.now_ts(),))
+            conn.commit()
+            return conn.execute(
+                'SELECT user_id, revoked_before FROM session_revocations WHERE revoked_before > ?', (since,)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    async def sync(self):
+        """Подтянуть новые отзывы из БД (инкрементально по revoked_before)"""
+        loop = asyncio.get_running_loop()
+        # Перекрытие окна: запись, зафиксированная позже более свежей, не теряется
+        since = max(0, self._synced_until - SYNC_OVERLAP_MS)
+        rows = await loop.run_in_executor(None, self._fetch, since)
+        for user_id, revoked_before in rows:
+            if revoked_before > self._revoked_before.get(user_id, 0):
+                self._revoked_before[user_id] = revoked_before
+            self._synced_until = max(self._synced_until, revoked_before)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Ошибка синхронизации списка отзыва сессий")
+
+    async def start(self):
+        if self._task is None:
+            await self.sync()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+revocations = RevocationList(SESSION_REVOCATION_SYNC_INTERVAL)
+
+
+def verify_token(token: str) -> Optional[dict]:
+    """Данные токена, если подпись верна, срок не истек и токен не отозван"""
+    if not token.startswith(TOKEN_PREFIX):
+        return None
+    payload, _, signature = token[len(TOKEN_PREFIX):].partition(".")
+    try:
+        if not signature or not hmac.compare_digest(signature.encode('ascii'), _sign(payload).encode('ascii')):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if claims["exp"] <= db.now_ts() or revocations.is_revoked(claims["sub"], claims["iat"]):
+        return None
+    return claims
@@ -0,0 +1,178 @@
+"""
+WindexRouter - Теневой трафик
+Выборка запросов чата дублируется на кандидатный backend; его ответ отбрасывается,
+сравниваются задержка, время до первого байта и число токенов
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Optional, Set
+
+import httpx
+
+import metrics
+import proxy
+from proxy import ProxyRoute
+
+logger = logging.getLogger("windexrouter.shadow")
+
+# Теневой backend (пусто = зеркалирование выключено) и доля зеркалируемых запросов
+SHADOW_BACKEND = os.getenv("SHADOW_BACKEND", "").rstrip("/")
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.0"))
+# Больше этого числа теневых запросов одновременно не отправляется: лишние пропускаются
+SHADOW_MAX_CONCURRENCY = int(os.getenv("SHADOW_MAX_CONCURRENCY", "8"))
+SHADOW_TIMEOUT = float(os.getenv("SHADOW_TIMEOUT", "120"))
+# Модель для теневых запросов (пусто = как в исходном запросе)
+SHADOW_MODEL = os.getenv("SHADOW_MODEL", "")
+
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+_DELTA_BUCKETS = (-10.0, -5.0, -2.0, -1.0, -0.5, -0.1, 0.0, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0)
+_TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+SHADOW_REQUESTS = metrics.Counter("windex_shadow_requests_total", "Теневые запросы по результату", ("result",))
+SHADOW_LATENCY = metrics.Histogram(
+    "windex_shadow_latency_seconds", "Задержка основного и теневого backend на зеркалированных запросах",
+    ("target", "phase"), buckets=_LATENCY_BUCKETS,
+)
+SHADOW_LATENCY_DELTA = metrics.Histogram(
+    "windex_shadow_latency_delta_seconds", "Разница полной задержки: теневой минус основной",
+    buckets=_DELTA_BUCKETS,
+)
+SHADOW_TOKENS = metrics.Histogram(
+    "windex_shadow_completion_tokens", "Токены ответа основного и теневого backend",
+    ("target",), buckets=_TOKEN_BUCKETS,
+)
+
+
+class ShadowSample:
+    """Замеры одного зеркалированного запроса: основной и теневой ответ"""
+    __slots__ = ("started", "primary_total", "shadow_total")
+
+    def __init__(self, started: float):
+        self.started = started
+        self.primary_total: Optional[float] = None
+        self.shadow_total: Optional[float] = None
+
+    def _observe(self, target: str, phase: str):
+        elapsed = time.perf_counter() - self.started
+        SHADOW_LATENCY.observe(elapsed, target, phase)
+        return elapsed
+
+    def _observe_usage(self, target: str, usage: Optional[dict]):
+        if isinstance(usage, dict) and isinstance(usage.get("completion_tokens"), int):
+            SHADOW_TOKENS.observe(usage["completion_tokens"], target)
+
+    def _compare(self):
+        if self.primary_total is not None and self.shadow_total is not None:
+            SHADOW_LATENCY_DELTA.observe(self.shadow_total - self.primary_total)
+
+    def primary_first_chunk(self):
+        self._observe("primary", "ttfb")
+
+    def primary_done(self, usage: Optional[dict]):
+        self.primary_total = self._observe("primary", "total")
+        self._observe_usage("primary", usage)
+        self._compare()
+
+    def shadow_first_chunk(self):
+        self._observe("shadow", "ttfb")
+
+    def shadow_done(self, usage: Optional[dict]):
+        self.shadow_total = self._observe("shadow", "total")
+        self._observe_usage("shadow", usage)
+        self._compare()
+
+
+class ShadowMirror:
+    """Асинхронное зеркалирование выборки запросов на теневой backend"""
+
+    def __init__(self, backend: str, sample_rate: float, max_concurrency: int, timeout: float, model: str):
+        self.backend = backend
+        self.sample_rate = sample_rate
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.model = model
+        self._tasks: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.backend) and self.sample_rate > 0 and self.max_concurrency > 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Отдельный пул соединений: теневые запросы не занимают соединения основного трафика
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+        return self._client
+
+    def mirror(self, route: ProxyRoute, body: Optional[bytes], stream: bool) -> Optional[ShadowSample]:
+        """Отправить копию запроса в фоне, если он попал в выборку. Никогда не ждет."""
+        if not self.enabled or body is None or random.random() >= self.sample_rate:
+            return None
+        if len(self._tasks) >= self.max_concurrency:
+            SHADOW_REQUESTS.inc("dropped")
+            return None
+
+        sample = ShadowSample(time.perf_counter())
+        task = asyncio.get_running_loop().create_task(self._send(route, body, stream, sample))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return sample
+
+    async def _send(self, route: ProxyRoute, body: bytes, stream: bool, sample: ShadowSample):
+        if self.model:
+            data = json.loads(body)
+            data["model"] = self.model
+            body = json.dumps(data).encode("utf-8")
+        try:
+            client = self._get_client()
+            request = client.build_request(
+                route.method, self.backend + route.upstream_path, content=body,
+                headers={"Content-Type": "application/json", "Accept-Encoding": "identity"},
+            )
+            upstream = await client.send(request, stream=True)
+            try:
+                if upstream.status_code != 200:
+                    SHADOW_REQUESTS.inc(f"http_{upstream.status_code}")
+                    return
+                if stream:
+                    # Тело отбрасывается, из событий SSE берется только usage
+                    async for _ in proxy.report_stream_usage(upstream.aiter_raw(), sample.shadow_done,
+                                                             sample.shadow_first_chunk):
+                        pass
+                else:
+                    parts = []
+                    async for chunk in upstream.aiter_raw():
+                        if not parts:
+                            sample.shadow_first_chunk()
+                        parts.append(chunk)
+                    sample.shadow_done(proxy.usage_from_body(b"".join(parts)))
+            finally:
+                await upstream.aclose()
+            SHADOW_REQUESTS.inc("ok")
+        except httpx.TimeoutException:
+            SHADOW_REQUESTS.inc("timeout")
+        except Exception as e:
+            SHADOW_REQUESTS.inc("error")
+            logger.debug("Теневой запрос не удался: %s", e)
+
+    async def stop(self):
+        """Прервать незавершенные теневые запросы и закрыть пул соединений"""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+shadow_mirror = ShadowMirror(SHADOW_BACKEND, SHADOW_SAMPLE_RATE, SHADOW_MAX_CONCURRENCY, SHADOW_TIMEOUT, SHADOW_MODEL)
@@ -41,6 +41,16 @@ def run_fastapi():
         "--reload"
     ])
 
+def stop_fastapi(process):
+    """Дождаться штатной остановки FastAPI, после периода ожидания завершить принудительно"""
+    grace_period = float(os.getenv("DRAIN_GRACE_PERIOD", "30")) + 5
+    try:
+        process.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        print("⚠️ FastAPI не остановился вовремя, принудительное завершение")
+        process.kill()
+        process.wait()
+
 def run_streamlit():
     """Запуск Streamlit приложения"""
     print("🌐 Запуск Streamlit приложения...")
@@ -124,12 +134,13 @@ def main():
     
     def signal_handler(sig, frame):
         print("\n🛑 Остановка всех сервисов...")
+        # FastAPI получает SIGTERM и дожидается запросов в обработке (DRAIN_GRACE_PERIOD)
         fastapi_process.terminate()
         streamlit_process.terminate()
         ngrok_streamlit_process.terminate()
         ngrok_fastapi_process.terminate()
         
-        fastapi_process.wait()
+        stop_fastapi(fastapi_process)
         streamlit_process.wait()
         ngrok_streamlit_process.wait()
         ngrok_fastapi_process.wait()
@@ -2,7 +2,7 @@ import streamlit as st
 import requests
 import pandas as pd
 from datetime import datetime
-import json
+from requests.adapters import HTTPAdapter
 
 # Настройки
 st.set_page_config(
@@ -13,13 +13,33 @@ st.set_page_config(
 
 # Конфигурация API
 API_BASE_URL = "http://localhost:1101"
+REQUEST_TIMEOUT = 10
+
+# Время жизни кэша ответов API (сек) и размер страницы списка ключей
+USER_CACHE_TTL = 60
+KEYS_CACHE_TTL = 15
+KEYS_PAGE_SIZE = 20
+
+# Общая HTTP-сессия: соединения с API переиспользуются между перезапусками скрипта
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Content-Type"] = "application/json"
+    return session
 
 # Заголовки для запросов
-def get_headers():
-    headers = {"Content-Type": "application/json"}
-    if "access_token" in st.session_state:
-        headers["Authorization"] = f"Bearer {st.session_state.access_token}"
-    return headers
+def get_headers(token=None):
+    token = token or st.session_state.get("access_token")
+    if token:
+        return {"Authorization": f"Bearer {token}"}
+    return {}
+
+def format_timestamp(value):
+    """ISO-дата из API в формат для отображения"""
+    return datetime.fromisoformat(value).strftime("%d.%m.%Y %H:%M") if value else "Бессрочно"
 
 # Функции для работы с аутентификацией
 def register_user(username, email, password):
@@ -32,7 +52,7 @@ def register_user(username, email, password):
     }
     
     try:
-        response = requests.post(url, json=data, headers=get_headers())
+        response = get_session().post(url, json=data, timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
             return response.json()
         else:
@@ -50,7 +70,7 @@ def login_user(username, password):
     }
     
     try:
-        response = requests.post(url, json=data, headers=get_headers())
+        response = get_session().post(url, json=data, timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
             return response.json()
         else:
@@ -59,16 +79,17 @@ def login_user(username, password):
     except Exception as e:
         return {"error": f"Ошибка подключения к API: {e}"}
 
+# Ответы кэшируются по токену; ошибки выбрасываются и поэтому не кэшируются
+@st.cache_data(ttl=USER_CACHE_TTL, show_spinner=False)
+def fetch_current_user(token):
+    response = get_session().get(f"{API_BASE_URL}/api/auth/me", headers=get_headers(token), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
 def get_current_user():
     """Получение информации о текущем пользователе"""
-    url = f"{API_BASE_URL}/api/auth/me"
-    
     try:
-        response = requests.get(url, headers=get_headers())
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return None
+        return fetch_current_user(st.session_state.access_token)
     except Exception as e:
         return None
 
@@ -77,8 +98,9 @@ def logout_user():
     url = f"{API_BASE_URL}/api/auth/logout"
     
     try:
-        response = requests.post(url, headers=get_headers())
+        response = get_session().post(url, headers=get_headers(), timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
+            fetch_current_user.clear(st.session_state.access_token)
             return True
         else:
             return False
@@ -86,6 +108,10 @@ def logout_user():
         return False
 
 # Функции для работы с API ключами
+def invalidate_keys():
+    """Сбросить кэш списка ключей текущего пользователя после изменений"""
+    st.session_state.keys_version = st.session_state.get("keys_version", 0) + 1
+
 def create_api_key(name, expires_days=None):
     """Создать новый API ключ"""
     url = f"{API_BASE_URL}/api/keys"
@@ -94,8 +120,9 @@ def create_api_key(name, expires_days=None):
         data["expires_in_days"] = expires_days
 
     try:
-        response = requests.post(url, json=data, headers=get_headers())
+        response = get_session().post(url, json=data, headers=get_headers(), timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
+            invalidate_keys()
             return response.json()
         else:
             error_data = response.json() if response.content else {"detail": "Ошибка создания ключа"}
@@ -103,24 +130,40 @@ def create_api_key(name, expires_days=None):
     except Exception as e:
         return {"error": f"Ошибка подключения к API: {e}"}
 
-def get_api_keys():
-    """Получить все API ключи пользователя"""
-    url = f"{API_BASE_URL}/api/keys"
+# version входит в ключ кэша: после изменений запрашивается свежая страница
+@st.cache_data(ttl=KEYS_CACHE_TTL, show_spinner=False)
+def fetch_api_keys(token, version, cursor=None, status=None, name=None, limit=KEYS_PAGE_SIZE):
+    params = {"limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    if status:
+        params["status"] = status
+    if name:
+        params["name"] = name
+    response = get_session().get(f"{API_BASE_URL}/api/keys", params=params, headers=get_headers(token), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    page = response.json()
+    # Даты форматируются один раз при загрузке страницы, а не при каждом рендере
+    for key in page["data"]:
+        key["created_display"] = format_timestamp(key["created_at"])
+        key["expires_display"] = format_timestamp(key["expires_at"])
+    return page
+
+def get_api_keys(cursor=None, status=None, name=None):
+    """Получить страницу API ключей пользователя"""
     try:
-        response = requests.get(url, headers=get_headers())
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return []
+        return fetch_api_keys(st.session_state.access_token, st.session_state.get("keys_version", 0),
+                              cursor, status, name)
     except Exception as e:
-        return []
+        return {"data": [], "next_cursor": None}
 
 def delete_api_key(key_id):
     """Удалить API ключ"""
     url = f"{API_BASE_URL}/api/keys/{key_id}"
     try:
-        response = requests.delete(url, headers=get_headers())
+        response = get_session().delete(url, headers=get_headers(), timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
+            invalidate_keys()
             return True
         else:
             return False
@@ -131,8 +174,9 @@ def toggle_api_key(key_id):
     """Включить/выключить API ключ"""
     url = f"{API_BASE_URL}/api/keys/{key_id}/toggle"
     try:
-        response = requests.put(url, headers=get_headers())
+        response = get_session().put(url, headers=get_headers(), timeout=REQUEST_TIMEOUT)
         if response.status_code == 200:
+            invalidate_keys()
             return True
         else:
             return False
@@ -243,104 +287,111 @@ def user_dashboard():
             if "error" in result:
                 st.error(f"❌ {result['error']}")
             else:
-                st.success("✅ Ключ успешно создан!")
-                st.code(result["key"], language="text")
+                # Полный ключ возвращается только при создании: сохраняем его до следующего показа
+                st.session_state.new_api_key = result["key"]
                 st.rerun()
         else:
             st.error("❌ Пожалуйста, введите название ключа")
 
+    new_api_key = st.session_state.pop("new_api_key", None)
+    if new_api_key:
+        st.success("✅ Ключ успешно создан! Скопируйте его сейчас — позже он не будет показан.")
+        st.code(new_api_key, language="text")
+
     st.divider()
 
     # Список существующих ключей
     st.header("📋 Мои API ключи")
 
-    keys = get_api_keys()
+    # Фильтры выполняются на стороне API
+    status_labels = {"Все": None, "Активные": "active", "Неактивные": "inactive", "Истекшие": "expired"}
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        status_label = st.selectbox("Статус", list(status_labels))
+    with col2:
+        name_filter = st.text_input("Поиск по названию", placeholder="Часть названия ключа").strip()
+
+    # Курсоры просмотренных страниц; смена фильтра начинает с первой страницы
+    filters = (status_label, name_filter)
+    if st.session_state.get("keys_filters") != filters:
+        st.session_state.keys_filters = filters
+        st.session_state.keys_cursors = [None]
+    cursors = st.session_state.keys_cursors
+
+    page = get_api_keys(cursors[-1], status_labels[status_label], name_filter or None)
+    keys = page["data"]
 
     if keys:
-        # Преобразование в DataFrame для удобного отображения
-        df_data = []
-        for key in keys:
-            df_data.append({
-                "ID": key["id"],
-                "Название": key["name"],
-                "Ключ": key["key"],
-                "Создан": datetime.fromisoformat(key["created_at"]).strftime("%d.%m.%Y %H:%M"),
-                "Истекает": datetime.fromisoformat(key["expires_at"]).strftime("%d.%m.%Y %H:%M") if key["expires_at"] else "Бессрочно",
-                "Активен": "✅ Да" if key["is_active"] else "❌ Нет"
-            })
-
-        df = pd.DataFrame(df_data)
+        df = pd.DataFrame({
+            "ID": [key["id"] for key in keys],
+            "Название": [key["name"] for key in keys],
+            "Ключ": [f"{key['key_prefix']}…" for key in keys],
+            "Создан": [key["created_display"] for key in keys],
+            "Истекает": [key["expires_display"] for key in keys],
+            "Активен": ["✅ Да" if key["is_active"] else "❌ Нет" for key in keys],
+        })
 
         # Отображение таблицы
         st.dataframe(
             df,
             column_config={
-                "Ключ": st.column_config.TextColumn("Ключ", width="large"),
+                "Ключ": st.column_config.TextColumn("Ключ", width="medium"),
                 "ID": st.column_config.TextColumn("ID", width="small")
             },
             hide_index=True,
             use_container_width=True
         )
 
-        # Управление ключами
-        st.header("⚙️ Управление ключами")
+        # Навигация по страницам
+        col1, col2, col3 = st.columns([1, 1, 4])
+        with col1:
+            if st.button("⬅️ Назад", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            if st.button("Далее ➡️", disabled=not page["next_cursor"]):
+                cursors.append(page["next_cursor"])
+                st.rerun()
+        with col3:
+            st.caption(f"Страница {len(cursors)}")
 
-        # Группировка ключей по состоянию
-        active_keys = [k for k in keys if k["is_active"]]
-        inactive_keys = [k for k in keys if not k["is_active"]]
-
-        if active_keys:
-            st.subheader("Активные ключи")
-            for key in active_keys:
-                col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
-
-                with col1:
-                    st.write(f"**{key['name']}**")
-                    st.code(key["key"], language="text")
-
-                with col2:
-                    st.write(f"Создан: {datetime.fromisoformat(key['created_at']).strftime('%d.%m.%Y %H:%M')}")
-                    if key["expires_at"]:
-                        st.write(f"Истекает: {datetime.fromisoformat(key['expires_at']).strftime('%d.%m.%Y %H:%M')}")
-
-                with col3:
-                    if st.button("🚫 Деактивировать", key=f"deactivate_{key['id']}"):
-                        if toggle_api_key(key["id"]):
-                            st.success("Ключ деактивирован")
-                            st.rerun()
-
-                with col4:
-                    if st.button("🗑️ Удалить", key=f"delete_active_{key['id']}", type="secondary"):
-                        if delete_api_key(key["id"]):
-                            st.success("Ключ удален")
-                            st.rerun()
-
-        if inactive_keys:
-            st.subheader("Неактивные ключи")
-            for key in inactive_keys:
-                col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
-
-                with col1:
-                    st.write(f"**{key['name']}** (неактивен)")
-                    st.code(key["key"], language="text")
-
-                with col2:
-                    st.write(f"Создан: {datetime.fromisoformat(key['created_at']).strftime('%d.%m.%Y %H:%M')}")
-                    if key["expires_at"]:
-                        st.write(f"Истекает: {datetime.fromisoformat(key['expires_at']).strftime('%d.%m.%Y %H:%M')}")
-
-                with col3:
-                    if st.button("✅ Активировать", key=f"activate_{key['id']}"):
-                        if toggle_api_key(key["id"]):
-                            st.success("Ключ активирован")
-                            st.rerun()
-
-                with col4:
-                    if st.button("🗑️ Удалить", key=f"delete_inactive_{key['id']}", type="secondary"):
-                        if delete_api_key(key["id"]):
-                            st.success("Ключ удален")
-                            st.rerun()
+        # Управление ключами: один набор элементов для выбранного ключа
+        st.header("⚙️ Управление ключами")
 
+        keys_by_id = {key["id"]: key for key in keys}
+        selected_id = st.selectbox(
+            "Ключ",
+            list(keys_by_id),
+            format_func=lambda key_id: f"{keys_by_id[key_id]['name']} ({keys_by_id[key_id]['key_prefix']}…)"
+                                       f"{'' if keys_by_id[key_id]['is_active'] else ' — неактивен'}",
+        )
+        selected = keys_by_id[selected_id]
+
+        col1, col2, col3 = st.columns([3, 1, 1])
+
+        with col1:
+            st.write(f"Создан: {selected['created_display']}")
+            if selected["expires_at"]:
+                st.write(f"Истекает: {selected['expires_display']}")
+
+        with col2:
+            toggle_label = "🚫 Деактивировать" if selected["is_active"] else "✅ Активировать"
+            if st.button(toggle_label, key=f"toggle_{selected_id}"):
+                if toggle_api_key(selected_id):
+                    st.success("Ключ деактивирован" if selected["is_active"] else "Ключ активирован")
+                    st.rerun()
+
+        with col3:
+            if st.button("🗑️ Удалить", key=f"delete_{selected_id}", type="secondary"):
+                if delete_api_key(selected_id):
+                    st.success("Ключ удален")
+                    st.rerun()
+
+    elif len(cursors) > 1 or status_labels[status_label] or name_filter:
+        st.info("📭 Ключи не найдены")
+        if len(cursors) > 1 and st.button("⬅️ Назад"):
+            cursors.pop()
+            st.rerun()
     else:
         st.info("📭 Пока нет созданных API ключей. Создайте первый ключ выше!")
 
@@ -0,0 +1,167 @@
+"""
+WindexRouter - Адаптивные таймауты upstream
+Лимиты на подключение, первый байт и паузу между чанками считаются из скользящих
+перцентилей наблюдаемых задержек по маршруту, модели и backend
+"""
+
+import os
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+# 0 — фиксированные таймауты маршрутов (ProxyRoute.timeout), как раньше
+ADAPTIVE_TIMEOUTS = os.getenv("ADAPTIVE_TIMEOUTS", "1") == "1"
+# Лимит = перцентиль * множитель, в пределах [нижняя граница, TIMEOUT_MAX]
+TIMEOUT_PERCENTILE = float(os.getenv("TIMEOUT_PERCENTILE", "0.99"))
+TIMEOUT_MULTIPLIER = float(os.getenv("TIMEOUT_MULTIPLIER", "3.0"))
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "20"))
+TIMEOUT_WINDOW = int(os.getenv("TIMEOUT_WINDOW", "256"))
+# Предел числа рядов каждой фазы: модель приходит от клиента, давно не встречавшиеся ряды вытесняются
+TIMEOUT_MAX_SERIES = int(os.getenv("TIMEOUT_MAX_SERIES", "1024"))
+TIMEOUT_CONNECT_DEFAULT = float(os.getenv("TIMEOUT_CONNECT_DEFAULT", "10"))
+TIMEOUT_CONNECT_MIN = float(os.getenv("TIMEOUT_CONNECT_MIN", "1"))
+TIMEOUT_FIRST_BYTE_MIN = float(os.getenv("TIMEOUT_FIRST_BYTE_MIN", "5"))
+TIMEOUT_IDLE_MIN = float(os.getenv("TIMEOUT_IDLE_MIN", "5"))
+TIMEOUT_MAX = float(os.getenv("TIMEOUT_MAX", "600"))
+# max_tokens, если клиент его не указал (для оценки длительности генерации)
+TIMEOUT_DEFAULT_MAX_TOKENS = int(os.getenv("TIMEOUT_DEFAULT_MAX_TOKENS", "1024"))
+
+UPSTREAM_TIMEOUTS = metrics.Counter(
+    "windex_upstream_timeouts_total", "Срабатывания таймаутов upstream по фазам", ("route", "phase")
+)
+
+
+class RollingPercentile:
+    """Перцентиль по последним N наблюдениям; сортировка пересчитывается не на каждое наблюдение"""
+    __slots__ = ("_values", "_sorted", "_stale")
+
+    RESORT_EVERY = 16
+
+    def __init__(self, window: int):
+        self._values = deque(maxlen=window)
+        self._sorted: list = []
+        self._stale = 0
+
+    def add(self, value: float):
+        self._values.append(value)
+        self._stale += 1
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, q: float) -> float:
+        if self._stale >= self.RESORT_EVERY or not self._sorted:
+            self._sorted = sorted(self._values)
+            self._stale = 0
+        index = min(len(self._sorted) - 1, int(q * len(self._sorted)))
+        return self._sorted[index]
+
+
+class TimeoutLimits:
+    """Лимиты одного запроса (сек)"""
+    __slots__ = ("connect", "first_byte", "idle")
+
+    def __init__(self, connect: float, first_byte: float, idle: float):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.idle = idle
+
+
+SeriesKey = Tuple[str, str, str]  # route, model, backend
+
+
+class AdaptiveTimeouts:
+    """Скользящие задержки upstream и лимиты на их основе"""
+
+    def __init__(self, enabled: bool, percentile: float, multiplier: float, min_samples: int, window: int,
+                 max_series: int = TIMEOUT_MAX_SERIES):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.window = window
+        self.max_series = max_series
+        self._connect: Dict[str, RollingPercentile] = OrderedDict()
+        # (route, model, backend) -> наблюдения по фазам
+        self._first_byte: Dict[SeriesKey, RollingPercentile] = OrderedDict()  # только потоки
+        self._per_token: Dict[SeriesKey, RollingPercentile] = OrderedDict()
+        # Без потока и без usage: полное время ответа (заголовки приходят после всей генерации)
+        self._total: Dict[SeriesKey, RollingPercentile] = OrderedDict()
+        self._idle: Dict[SeriesKey, RollingPercentile] = OrderedDict()
+
+    def _series(self, store: OrderedDict, key) -> RollingPercentile:
+        series = store.get(key)
+        if series is None:
+            series = store[key] = RollingPercentile(self.window)
+            while len(store) > self.max_series:
+                store.popitem(last=False)
+        else:
+            store.move_to_end(key)
+        return series
+
+    def _estimate(self, store: OrderedDict, key) -> Optional[float]:
+        series = store.get(key)
+        if series is None or len(series) < self.min_samples:
+            return None
+        store.move_to_end(key)
+        return series.percentile(self.percentile)
+
+    def _clamp(self, value: float, floor: float) -> float:
+        return min(max(value * self.multiplier, floor), TIMEOUT_MAX)
+
+    def limits(self, route_name: str, default: float, model: str, backend: str,
+               stream: bool, max_tokens: Optional[int]) -> TimeoutLimits:
+        """Лимиты для запроса; пока наблюдений мало — таймаут маршрута по умолчанию"""
+        if not self.enabled:
+            return TimeoutLimits(TIMEOUT_CONNECT_DEFAULT, default, default)
+
+        connect = self._estimate(self._connect, backend)
+        connect = TIMEOUT_CONNECT_DEFAULT if connect is None else self._clamp(connect, TIMEOUT_CONNECT_MIN)
+
+        key = (route_name, model, backend)
+        idle = self._estimate(self._idle, key)
+        idle = default if idle is None else self._clamp(idle, TIMEOUT_IDLE_MIN)
+        if stream:
+            first_byte = self._estimate(self._first_byte, key)
+            first_byte = default if first_byte is None else self._clamp(first_byte, TIMEOUT_FIRST_BYTE_MIN)
+            return TimeoutLimits(connect, first_byte, idle)
+
+        # Без потока первый байт приходит после всей генерации: оценка растет с max_tokens.
+        # Время до первого чанка потоков сюда не подходит — у них отдельный ряд
+        per_token = self._estimate(self._per_token, key)
+        total = self._estimate(self._total, key)
+        if per_token is not None:
+            tokens = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else TIMEOUT_DEFAULT_MAX_TOKENS
+            first_byte = self._clamp(per_token * tokens, TIMEOUT_FIRST_BYTE_MIN)
+        elif total is not None:
+            first_byte = self._clamp(total, TIMEOUT_FIRST_BYTE_MIN)
+        else:
+            first_byte = default
+        return TimeoutLimits(connect, first_byte, idle)
+
+    def observe_connect(self, backend: str, seconds: float):
+        self._series(self._connect, backend).add(seconds)
+
+    def observe_first_byte(self, route_name: str, model: str, backend: str, seconds: float):
+        """Поток: время до первого чанка"""
+        self._series(self._first_byte, (route_name, model, backend)).add(seconds)
+
+    def observe_generation(self, route_name: str, model: str, backend: str, seconds: float,
+                           usage: Optional[dict]):
+        """Ответ без потока целиком: время на один токен ответа, а без токенов генерации
+        (эмбеддинги, ответ без usage) — полное время ответа"""
+        tokens = usage.get("completion_tokens") if isinstance(usage, dict) else None
+        if isinstance(tokens, int) and tokens > 0:
+            self._series(self._per_token, (route_name, model, backend)).add(seconds / tokens)
+        else:
+            self._series(self._total, (route_name, model, backend)).add(seconds)
+
+    def observe_idle(self, route_name: str, model: str, backend: str, max_gap: float):
+        """Поток: наибольшая пауза между чанками"""
+        self._series(self._idle, (route_name, model, backend)).add(max_gap)
+
+
+adaptive_timeouts = AdaptiveTimeouts(
+    ADAPTIVE_TIMEOUTS, TIMEOUT_PERCENTILE, TIMEOUT_MULTIPLIER, TIMEOUT_MIN_SAMPLES, TIMEOUT_WINDOW
+)
@@ -0,0 +1,99 @@
+"""
+WindexRouter - Локальная оценка числа токенов
+Быстрая оценка длины промпта без обращения к upstream; результат кэшируется по хэшу текста сообщения
+"""
+
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # tokenizers необязателен: без него используется эвристика
+    Tokenizer = None
+
+# tokenizer.json модели (нужен пакет tokenizers); без него — оценка по длине текста в байтах
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")
+TOKEN_ESTIMATE_CACHE_SIZE = int(os.getenv("TOKEN_ESTIMATE_CACHE_SIZE", "65536"))
+# Служебные токены на сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Байты UTF-8 сверх одного на символ: кириллица ~0.67, CJK ~1.1 токена на символ
+NON_ASCII_TOKENS_PER_EXTRA_BYTE = 0.42
+
+_tokenizer = None
+if TOKENIZER_PATH and Tokenizer is not None:
+    _tokenizer = Tokenizer.from_file(TOKENIZER_PATH)
+
+
+# (хэш, длина) текста -> число токенов: кэш не удерживает сами тексты, которые бывают
+# длиной в сотни килобайт. Совпадение хэша лишь исказит оценку одного сообщения
+_cache: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+
+
+def _count_tokens(text: str) -> int:
+    if _tokenizer is not None:
+        return len(_tokenizer.encode(text, add_special_tokens=False).ids)
+    if text.isascii():
+        return (len(text) + 3) // 4
+    extra_bytes = len(text.encode("utf-8")) - len(text)
+    return int(len(text) / 4 + extra_bytes * NON_ASCII_TOKENS_PER_EXTRA_BYTE) + 1
+
+
+def text_tokens(text: str) -> int:
+    """Число токенов текста: токенизатор модели, если задан, иначе эвристика"""
+    key = (hash(text), len(text))
+    tokens = _cache.get(key)
+    if tokens is not None:
+        _cache.move_to_end(key)
+        return tokens
+    tokens = _cache[key] = _count_tokens(text)
+    if len(_cache) > TOKEN_ESTIMATE_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return tokens
+
+
+def _content_tokens(content: Any) -> int:
+    if isinstance(content, str):
+        return text_tokens(content)
+    if isinstance(content, list):
+        # Составное содержимое: учитываются текстовые части
+        return sum(text_tokens(part["text"]) for part in content
+                   if isinstance(part, dict) and isinstance(part.get("text"), str))
+    return 0
+
+
+def message_tokens(message: Any) -> int:
+    if not isinstance(message, dict):
+        return 0
+    return MESSAGE_OVERHEAD_TOKENS + _content_tokens(message.get("content"))
+
+
+def messages_tokens(messages: Any) -> int:
+    if not isinstance(messages, list):
+        return 0
+    return sum(message_tokens(message) for message in messages)
+
+
+def prompt_tokens(request_data: Optional[Dict[str, Any]]) -> int:
+    """Оценка входных токенов запроса чата, completions или эмбеддингов"""
+    if not request_data:
+        return 0
+    if "messages" in request_data:
+        return messages_tokens(request_data["messages"])
+    value = request_data.get("prompt", request_data.get("input"))
+    if isinstance(value, str):
+        return text_tokens(value)
+    if isinstance(value, list):
+        return sum(text_tokens(item) for item in value if isinstance(item, str))
+    return 0
+
+
+def largest_prompt_tokens(request_data: Optional[Dict[str, Any]]) -> int:
+    """Оценка самого длинного промпта запроса: элементы списка prompt/input
+    обрабатываются независимо, и окно контекста относится к каждому из них"""
+    if not request_data:
+        return 0
+    value = request_data.get("prompt", request_data.get("input"))
+    if "messages" not in request_data and isinstance(value, list):
+        return max((text_tokens(item) for item in value if isinstance(item, str)), default=0)
+    return prompt_tokens(request_data)
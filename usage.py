@@ -0,0 +1,117 @@
+"""
+WindexRouter - Журнал использования API
+Записи копятся в памяти и пишутся пачками в фоне в помесячные партиции api_usage_log_ГГГГММ
+"""
+
+import asyncio
+import logging
+import os
+from typing import List, Optional, Set, Tuple
+
+import db
+import metrics
+
+logger = logging.getLogger("windexrouter.usage")
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_FLUSH_BATCH = int(os.getenv("USAGE_FLUSH_BATCH", "500"))
+# Предел буфера, пока БД недоступна: сверх него самые старые строки отбрасываются
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "100000"))
+
+USAGE_DROPPED = metrics.Counter(
+    "windex_usage_dropped_rows_total", "Строки лога использования, отброшенные при переполнении буфера"
+)
+
+UsageRow = Tuple[str, str, str, int]  # user_id, api_key_id, endpoint, timestamp
+
+
+# Партиции, про которые этот процесс знает, что они существуют
+_known_partitions: Set[str] = set()
+
+
+def _write_rows(rows: List[UsageRow]):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(db.usage_month(row[3]), []).append(row)
+    conn = db.connect()
+    try:
+        if not _known_partitions.issuperset(by_month):
+            # Новая партиция — DDL и перестройка представления под блокировкой записи
+            conn.execute("BEGIN IMMEDIATE")
+            for month in by_month:
+                db.ensure_usage_partition(conn, month)
+        for month, month_rows in by_month.items():
+            conn.executemany(f'''
+                INSERT INTO {db.usage_partition(month)} (user_id, api_key_id, endpoint, timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', month_rows)
+        conn.commit()
+        _known_partitions.update(by_month)
+    except Exception:
+        # Партицию могли удалить из другого процесса: в следующий раз проверить заново
+        _known_partitions.clear()
+        raise
+    finally:
+        conn.close()
+
+
+class UsageLogWriter:
+    """Буферизованная запись лога использования одной транзакцией на пачку"""
+
+    def __init__(self, interval: float, batch_size: int, max_rows: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self._buffer: List[UsageRow] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def record(self, user_id: str, api_key_id: str, endpoint: str):
+        self._buffer.append((user_id, api_key_id, endpoint, db.now_ts()))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записать накопленные строки в БД (вне event loop)"""
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, _write_rows, rows)
+        except Exception:
+            logger.exception("Не удалось записать %d строк лога использования", len(rows))
+            self._buffer[:0] = rows
+            overflow = len(self._buffer) - self.max_rows
+            if overflow > 0:
+                del self._buffer[:overflow]
+                USAGE_DROPPED.inc(amount=overflow)
+                logger.error("Буфер лога использования переполнен: отброшено %d строк", overflow)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую задачу и дописать остаток буфера"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+usage_writer = UsageLogWriter(USAGE_FLUSH_INTERVAL, USAGE_FLUSH_BATCH, USAGE_BUFFER_MAX)
@@ -0,0 +1,248 @@
+"""
+WindexRouter - Чат через WebSocket
+Одна проверка ключа на соединение, несколько реплик подряд, потоковая передача чанков и отмена
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+
+import metrics
+import proxy
+import routing
+from context_window import context_limits
+from lifecycle import readiness
+from proxy import CHAT_ROUTE
+from shadow import shadow_mirror
+
+# Сколько реплик одного соединения может обрабатываться одновременно
+WS_MAX_TURNS_IN_FLIGHT = int(os.getenv("WS_MAX_TURNS_IN_FLIGHT", "4"))
+# Сколько ждать сообщения авторизации, если ключ не передан в заголовке (сек)
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+# Ключ перепроверяется (через кэш ключей) не чаще этого интервала, а не на каждую реплику
+WS_REAUTH_INTERVAL = float(os.getenv("WS_REAUTH_INTERVAL", "60"))
+
+METRICS_ROUTE = "deepseek_chat_ws"
+# Коды закрытия: нарушение политики (ключ) и перезапуск сервиса (остановка воркера)
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_SERVICE_RESTART = 1012
+
+WS_CONNECTIONS = metrics.Gauge("windex_ws_connections", "Открытые WebSocket-соединения чата")
+
+
+def _sse_payloads(buffer: bytes):
+    """Полные события SSE из буфера: (список data-полезных нагрузок, остаток буфера)"""
+    payloads = []
+    buffer = buffer.replace(b"\r\n", b"\n")
+    while True:
+        end = buffer.find(b"\n\n")
+        if end < 0:
+            return payloads, buffer
+        event, buffer = buffer[:end], buffer[end + 2:]
+        for line in event.split(b"\n"):
+            if line.startswith(b"data:"):
+                payload = line[5:].strip()
+                if payload and payload != b"[DONE]":
+                    payloads.append(payload)
+
+
+class ChatSocketSession:
+    """Сессия чата поверх WebSocket.
+
+    Клиент -> сервер: {"type": "auth", "api_key"}, {"type": "chat", "id", "request"},
+    {"type": "cancel", "id"}, {"type": "ping"}.
+    Сервер -> клиент: ready, chunk (data — событие upstream как есть), done (с usage и context_trimmed,
+    если старые реплики были отброшены),
+    cancelled, error (status, detail), pong."""
+
+    def __init__(self, websocket: WebSocket, authenticate: Callable[[str], Awaitable[Optional[tuple]]],
+                 admit: Callable, track: Callable):
+        self.websocket = websocket
+        self.authenticate = authenticate
+        self.admit = admit
+        self.track = track
+        self.api_key: Optional[str] = None
+        self.user = None
+        self.key_id: Optional[str] = None
+        self.authenticated_at = 0.0
+        self.turns: Dict[str, asyncio.Task] = {}
+
+    async def send(self, message: dict):
+        await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+
+    async def send_error(self, turn_id: Optional[str], status_code: int, detail: str, **extra):
+        await self.send({"type": "error", "id": turn_id, "status": status_code, "detail": detail, **extra})
+
+    async def _login(self) -> bool:
+        header = self.websocket.headers.get("authorization", "")
+        if header.startswith("Bearer "):
+            api_key = header[7:]
+        else:
+            try:
+                message = await asyncio.wait_for(self.websocket.receive_json(), WS_AUTH_TIMEOUT)
+            except (asyncio.TimeoutError, ValueError):
+                return False
+            api_key = message.get("api_key") if isinstance(message, dict) and message.get("type") == "auth" else None
+            if not isinstance(api_key, str):
+                return False
+
+        result = await self.authenticate(api_key)
+        if not result:
+            return False
+        self.api_key = api_key
+        self.user, self.key_id = result
+        self.authenticated_at = time.monotonic()
+        return True
+
+    async def _still_authorized(self) -> bool:
+        if time.monotonic() - self.authenticated_at < WS_REAUTH_INTERVAL:
+            return True
+        result = await self.authenticate(self.api_key)
+        if not result:
+            return False
+        self.user, self.key_id = result
+        self.authenticated_at = time.monotonic()
+        return True
+
+    async def run(self):
+        await self.websocket.accept()
+        if not await self._login():
+            await self.send_error(None, status.HTTP_401_UNAUTHORIZED, "Недействительный или истекший API ключ")
+            await self.websocket.close(code=CLOSE_POLICY_VIOLATION)
+            return
+
+        WS_CONNECTIONS.inc()
+        try:
+            await self.send({"type": "ready"})
+            while True:
+                try:
+                    message = await self.websocket.receive_json()
+                except ValueError:
+                    await self.send_error(None, status.HTTP_400_BAD_REQUEST, "Неверный JSON в сообщении")
+                    continue
+                if not await self._handle(message):
+                    break
+        except WebSocketDisconnect:
+            pass
+        finally:
+            WS_CONNECTIONS.dec()
+            for task in list(self.turns.values()):
+                task.cancel()
+            if self.turns:
+                await asyncio.gather(*self.turns.values(), return_exceptions=True)
+
+    async def _handle(self, message) -> bool:
+        """Обработать сообщение клиента; False — закрыть соединение"""
+        kind = message.get("type") if isinstance(message, dict) else None
+        turn_id = message.get("id") if isinstance(message, dict) else None
+
+        if kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind == "cancel":
+            task = self.turns.get(turn_id)
+            if task is not None:
+                task.cancel()
+        elif kind == "chat":
+            request_data = message.get("request")
+            if readiness.draining:
+                await self.send_error(turn_id, status.HTTP_503_SERVICE_UNAVAILABLE,
+                                      "Сервер останавливается, повторите запрос")
+                await self.websocket.close(code=CLOSE_SERVICE_RESTART)
+                return False
+            if not await self._still_authorized():
+                await self.send_error(turn_id, status.HTTP_401_UNAUTHORIZED, "Недействительный или истекший API ключ")
+                await self.websocket.close(code=CLOSE_POLICY_VIOLATION)
+                return False
+            if not isinstance(turn_id, str) or turn_id in self.turns:
+                await self.send_error(turn_id, status.HTTP_400_BAD_REQUEST, "Нужен уникальный строковый id реплики")
+            elif not isinstance(request_data, dict) or CHAT_ROUTE.required_field not in request_data:
+                await self.send_error(turn_id, status.HTTP_400_BAD_REQUEST,
+                                      f"Отсутствует поле '{CHAT_ROUTE.required_field}' в запросе")
+            elif len(self.turns) >= WS_MAX_TURNS_IN_FLIGHT:
+                await self.send_error(turn_id, status.HTTP_429_TOO_MANY_REQUESTS,
+                                      "Слишком много одновременных реплик в соединении")
+            else:
+                task = asyncio.get_running_loop().create_task(self._turn(turn_id, request_data))
+                self.turns[turn_id] = task
+                task.add_done_callback(lambda _, turn_id=turn_id: self.turns.pop(turn_id, None))
+        else:
+            await self.send_error(turn_id, status.HTTP_400_BAD_REQUEST, "Неизвестный тип сообщения")
+        return True
+
+    async def _turn(self, turn_id: str, request_data: dict):
+        # Реплика учитывается как запрос в обработке: остановка воркера дожидается ее
+        readiness.request_started()
+        started = time.perf_counter()
+        metrics.IN_FLIGHT.inc(METRICS_ROUTE)
+        status_code = 500
+        try:
+            status_code = await self._stream_turn(turn_id, request_data)
+        except asyncio.CancelledError:
+            status_code = 499
+            try:
+                await self.send({"type": "cancelled", "id": turn_id})
+            except Exception:
+                pass
+        except HTTPException as e:
+            status_code = e.status_code
+            if e.status_code in (status.HTTP_502_BAD_GATEWAY, status.HTTP_504_GATEWAY_TIMEOUT):
+                metrics.UPSTREAM_ERRORS.inc(METRICS_ROUTE, str(e.status_code))
+            retry_after = (e.headers or {}).get("Retry-After")
+            extra = {"retry_after": int(retry_after)} if retry_after else {}
+            try:
+                await self.send_error(turn_id, e.status_code, e.detail, **extra)
+            except Exception:
+                pass
+        except WebSocketDisconnect:
+            pass
+        finally:
+            readiness.request_finished()
+            metrics.IN_FLIGHT.dec(METRICS_ROUTE)
+            metrics.REQUESTS_TOTAL.inc(METRICS_ROUTE, str(status_code))
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - started, METRICS_ROUTE)
+
+    async def _stream_turn(self, turn_id: str, request_data: dict) -> int:
+        self.admit(CHAT_ROUTE, self.user, self.key_id)
+
+        request_data = dict(request_data, stream=True)
+        trimmed = context_limits.fit(CHAT_ROUTE, request_data)
+        body = json.dumps(request_data, ensure_ascii=False).encode("utf-8")
+        sample = shadow_mirror.mirror(CHAT_ROUTE, body, True)
+        track_usage = self.track(CHAT_ROUTE, self.user, self.key_id, sample)
+        reported = {}
+
+        def on_usage(usage: Optional[dict]):
+            reported["usage"] = usage
+            if track_usage is not None:
+                track_usage(usage)
+
+        affinity = routing.prefix_key(request_data) if routing.STICKY_ROUTING else None
+        response = await proxy.forward(
+            CHAT_ROUTE, body, stream=True, affinity=affinity, on_usage=on_usage,
+            on_first_chunk=sample.primary_first_chunk if sample is not None else None,
+            model=request_data.get("model"), max_tokens=request_data.get("max_tokens"),
+            cost=routing.request_cost(request_data),
+        )
+
+        # Событие upstream вставляется в сообщение как есть, без разбора и повторной сериализации
+        prefix = '{"type":"chunk","id":' + json.dumps(turn_id, ensure_ascii=False) + ',"data":'
+        buffer = b""
+        try:
+            async for chunk in response.body_iterator:
+                payloads, buffer = _sse_payloads(buffer + chunk)
+                for payload in payloads:
+                    await self.websocket.send_text(prefix + payload.decode("utf-8") + "}")
+        finally:
+            await response.body_iterator.aclose()
+            if response.background is not None:
+                await response.background()
+
+        done = {"type": "done", "id": turn_id, "usage": reported.get("usage")}
+        if trimmed:
+            done["context_trimmed"] = trimmed
+        await self.send(done)
+        return status.HTTP_200_OK